@@ -1,45 +1,41 @@
 """Agents API."""
 from fastapi import APIRouter, Depends, HTTPException
 
-from app.deps import get_db
+from app.deps import get_db, get_read_db
 from app.schemas.agent import AgentCreateIn, AgentOut, AgentUpdateIn
+from app.services.answer_cache import invalidate_agent_answers
+from app.storage.db import run_after_commit
 from app.storage.repositories import agent_create, agent_get, agent_list, agent_update
 from sqlalchemy.ext.asyncio import AsyncSession
 
 router = APIRouter(prefix="/api/agents", tags=["agents"])
 
 
+def _agent_out(a) -> AgentOut:
+    return AgentOut(
+        id=a.id,
+        name=a.name,
+        description=a.description,
+        icon=a.icon or "",
+        systemPrompt=a.system_prompt or "",
+        modelId=a.model_id,
+        supportedCategories=a.supported_categories,
+        answerCache=a.answer_cache,
+    )
+
+
 @router.get("", response_model=list[AgentOut])
-async def list_agents(session: AsyncSession = Depends(get_db)):
+async def list_agents(session: AsyncSession = Depends(get_read_db)):
     agents = await agent_list(session)
-    return [
-        AgentOut(
-            id=a.id,
-            name=a.name,
-            description=a.description,
-            icon=a.icon or "",
-            systemPrompt=a.system_prompt or "",
-            modelId=a.model_id,
-            supportedCategories=a.supported_categories,
-        )
-        for a in agents
-    ]
+    return [_agent_out(a) for a in agents]
 
 
 @router.get("/{agent_id}", response_model=AgentOut)
-async def get_agent(agent_id: str, session: AsyncSession = Depends(get_db)):
+async def get_agent(agent_id: str, session: AsyncSession = Depends(get_read_db)):
     agent = await agent_get(session, agent_id)
     if not agent:
         raise HTTPException(status_code=404, detail="Agent not found")
-    return AgentOut(
-        id=agent.id,
-        name=agent.name,
-        description=agent.description,
-        icon=agent.icon or "",
-        systemPrompt=agent.system_prompt or "",
-        modelId=agent.model_id,
-        supportedCategories=agent.supported_categories,
-    )
+    return _agent_out(agent)
 
 
 @router.post("", response_model=AgentOut)
@@ -51,16 +47,9 @@ async def create_agent(body: AgentCreateIn, session: AsyncSession = Depends(get_
         icon=body.icon or "",
         system_prompt=body.systemPrompt,
         supported_categories=body.supportedCategories,
+        answer_cache=body.answerCache,
     )
-    return AgentOut(
-        id=agent.id,
-        name=agent.name,
-        description=agent.description,
-        icon=agent.icon or "",
-        systemPrompt=agent.system_prompt or "",
-        modelId=agent.model_id,
-        supportedCategories=agent.supported_categories,
-    )
+    return _agent_out(agent)
 
 
 @router.patch("/{agent_id}", response_model=AgentOut)
@@ -74,15 +63,11 @@ async def update_agent(agent_id: str, body: AgentUpdateIn, session: AsyncSession
         system_prompt=body.systemPrompt,
         model_id=body.modelId,
         supported_categories=body.supportedCategories,
+        answer_cache=body.answerCache,
     )
-    if not a:
+    if not agent:
         raise HTTPException(status_code=404, detail="Agent not found")
-    return AgentOut(
-        id=a.id,
-        name=agent.name,
-        description=agent.description,
-        icon=agent.icon or "",
-        systemPrompt=agent.system_prompt or "",
-        modelId=agent.model_id,
-        supportedCategories=agent.supported_categories,
-    )
+    if body.systemPrompt is not None or body.answerCache is not None:
+        # Ответы под старый промпт больше не подходят (новый промпт и так даёт новый индекс — здесь чистим старые)
+        run_after_commit(session, lambda: invalidate_agent_answers(agent_id))
+    return _agent_out(agent)
@@ -53,6 +53,8 @@ async def login_telegram(
         external_id=str(user_id),
     )
     token = create_token(account.id)
+    # Сразу после логина клиент читает по этому токену — не отправлять его на отстающую реплику
+    request.state.consistency_keys = [f"account:{account.id}"]
     return AuthOut(
         token=token,
         accountId=account.id,
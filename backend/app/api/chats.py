@@ -1,30 +1,39 @@
 """Chats API: list, get, create, send message, send voice, set model/agent."""
-from fastapi import APIRouter, Body, Depends, File, Form, HTTPException, UploadFile
+import orjson
+from fastapi import (
+    APIRouter, Body, Depends, File, Form, Header, HTTPException, Query, Request, Response, UploadFile, WebSocket,
+)
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.schemas.chat import (
     ChatSummaryOut,
     ChatWithMessagesOut,
     CreateChatIn,
-    MessageOut,
     SendMessageIn,
     SendMessageOut,
     SetAgentIn,
     SetModelIn,
 )
+from app.services.channel_profiles import split_for_channel
 from app.services.chat_service import generate_reply
-from app.deps import get_db, get_optional_account
+from app.services.idempotency import fingerprint, idempotent
+from app.deps import get_db, get_optional_account, get_read_db
+from app.storage.db import get_session
 from app.storage.models import AccountModel
 from app.storage.repositories import (
     chat_create,
     chat_get,
     chat_get_or_create_for_channel,
+    chat_get_row,
     chat_get_with_messages,
     chat_list,
+    chat_lock,
     chat_set_agent,
     chat_set_model,
     chat_update_title,
     message_add,
+    messages_page,
+    messages_page_of,
 )
 
 router = APIRouter(prefix="/api/chats", tags=["chats"])
@@ -44,7 +53,7 @@ async def list_chats(
     channel: str | None = None,
     externalId: str | None = None,
     for_me: bool = False,
-    session: AsyncSession = Depends(get_db),
+    session: AsyncSession = Depends(get_read_db),
     account: AccountModel | None = Depends(get_optional_account),
 ):
     """List chats. Use channel+externalId (bot) or for_me=1 with Bearer token (web, same account as Telegram)."""
@@ -54,7 +63,8 @@ async def list_chats(
     chats = await chat_list(session, channel=channel, external_id=externalId)
     result = []
     for c in chats:
-        full = await chat_get_with_messages(session, c.id)
+        # Архивные чаты в списке не поднимаем из архива: превью хранится в заглушке
+        full = await chat_get_with_messages(session, c.id, rehydrate=False)
         messages = full.messages if full else []
         last = messages[-1].created_at.isoformat() if messages else c.updated_at.isoformat()
         result.append(
@@ -62,7 +72,7 @@ async def list_chats(
                 id=c.id,
                 title=c.title,
                 model=c.model_id,
-                lastMessagePreview=_last_preview(messages),
+                lastMessagePreview=_last_preview(messages) if messages or not c.archive_preview else c.archive_preview,
                 lastMessageAt=last,
             )
         )
@@ -77,20 +87,20 @@ async def get_or_create_chat_by_channel(
 ):
     """For bots: get or create chat for channel user. Returns chat summary."""
     chat = await chat_get_or_create_for_channel(session, channel, externalId)
-    full = await chat_get_with_messages(session, chat.id)
+    full = await chat_get_with_messages(session, chat.id, rehydrate=False)
     messages = full.messages if full else []
     last = messages[-1].created_at.isoformat() if messages else chat.updated_at.isoformat()
     return ChatSummaryOut(
         id=chat.id,
         title=chat.title,
         model=chat.model_id,
-        lastMessagePreview=_last_preview(messages),
+        lastMessagePreview=_last_preview(messages) if messages or not chat.archive_preview else chat.archive_preview,
         lastMessageAt=last,
     )
 
 
 @router.get("/{chat_id}/ticket")
-async def get_chat_ticket(chat_id: str, session: AsyncSession = Depends(get_db)):
+async def get_chat_ticket(chat_id: str, session: AsyncSession = Depends(get_read_db)):
     from app.storage.repositories import ticket_get_by_chat
     t = await ticket_get_by_chat(session, chat_id)
     if not t:
@@ -108,34 +118,60 @@ async def get_chat_ticket(chat_id: str, session: AsyncSession = Depends(get_db))
 
 
 @router.get("/{chat_id}", response_model=ChatWithMessagesOut)
-async def get_chat(chat_id: str, session: AsyncSession = Depends(get_db)):
-    chat = await chat_get_with_messages(session, chat_id)
+async def get_chat(
+    chat_id: str,
+    since_seq: int | None = Query(None, ge=0),
+    before_seq: int | None = Query(None, ge=1),
+    limit: int | None = Query(None, ge=1, le=500),
+    session: AsyncSession = Depends(get_read_db),
+):
+    """
+    Chat with its messages in seq order. Without parameters returns the whole history.
+    since_seq=N: only messages after N (incremental sync); limit=K: newest K, before_seq=N pages further back.
+    Fast path for long chats: Core rows serialized straight to JSON bytes (no ORM objects, no per-message
+    pydantic models); response_model is kept for the OpenAPI schema only.
+    """
+    chat = await chat_get_row(session, chat_id)
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
-    return ChatWithMessagesOut(
-        id=chat.id,
-        title=chat.title,
-        modelId=chat.model_id,
-        agentId=chat.agent_id,
-        messages=[
-            MessageOut(
-                id=m.id,
-                role=m.role,
-                content=m.content,
-                createdAt=m.created_at.isoformat(),
-            )
-            for m in chat.messages
+    if chat.archived_at is not None:
+        # Холодный чат: chat_get_with_messages возвращает сообщения из архива, страницу режем в памяти
+        full = await chat_get_with_messages(session, chat_id)
+        messages, has_more = messages_page_of(
+            full.messages, since_seq=since_seq, before_seq=before_seq, limit=limit
+        )
+    else:
+        messages, has_more = await messages_page(
+            session, chat_id, since_seq=since_seq, before_seq=before_seq, limit=limit
+        )
+    body = {
+        "id": chat.id,
+        "title": chat.title,
+        "modelId": chat.model_id,
+        "agentId": chat.agent_id,
+        # orjson пишет naive datetime так же, как isoformat()
+        "messages": [
+            {
+                "id": m.id, "role": m.role, "content": m.content, "createdAt": m.created_at, "seq": m.seq,
+                "provenance": m.provenance,
+            }
+            for m in messages
         ],
-    )
+        "hasMore": has_more,
+    }
+    return Response(content=orjson.dumps(body), media_type="application/json")
 
 
 @router.post("", response_model=ChatSummaryOut)
 async def create_chat(
+    request: Request,
     body: CreateChatIn | None = Body(None),
     session: AsyncSession = Depends(get_db),
 ):
     model_id = (body.modelId if body else None) or "openrouter/auto"
     if body and body.channel and body.externalId:
+        # channel+externalId пришли в теле, а не в query: закрепляем чтения этого пользователя за primary сами
+        request.state.consistency_keys = [f"user:{body.channel}:{body.externalId}"]
         chat = await chat_create(
             session, model_id=model_id, channel=body.channel, external_id=body.externalId
         )
@@ -154,77 +190,127 @@ async def create_chat(
 async def send_message(
     chat_id: str,
     body: SendMessageIn,
+    response: Response,
     session: AsyncSession = Depends(get_db),
+    idempotency_key: str | None = Header(None, alias="Idempotency-Key"),
 ):
+    """Send a message and get the reply. Idempotency-Key: a retry with the same key returns the first response."""
     from app.storage.repositories import ticket_create, ticket_get_by_chat, ticket_update
     from app.services.support_orchestration import classify_support_message, route_ticket_to_agent
 
-    chat = await chat_get_with_messages(session, chat_id)
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat not found")
-    await message_add(session, chat_id, "user", body.message)
-    # Auto support: create ticket on first message, classify, route to agent
-    ticket = await ticket_get_by_chat(session, chat_id)
-    if not ticket:
-        ticket = await ticket_create(session, chat_id)
-        category = await classify_support_message(body.message)
-        await ticket_update(session, ticket.id, category=category)
-        await route_ticket_to_agent(session, ticket.id, category)
-    if body.modelId:
-        await chat_set_model(session, chat_id, body.modelId)
-    content = await generate_reply(session, chat_id, body.message, body.modelId)
-    await message_add(session, chat_id, "assistant", content)
-    title = (body.message[:50] + "…") if len(body.message) > 50 else body.message
-    await chat_update_title(session, chat_id, title)
-    # Level 2 Voice: optional TTS response for text messages (ElevenLabs)
-    audio_base64 = None
-    if body.withVoice:
-        from app.voice.elevenlabs_client import text_to_speech_base64
-        audio_base64 = await text_to_speech_base64(content) or ""
-    return SendMessageOut(content=content, audioBase64=audio_base64)
+    fp = fingerprint(body.model_dump())
+    async with idempotent(session, f"send:{chat_id}", idempotency_key, fp) as idem:
+        if idem.replay is not None:
+            response.headers["Idempotent-Replayed"] = "true"
+            return idem.replay
+        # Один /send на чат за раз: параллельный (двойное нажатие, ретрай без ключа) ждёт и видит уже созданный тикет
+        await chat_lock(session, chat_id)
+        chat = await chat_get(session, chat_id)
+        if not chat:
+            raise HTTPException(status_code=404, detail="Chat not found")
+        if chat.archived_at is not None:
+            # Архив поднимаем до записи: после неё строка чата заблокирована этой транзакцией и rehydrate её пропустит
+            await chat_get_with_messages(session, chat_id)
+        await message_add(session, chat_id, "user", body.message)
+        # Auto support: create ticket on first message, classify, route to agent
+        ticket = await ticket_get_by_chat(session, chat_id)
+        if not ticket:
+            ticket = await ticket_create(session, chat_id)
+            category = await classify_support_message(body.message)
+            await ticket_update(session, ticket.id, category=category)
+            await route_ticket_to_agent(session, ticket.id, category)
+        if body.modelId:
+            await chat_set_model(session, chat_id, body.modelId)
+        content, provenance = await generate_reply(session, chat_id, body.message, body.modelId)
+        await message_add(session, chat_id, "assistant", content, provenance=provenance)
+        title = (body.message[:50] + "…") if len(body.message) > 50 else body.message
+        await chat_update_title(session, chat_id, title)
+        # Level 2 Voice: optional TTS response for text messages (ElevenLabs)
+        audio_base64 = None
+        if body.withVoice:
+            from app.voice.elevenlabs_client import text_to_speech_base64
+            audio_base64 = await text_to_speech_base64(content) or ""
+        return idem.complete(SendMessageOut(
+            content=content,
+            audioBase64=audio_base64,
+            parts=split_for_channel(content, chat.channel),
+        ).model_dump())
 
 
 @router.post("/{chat_id}/send-voice")
 async def send_voice(
     chat_id: str,
+    response: Response,
     session: AsyncSession = Depends(get_db),
     audio: UploadFile = File(...),
     modelId: str | None = Form(None),
     withVoice: bool = Form(True),
+    idempotency_key: str | None = Header(None, alias="Idempotency-Key"),
 ):
-    """Accept audio upload → ElevenLabs STT → LLM; optionally ElevenLabs TTS. withVoice: when True (default), return TTS for the reply (как при включённой кнопке «Ответить голосом»)."""
+    """Accept audio upload → ElevenLabs STT → LLM; optionally ElevenLabs TTS. withVoice: when True (default), return TTS for the reply (как при включённой кнопке «Ответить голосом»). Idempotency-Key as in /send."""
     from app.voice.elevenlabs_client import speech_to_text, text_to_speech_base64
 
     raw = await audio.read()
-    filename = audio.filename or "audio.webm"
-    user_text = await speech_to_text(raw, filename)
-    if user_text is None or not str(user_text).strip():
-        user_text = (
-            "[Голос: не удалось распознать. Проверьте ELEVENLABS_API_KEY в .env, "
-            "что запись не пустая и не слишком короткая; поддерживаются форматы в т.ч. WebM. Подробности — в логах backend.]"
-        )
-    chat = await chat_get_with_messages(session, chat_id)
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat not found")
-    await message_add(session, chat_id, "user", user_text)
+    fp = fingerprint(raw, modelId, withVoice)
+    async with idempotent(session, f"send-voice:{chat_id}", idempotency_key, fp) as idem:
+        if idem.replay is not None:
+            response.headers["Idempotent-Replayed"] = "true"
+            return idem.replay
+        filename = audio.filename or "audio.webm"
+        user_text = await speech_to_text(raw, filename)
+        if user_text is None or not str(user_text).strip():
+            user_text = (
+                "[Голос: не удалось распознать. Проверьте ELEVENLABS_API_KEY в .env, "
+                "что запись не пустая и не слишком короткая; поддерживаются форматы в т.ч. WebM. Подробности — в логах backend.]"
+            )
+        await chat_lock(session, chat_id)
+        chat = await chat_get(session, chat_id)
+        if not chat:
+            raise HTTPException(status_code=404, detail="Chat not found")
+        if chat.archived_at is not None:
+            await chat_get_with_messages(session, chat_id)
+        await message_add(session, chat_id, "user", user_text)
 
-    from app.storage.repositories import ticket_create, ticket_get_by_chat, ticket_update
-    from app.services.support_orchestration import classify_support_message, route_ticket_to_agent
+        from app.storage.repositories import ticket_create, ticket_get_by_chat, ticket_update
+        from app.services.support_orchestration import classify_support_message, route_ticket_to_agent
 
-    ticket = await ticket_get_by_chat(session, chat_id)
-    if not ticket:
-        ticket = await ticket_create(session, chat_id)
-        category = await classify_support_message(user_text)
-        await ticket_update(session, ticket.id, category=category)
-        await route_ticket_to_agent(session, ticket.id, category)
-    if modelId:
-        await chat_set_model(session, chat_id, modelId)
-    content = await generate_reply(session, chat_id, user_text, modelId)
-    await message_add(session, chat_id, "assistant", content)
-    audio_base64 = ""
-    if withVoice:
-        audio_base64 = await text_to_speech_base64(content) or ""
-    return {"content": content, "audioBase64": audio_base64}
+        ticket = await ticket_get_by_chat(session, chat_id)
+        if not ticket:
+            ticket = await ticket_create(session, chat_id)
+            category = await classify_support_message(user_text)
+            await ticket_update(session, ticket.id, category=category)
+            await route_ticket_to_agent(session, ticket.id, category)
+        if modelId:
+            await chat_set_model(session, chat_id, modelId)
+        content, provenance = await generate_reply(session, chat_id, user_text, modelId)
+        await message_add(session, chat_id, "assistant", content, provenance=provenance)
+        audio_base64 = ""
+        if withVoice:
+            audio_base64 = await text_to_speech_base64(content) or ""
+        return idem.complete({
+            "content": content,
+            "audioBase64": audio_base64,
+            "parts": split_for_channel(content, chat.channel),
+        })
+
+
+@router.websocket("/{chat_id}/voice-stream")
+async def voice_stream(
+    websocket: WebSocket,
+    chat_id: str,
+    modelId: str | None = None,
+    withVoice: bool = True,
+):
+    """Duplex voice: audio frames in while speaking → partial STT; end of utterance → LLM → streamed TTS out. See app/voice/realtime.py."""
+    from app.voice.realtime import VoiceSession
+
+    async with get_session() as session:
+        chat = await chat_get(session, chat_id)
+    if not chat:
+        await websocket.close(code=4404)
+        return
+    await websocket.accept()
+    await VoiceSession(websocket, chat_id, model_id=modelId, with_voice=withVoice).run()
 
 
 @router.post("/{chat_id}/model")
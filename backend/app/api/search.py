@@ -0,0 +1,78 @@
+"""Search API: full-text search over chat history."""
+import base64
+from typing import Literal
+
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.deps import get_optional_account, get_read_db
+from app.schemas.chat import MessageSearchHitOut, MessageSearchOut
+from app.storage.models import AccountModel
+from app.storage.repositories import messages_search, search_snippet_html
+
+router = APIRouter(prefix="/api/search", tags=["search"])
+
+
+def _encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(orjson.dumps(values)).decode()
+
+
+def _decode_cursor(cursor: str, sort: str) -> tuple:
+    try:
+        values = orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, orjson.JSONDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if sort == "recent" and isinstance(values, list) and len(values) == 1:
+        return tuple(values)
+    if sort == "rank" and isinstance(values, list) and len(values) == 2 and isinstance(values[0], (int, float)):
+        return tuple(values)
+    raise HTTPException(status_code=400, detail="Cursor does not match sort")
+
+
+@router.get("/messages", response_model=MessageSearchOut)
+async def search_messages(
+    q: str = Query(..., min_length=1, max_length=500),
+    channel: str | None = None,
+    externalId: str | None = None,
+    for_me: bool = False,
+    sort: Literal["rank", "recent"] = "rank",
+    limit: int = Query(20, ge=1, le=100),
+    cursor: str | None = None,
+    session: AsyncSession = Depends(get_read_db),
+    account: AccountModel | None = Depends(get_optional_account),
+):
+    """
+    Search messages (web search syntax: words, "exact phrase", -exclude, or). Scope to one user's chats with
+    channel+externalId or for_me=1 with Bearer token. sort=rank (relevance among the newest 10000 matches) or
+    recent (newest first). Snippets are HTML-escaped, with matched terms in <mark></mark>.
+    """
+    if for_me:
+        if account is None:
+            raise HTTPException(status_code=401, detail="Authentication required")
+        channel = account.channel
+        externalId = account.external_id
+    after = _decode_cursor(cursor, sort) if cursor else None
+    rows, has_more = await messages_search(
+        session, q, channel=channel, external_id=externalId, sort=sort, after=after, limit=limit
+    )
+    next_cursor = None
+    if has_more and rows:
+        last = rows[-1]
+        next_cursor = _encode_cursor([last.id] if sort == "recent" else [last.rank, last.id])
+    return MessageSearchOut(
+        hits=[
+            MessageSearchHitOut(
+                id=r.id,
+                chatId=r.chat_id,
+                chatTitle=r.chat_title,
+                role=r.role,
+                createdAt=r.created_at.isoformat(),
+                seq=r.seq,
+                rank=r.rank,
+                snippet=search_snippet_html(r.snippet),
+            )
+            for r in rows
+        ],
+        nextCursor=next_cursor,
+    )
@@ -2,7 +2,7 @@
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.deps import get_db
+from app.deps import get_db, get_read_db
 from app.schemas.ticket import TicketCreateIn, TicketOut, TicketUpdateIn
 from app.services.support_orchestration import classify_support_message, route_ticket_to_agent
 from app.storage.repositories import (
@@ -69,14 +69,14 @@ async def create_ticket(body: TicketCreateIn, session: AsyncSession = Depends(ge
 @router.get("", response_model=list[TicketOut])
 async def list_tickets(
     status: str | None = None,
-    session: AsyncSession = Depends(get_db),
+    session: AsyncSession = Depends(get_read_db),
 ):
     tickets = await ticket_list(session, status=status)
     return [_ticket_out(t) for t in tickets]
 
 
 @router.get("/{ticket_id}", response_model=TicketOut)
-async def get_ticket(ticket_id: str, session: AsyncSession = Depends(get_db)):
+async def get_ticket(ticket_id: str, session: AsyncSession = Depends(get_read_db)):
     t = await ticket_get(session, ticket_id)
     if not t:
         raise HTTPException(status_code=404, detail="Ticket not found")
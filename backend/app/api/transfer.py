@@ -0,0 +1,59 @@
+"""Bulk transfer API: streaming NDJSON export and COPY-based import of chats with their messages."""
+from datetime import datetime
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse
+
+from app.deps import get_optional_account, is_admin, require_admin
+from app.services.chat_transfer import ChatImportError, export_ndjson, import_ndjson
+from app.storage.models import AccountModel
+
+router = APIRouter(prefix="/api/transfer", tags=["transfer"])
+
+
+@router.get("/export")
+async def export_chats(
+    channel: str | None = None,
+    externalId: str | None = None,
+    for_me: bool = False,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    gzip: bool = False,
+    account: AccountModel | None = Depends(get_optional_account),
+    admin: bool = Depends(is_admin),
+):
+    """
+    Stream chats and messages as NDJSON (gzip=1: .ndjson.gz), optionally within a [since, until) window.
+    A Bearer account exports only its own chats (for_me=1 is implied). With X-Admin-Token: any channel+externalId,
+    or everything without filters.
+    """
+    if for_me or not admin:
+        if account is None:
+            raise HTTPException(status_code=401, detail="Authentication required")
+        if (channel or externalId) and (channel, externalId) != (account.channel, account.external_id):
+            raise HTTPException(status_code=403, detail="Only your own chats can be exported")
+        channel = account.channel
+        externalId = account.external_id
+    body = export_ndjson(channel=channel, external_id=externalId, since=since, until=until, compress=gzip)
+    filename = "chats.ndjson.gz" if gzip else "chats.ndjson"
+    return StreamingResponse(
+        body,
+        media_type="application/gzip" if gzip else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@router.post("/import", dependencies=[Depends(require_admin)])
+async def import_chats(request: Request):
+    """
+    Admin only (X-Admin-Token). Import an export file sent as the raw request body (gzip via Content-Encoding: gzip or Content-Type:
+    application/gzip). Already existing chats/messages are skipped, so a failed import can simply be re-sent.
+    """
+    gzipped = (
+        request.headers.get("content-encoding", "").lower() == "gzip"
+        or request.headers.get("content-type", "").split(";")[0].strip() in ("application/gzip", "application/x-gzip")
+    )
+    try:
+        return await import_ndjson(request.stream(), gzipped=gzipped)
+    except ChatImportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
@@ -1,18 +1,51 @@
 """Shared FastAPI dependencies."""
+import hmac
 from typing import AsyncGenerator
 
-from fastapi import Depends, Header, HTTPException
+from fastapi import Depends, Header, HTTPException, Request
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.auth.jwt_handler import decode_token
-from app.storage.db import get_session
+from app.config import get_settings
+from app.storage.consistency import is_pinned, mark_written
+from app.storage.db import get_read_session, get_session, session_wrote
 from app.storage.models import AccountModel
 from app.storage.repositories import account_get
 
 
-async def get_db() -> AsyncGenerator[AsyncSession, None]:
+def consistency_keys(request: Request) -> list[str]:
+    """
+    Who must see this request's writes: Bearer account, ids in the path (chat_id, ticket_id, …), channel user
+    from the query, plus anything an endpoint added to request.state.consistency_keys (e.g. a fresh login).
+    """
+    keys = list(getattr(request.state, "consistency_keys", ()))
+    authorization = request.headers.get("Authorization")
+    if authorization and authorization.startswith("Bearer "):
+        payload = decode_token(authorization[7:].strip())
+        if payload and "sub" in payload:
+            keys.append(f"account:{payload['sub']}")
+    for name, value in request.path_params.items():
+        if name.endswith("_id"):
+            keys.append(f"{name}:{value}")
+    channel, external_id = request.query_params.get("channel"), request.query_params.get("externalId")
+    if channel and external_id:
+        keys.append(f"user:{channel}:{external_id}")
+    return keys
+
+
+async def get_db(request: Request) -> AsyncGenerator[AsyncSession, None]:
     async with get_session() as session:
         yield session
+    # Закоммичено: следующие чтения этого клиента идут на primary, пока реплика догоняет (если что-то записали)
+    if session_wrote(session):
+        await mark_written(consistency_keys(request))
+
+
+async def get_read_db(request: Request) -> AsyncGenerator[AsyncSession, None]:
+    """Read-only session, no commit. Uses the replica (DATABASE_READ_URL) unless this client has just written."""
+    use_primary = await is_pinned(consistency_keys(request))
+    async with get_read_session(use_primary=use_primary) as session:
+        yield session
 
 
 async def get_current_account(
@@ -31,11 +64,7 @@ async def get_current_account(
     return account
 
 
-async def get_optional_account(
-    authorization: str | None = Header(None, alias="Authorization"),
-    session: AsyncSession = Depends(get_db),
-) -> AccountModel | None:
-    """Return account if valid JWT present, else None."""
+async def _optional_account(authorization: str | None, session: AsyncSession) -> AccountModel | None:
     if not authorization or not authorization.startswith("Bearer "):
         return None
     token = authorization[7:].strip()
@@ -43,3 +72,30 @@ async def get_optional_account(
     if not payload or "sub" not in payload:
         return None
     return await account_get(session, payload["sub"])
+
+
+async def get_optional_account(
+    authorization: str | None = Header(None, alias="Authorization"),
+    session: AsyncSession = Depends(get_read_db),
+) -> AccountModel | None:
+    """Return account if valid JWT present, else None. For read endpoints: shares their get_read_db session."""
+    return await _optional_account(authorization, session)
+
+
+async def get_optional_write_account(
+    authorization: str | None = Header(None, alias="Authorization"),
+    session: AsyncSession = Depends(get_db),
+) -> AccountModel | None:
+    """get_optional_account for endpoints on get_db: reads the account in the request's write session."""
+    return await _optional_account(authorization, session)
+
+
+def is_admin(x_admin_token: str | None = Header(None, alias="X-Admin-Token")) -> bool:
+    """True if X-Admin-Token matches ADMIN_TOKEN (never when ADMIN_TOKEN is unset)."""
+    expected = get_settings().admin_token
+    return bool(expected and x_admin_token and hmac.compare_digest(x_admin_token, expected))
+
+
+def require_admin(admin: bool = Depends(is_admin)) -> None:
+    if not admin:
+        raise HTTPException(status_code=403, detail="Admin token required")
@@ -1,10 +1,12 @@
 """LLM abstraction and registry — add any provider by implementing LLMProvider and registering it."""
-from app.llm.base import LLMProvider, ChatMessage, LLMResponse
+from app.llm.base import LLMProvider, ChatMessage, CompactMessage, LLMResponse, MessageLog
 from app.llm.registry import get_llm_registry, llm_registry
 
 __all__ = [
     "LLMProvider",
     "ChatMessage",
+    "CompactMessage",
+    "MessageLog",
     "LLMResponse",
     "get_llm_registry",
     "llm_registry",
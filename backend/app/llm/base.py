@@ -1,7 +1,8 @@
 """Base interface for any LLM provider — implement this to add a new model/provider."""
 from abc import ABC, abstractmethod
-from typing import Any, AsyncIterator
+from typing import Any, AsyncIterator, Iterable, Iterator
 
+import orjson
 from pydantic import BaseModel, Field
 
 
@@ -12,6 +13,69 @@ class ChatMessage(BaseModel):
     tool_call_id: str | None = None  # for role="tool"
 
 
+class CompactMessage:
+    """
+    ChatMessage for the reply hot path: slotted, no validation, converts straight to the OpenAI-style wire dict.
+    Same attributes as ChatMessage, so providers reading m.role / m.content accept either.
+    """
+
+    __slots__ = ("role", "content", "tool_calls", "tool_call_id")
+
+    def __init__(
+        self,
+        role: str,
+        content: str | None = "",
+        tool_calls: list[dict[str, Any]] | None = None,
+        tool_call_id: str | None = None,
+    ) -> None:
+        self.role = role
+        self.content = content
+        self.tool_calls = tool_calls
+        self.tool_call_id = tool_call_id
+
+    def to_api(self) -> dict[str, Any]:
+        """API message format (supports tool_calls and the tool role)."""
+        if self.role == "tool":
+            if self.tool_call_id:
+                return {"role": "tool", "content": self.content or "", "tool_call_id": self.tool_call_id}
+            return {"role": "tool", "content": self.content or ""}
+        if self.tool_calls:
+            return {"role": self.role, "content": self.content or None, "tool_calls": self.tool_calls}
+        return {"role": self.role, "content": self.content or ""}
+
+
+class MessageLog:
+    """
+    Messages of one reply turn together with their wire JSON. Each message is encoded once, when it is added, so
+    tool rounds re-send the already serialized history instead of rebuilding and re-encoding it.
+    """
+
+    __slots__ = ("messages", "_wire")
+
+    def __init__(self, messages: Iterable[CompactMessage] = ()) -> None:
+        self.messages = list(messages)
+        # ",{...},{...}": каждое сообщение с ведущей запятой, чтобы дописывать без перекодирования
+        self._wire = bytearray()
+        if self.messages:
+            self._wire += b"," + orjson.dumps([m.to_api() for m in self.messages])[1:-1]
+
+    def append(self, message: CompactMessage) -> None:
+        self.messages.append(message)
+        self._wire += b"," + orjson.dumps(message.to_api())
+
+    def __iter__(self) -> Iterator[CompactMessage]:
+        return iter(self.messages)
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def to_json(self, system_prompt: str | None = None) -> bytes:
+        """JSON array of the messages, optionally preceded by a system message."""
+        if system_prompt:
+            return b"[" + orjson.dumps({"role": "system", "content": system_prompt}) + self._wire + b"]"
+        return b"[" + self._wire[1:] + b"]"
+
+
 class LLMResponse(BaseModel):
     content: str
     model_used: str
@@ -28,7 +92,7 @@ class LLMProvider(ABC):
     @abstractmethod
     async def chat(
         self,
-        messages: list[ChatMessage],
+        messages: list[ChatMessage] | MessageLog,
         model_id: str,
         *,
         system_prompt: str | None = None,
@@ -36,7 +100,10 @@ class LLMProvider(ABC):
         max_tokens: int = 4096,
         tools: list[dict[str, Any]] | None = None,
     ) -> LLMResponse:
-        """Send chat completion request. model_id is provider-specific. tools = OpenRouter-style tool definitions."""
+        """
+        Send chat completion request. model_id is provider-specific. tools = OpenRouter-style tool definitions.
+        messages is a MessageLog on the reply path (use its to_json() for the request body when the wire format fits).
+        """
         ...
 
     @abstractmethod
@@ -5,26 +5,18 @@ import os
 from typing import Any, AsyncIterator
 
 import httpx
+import orjson
 
-from app.llm.base import ChatMessage, LLMProvider, LLMResponse
+from app.llm.base import ChatMessage, CompactMessage, LLMProvider, LLMResponse, MessageLog
 
 logger = logging.getLogger(__name__)
 
 
-def _message_to_api(m: ChatMessage) -> dict[str, Any]:
-    """Convert ChatMessage to OpenRouter API message format (supports tool_calls and tool role)."""
-    out: dict[str, Any] = {"role": m.role}
-    if m.role == "tool":
-        out["content"] = m.content or ""
-        if m.tool_call_id:
-            out["tool_call_id"] = m.tool_call_id
-        return out
-    if m.tool_calls:
-        out["content"] = m.content if m.content else None
-        out["tool_calls"] = m.tool_calls
-        return out
-    out["content"] = m.content or ""
-    return out
+def _request_body(body: dict, messages: list[ChatMessage] | MessageLog, system_prompt: str | None) -> bytes:
+    """Request JSON via orjson; a MessageLog's history goes in already serialized."""
+    if not isinstance(messages, MessageLog):
+        messages = MessageLog(CompactMessage(m.role, m.content, m.tool_calls, m.tool_call_id) for m in messages)
+    return orjson.dumps(body)[:-1] + b',"messages":' + messages.to_json(system_prompt) + b"}"
 
 
 class OpenRouterProvider(LLMProvider):
@@ -40,7 +32,7 @@ class OpenRouterProvider(LLMProvider):
 
     async def chat(
         self,
-        messages: list[ChatMessage],
+        messages: list[ChatMessage] | MessageLog,
         model_id: str,
         *,
         system_prompt: str | None = None,
@@ -57,12 +49,9 @@ class OpenRouterProvider(LLMProvider):
         openrouter_model = model_id if model_id.startswith("openrouter/") or "/" in model_id else f"openrouter/{model_id}"
         body: dict = {
             "model": openrouter_model,
-            "messages": [_message_to_api(m) for m in messages],
             "temperature": temperature,
             "max_tokens": max_tokens,
         }
-        if system_prompt:
-            body["messages"] = [{"role": "system", "content": system_prompt}] + body["messages"]
         if tools:
             body["tools"] = tools
             body["tool_choice"] = "auto"
@@ -75,7 +64,7 @@ class OpenRouterProvider(LLMProvider):
                     "Content-Type": "application/json",
                     "HTTP-Referer": self._base_url,
                 },
-                json=body,
+                content=_request_body(body, messages, system_prompt),
             )
             if r.status_code >= 400:
                 try:
@@ -104,7 +93,7 @@ class OpenRouterProvider(LLMProvider):
                         finish_reason="error",
                     )
                 r.raise_for_status()
-            data = r.json()
+            data = orjson.loads(r.content)
         choices = data.get("choices") or []
         if not choices:
             return LLMResponse(content="", model_used=openrouter_model, finish_reason="unknown")
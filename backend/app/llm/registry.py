@@ -2,6 +2,7 @@
 from typing import Optional
 
 from app.llm.base import LLMProvider
+from app.llm.routing import RoutedProvider, Target
 
 
 class LLMRegistry:
@@ -17,6 +18,17 @@ class LLMRegistry:
         return self._providers.get(provider_id)
 
     def get_provider_for_model(self, model_id: str) -> Optional[tuple[str, LLMProvider]]:
+        """
+        Resolve model_id to its provider, wrapped in the routing policies (app/llm/routing.py): fallback chain,
+        hedged requests, circuit breakers. The provider id is that of model_id itself.
+        """
+        resolved = self._resolve(model_id)
+        if not resolved:
+            return None
+        provider_id, provider = resolved
+        return provider_id, RoutedProvider(self._resolve, Target(provider_id, provider, model_id))
+
+    def _resolve(self, model_id: str) -> Optional[tuple[str, LLMProvider]]:
         """
         Resolve model_id to a provider. By default we use 'openrouter' for OpenRouter models.
         Custom logic: model_id can be 'openrouter/<path>' or '<provider_id>/<model>' for future providers.
@@ -0,0 +1,149 @@
+"""
+Response cache for deterministic utility LLM calls (classification and similar prompts at temperature 0):
+an in-process LRU in front of a Redis tier shared by all workers. The key is the namespace, the prompt version
+and a hash of the request (provider, model, messages, tools, params); bump the prompt version when the prompt's
+meaning or the parsing of its answer changes. Hit rate per namespace is exported by GET /metrics.
+
+Caching is opt-in by decorating a call site's chat function; a decorated call opts out with cache=False.
+Conversational replies (chat_service.generate_reply) are never cached.
+"""
+import functools
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+
+from app.config import get_settings
+from app.llm.base import ChatMessage, LLMProvider, LLMResponse, MessageLog
+from app.llm.single_flight import request_key
+from app.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+_KEY_PREFIX = "llm:cache:"
+
+ChatCall = Callable[..., Awaitable[LLMResponse]]
+
+
+class CacheStats:
+    def __init__(self) -> None:
+        self.memory_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+
+_stats: dict[str, CacheStats] = {}
+# key -> (expires_at monotonic, response)
+_lru: "OrderedDict[str, tuple[float, LLMResponse]]" = OrderedDict()
+
+
+def _lru_get(key: str) -> Optional[LLMResponse]:
+    entry = _lru.get(key)
+    if entry is None:
+        return None
+    if entry[0] <= time.monotonic():
+        del _lru[key]
+        return None
+    _lru.move_to_end(key)
+    return entry[1]
+
+
+def _lru_put(key: str, response: LLMResponse, ttl: float) -> None:
+    _lru[key] = (time.monotonic() + ttl, response)
+    _lru.move_to_end(key)
+    while len(_lru) > get_settings().llm_response_cache_size:
+        _lru.popitem(last=False)
+
+
+def _cacheable(response: LLMResponse) -> bool:
+    # Ошибки провайдера и запросы инструментов не кэшируем: повтор должен сходить к модели
+    return bool(response.content) and not response.tool_calls and response.finish_reason not in ("error", "unknown")
+
+
+def response_cache(
+    namespace: str, prompt_version: str, ttl_seconds: Optional[float] = None
+) -> Callable[[ChatCall], ChatCall]:
+    """
+    Decorate an `async (provider, *, messages, model_id, **params) -> LLMResponse` chat call (provider.chat
+    wrapped by a call site, or chat_single_flight) with the response cache. TTL defaults to
+    LLM_RESPONSE_CACHE_TTL_SECONDS.
+    """
+    stats = _stats.setdefault(namespace, CacheStats())
+
+    def decorate(chat: ChatCall) -> ChatCall:
+        @functools.wraps(chat)
+        async def cached(
+            provider: LLMProvider,
+            *,
+            messages: list[ChatMessage] | MessageLog,
+            model_id: str,
+            cache: bool = True,
+            **params: Any,
+        ) -> LLMResponse:
+            if not cache:
+                stats.bypassed += 1
+                return await chat(provider, messages=messages, model_id=model_id, **params)
+            ttl = ttl_seconds or get_settings().llm_response_cache_ttl_seconds
+            key = f"{_KEY_PREFIX}{namespace}:{prompt_version}:" + request_key(
+                provider.provider_id, model_id, messages, params
+            )
+            response = _lru_get(key)
+            if response is not None:
+                stats.memory_hits += 1
+                return response
+            redis = get_redis()
+            if redis:
+                try:
+                    value = await redis.get(key)
+                except Exception as e:
+                    logger.warning("LLM response cache read failed: %s", e)
+                    value = None
+                if value is not None:
+                    stats.redis_hits += 1
+                    response = LLMResponse.model_validate_json(value)
+                    _lru_put(key, response, ttl)
+                    return response
+            stats.misses += 1
+            response = await chat(provider, messages=messages, model_id=model_id, **params)
+            if _cacheable(response):
+                _lru_put(key, response, ttl)
+                if redis:
+                    try:
+                        await redis.set(key, response.model_dump_json(), px=int(ttl * 1000))
+                    except Exception as e:
+                        logger.warning("LLM response cache write failed: %s", e)
+            return response
+
+        return cached
+
+    return decorate
+
+
+def render_prometheus() -> str:
+    lines = [
+        "# HELP agiens_llm_response_cache_requests_total Utility LLM calls by cache outcome",
+        "# TYPE agiens_llm_response_cache_requests_total counter",
+    ]
+    for name, s in _stats.items():
+        for result, n in (
+            ("memory_hit", s.memory_hits),
+            ("redis_hit", s.redis_hits),
+            ("miss", s.misses),
+            ("bypass", s.bypassed),
+        ):
+            lines.append(f'agiens_llm_response_cache_requests_total{{namespace="{name}",result="{result}"}} {n}')
+    lines += [
+        "# HELP agiens_llm_response_cache_hit_ratio (memory + redis hits) / cached lookups",
+        "# TYPE agiens_llm_response_cache_hit_ratio gauge",
+    ]
+    for name, s in _stats.items():
+        hits = s.memory_hits + s.redis_hits
+        total = hits + s.misses
+        lines.append(f'agiens_llm_response_cache_hit_ratio{{namespace="{name}"}} {hits / total if total else 0.0:.4f}')
+    lines += [
+        "# HELP agiens_llm_response_cache_entries Responses in the in-process LRU",
+        "# TYPE agiens_llm_response_cache_entries gauge",
+        f"agiens_llm_response_cache_entries {len(_lru)}",
+    ]
+    return "\n".join(lines) + "\n"
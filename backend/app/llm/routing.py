@@ -0,0 +1,249 @@
+"""
+Routing policies for LLM calls (LLMRegistry.get_provider_for_model returns a RoutedProvider):
+- fallback chains per model (LLM_FALLBACKS): an error (exception, or the provider's 429/500 error response)
+  moves on to the next model instead of ending up as an apology in the chat;
+- hedging: if the first request is slower than the p95 latency of its provider/model, a second one goes to the
+  next model of the chain (never to the same one, so a chain without fallbacks is not hedged); the first good
+  response wins and the other request is cancelled;
+- circuit breakers per provider/model: LLM_BREAKER_FAILURES consecutive failures skip it for
+  LLM_BREAKER_COOLDOWN_SECONDS, then one request goes through as a trial (the others keep skipping it for another
+  cooldown): success closes it, failure reopens it. When every model of the chain is skipped, the call returns an
+  error response at once (finish_reason="error") instead of waiting on models known to be failing.
+State is per process. stream() is not routed.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from functools import lru_cache
+from typing import Any, AsyncIterator, Callable, NamedTuple, Optional
+
+from app.config import get_settings
+from app.llm.base import ChatMessage, LLMProvider, LLMResponse, MessageLog
+
+logger = logging.getLogger(__name__)
+
+# p95 считаем по последним N успешным ответам; меньше MIN_SAMPLES — задержка хеджа = максимальная
+LATENCY_WINDOW = 200
+MIN_SAMPLES = 20
+UNAVAILABLE_REPLY = "Сервис LLM временно недоступен. Попробуйте через минуту или выберите другую модель."
+
+
+class Target(NamedTuple):
+    provider_id: str
+    provider: LLMProvider
+    model_id: str
+
+
+class _Health:
+    """Latency window and circuit breaker of one provider/model."""
+
+    def __init__(self) -> None:
+        self.latencies: deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.failures = 0
+        self.open_until = 0.0
+
+    def allows(self) -> bool:
+        if not self.is_open():
+            return True
+        now = time.monotonic()
+        if now < self.open_until:
+            return False
+        # Пауза прошла: пропускаем один пробный запрос, остальные ждут ещё одну паузу (успех закроет, ошибка откроет)
+        self.open_until = now + get_settings().llm_breaker_cooldown_seconds
+        return True
+
+    def success(self, seconds: float) -> None:
+        self.failures = 0
+        self.latencies.append(seconds)
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.failures >= get_settings().llm_breaker_failures:
+            self.open_until = time.monotonic() + get_settings().llm_breaker_cooldown_seconds
+
+    def is_open(self) -> bool:
+        return self.failures >= get_settings().llm_breaker_failures
+
+    def hedge_delay(self) -> float:
+        settings = get_settings()
+        if len(self.latencies) < MIN_SAMPLES:
+            return settings.llm_hedge_max_delay_seconds
+        ordered = sorted(self.latencies)
+        p95 = ordered[int(0.95 * (len(ordered) - 1))]
+        return min(max(p95, settings.llm_hedge_min_delay_seconds), settings.llm_hedge_max_delay_seconds)
+
+
+_health: dict[tuple[str, str], _Health] = {}
+_counters = {"hedged": 0, "hedge_won": 0, "failover": 0, "rejected": 0}
+
+
+def _health_of(target: Target) -> _Health:
+    key = (target.provider_id, target.model_id)
+    if key not in _health:
+        _health[key] = _Health()
+    return _health[key]
+
+
+@lru_cache
+def _parse_fallbacks(raw: Optional[str]) -> dict[str, list[str]]:
+    """"model=fallback|fallback,model2=…" ("*" = any model) -> {model: [fallbacks]}."""
+    chains: dict[str, list[str]] = {}
+    for item in (raw or "").split(","):
+        if "=" not in item:
+            continue
+        model, fallbacks = item.split("=", 1)
+        chains[model.strip()] = [f.strip() for f in fallbacks.split("|") if f.strip()]
+    return chains
+
+
+def fallback_models(model_id: str) -> list[str]:
+    """model_id followed by its fallbacks, then the "*" chain, without repeats."""
+    chains = _parse_fallbacks(get_settings().llm_fallbacks)
+    models = [model_id, *chains.get(model_id, []), *chains.get("*", [])]
+    return list(dict.fromkeys(models))
+
+
+def _failed(response: LLMResponse) -> bool:
+    # OpenRouterProvider отдаёт 429/500/401 как ответ с finish_reason="error" (текст-извинение для пользователя)
+    return response.finish_reason == "error"
+
+
+async def _attempt(target: Target, messages, kwargs: dict) -> LLMResponse:
+    health = _health_of(target)
+    started = time.monotonic()
+    try:
+        response = await target.provider.chat(messages=messages, model_id=target.model_id, **kwargs)
+    except Exception:
+        health.failure()
+        raise
+    if _failed(response):
+        health.failure()
+    else:
+        health.success(time.monotonic() - started)
+    return response
+
+
+class RoutedProvider(LLMProvider):
+    """LLMProvider over a model's fallback chain with hedging and circuit breakers (see module docstring)."""
+
+    def __init__(self, resolve: Callable[[str], Optional[tuple[str, LLMProvider]]], primary: Target) -> None:
+        self._resolve = resolve
+        self._primary = primary
+        self.provider_id = primary.provider_id
+        self.display_name = primary.provider.display_name
+
+    def is_available(self) -> bool:
+        return self._primary.provider.is_available()
+
+    def _chain(self, model_id: str) -> list[Target]:
+        targets = []
+        for model in fallback_models(model_id):
+            resolved = self._resolve(model)
+            if resolved:
+                targets.append(Target(resolved[0], resolved[1], model))
+        return targets
+
+    async def chat(
+        self,
+        messages: list[ChatMessage] | MessageLog,
+        model_id: str,
+        **kwargs: Any,
+    ) -> LLMResponse:
+        chain = self._chain(model_id)
+        remaining = list(chain)
+        settings = get_settings()
+        pending: dict[asyncio.Task, Target] = {}
+        hedge = None  # задача хеджа, пока он не запущен — None
+        last_error: LLMResponse | Exception | None = None
+
+        def next_target() -> Optional[Target]:
+            # Выключатель спрашиваем только у модели, которую сейчас запустим: allows() может выдать пробный запрос
+            while remaining:
+                target = remaining.pop(0)
+                if _health_of(target).allows():
+                    return target
+            return None
+
+        def launch(target: Target) -> asyncio.Task:
+            task = asyncio.create_task(_attempt(target, messages, kwargs))
+            pending[task] = target
+            return task
+
+        first = next_target()
+        if first is None:
+            # Все выключатели открыты: отвечаем сразу, не дожидаясь заведомых отказов; пробный запрос пропустит allows()
+            _counters["rejected"] += 1
+            return LLMResponse(content=UNAVAILABLE_REPLY, model_used=model_id, finish_reason="error")
+        launch(first)
+        try:
+            while pending:
+                timeout = None
+                if settings.llm_hedge_enabled and hedge is None and len(pending) == 1 and remaining:
+                    timeout = _health_of(next(iter(pending.values()))).hedge_delay()
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Медленнее p95: второй запрос к следующей модели цепочки (к той же — нет, это удвоит нагрузку)
+                    target = next_target()
+                    if target is None:
+                        hedge = False  # хеджировать некуда, просто ждём первый запрос
+                        continue
+                    hedge = launch(target)
+                    _counters["hedged"] += 1
+                    continue
+                for task in done:
+                    target = pending.pop(task)
+                    if task.exception() is not None:
+                        last_error = task.exception()
+                        logger.warning("LLM %s via %s failed: %s", target.model_id, target.provider_id, last_error)
+                        continue
+                    response = task.result()
+                    if _failed(response):
+                        last_error = response
+                        logger.warning("LLM %s via %s error response: %s", target.model_id, target.provider_id,
+                                       response.content[:200])
+                        continue
+                    if task is hedge:
+                        _counters["hedge_won"] += 1
+                    return response
+                if not pending:
+                    target = next_target()
+                    if target is not None:
+                        _counters["failover"] += 1
+                        launch(target)
+        finally:
+            # Проигравший запрос отменяем (httpx закрывает соединение)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+        if isinstance(last_error, Exception):
+            raise last_error
+        return last_error
+
+    async def stream(
+        self,
+        messages: list[ChatMessage],
+        model_id: str,
+        **kwargs: Any,
+    ) -> AsyncIterator[str]:
+        async for chunk in self._primary.provider.stream(messages, model_id, **kwargs):
+            yield chunk
+
+
+def render_prometheus() -> str:
+    lines = [
+        "# HELP agiens_llm_routing_total Hedged requests, hedges that won, failovers, calls rejected by open breakers",
+        "# TYPE agiens_llm_routing_total counter",
+    ]
+    for event, n in _counters.items():
+        lines.append(f'agiens_llm_routing_total{{event="{event}"}} {n}')
+    lines += [
+        "# HELP agiens_llm_breaker_open Circuit breaker of a provider/model is open (1) or closed (0)",
+        "# TYPE agiens_llm_breaker_open gauge",
+    ]
+    for (provider_id, model_id), health in _health.items():
+        lines.append(
+            f'agiens_llm_breaker_open{{provider="{provider_id}",model="{model_id}"}} {int(health.is_open())}'
+        )
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,112 @@
+"""
+Single-flight for deterministic LLM calls (classification and other utility prompts): identical requests in flight
+at the same time share one provider call. Inside a process callers await one task; across workers the first one
+takes a Redis lock and the others wait for the result it publishes. Opt-in per call site: conversational replies
+call provider.chat directly, their answers are not interchangeable.
+"""
+import asyncio
+import hashlib
+import logging
+import time
+from typing import Any, Awaitable, Callable
+
+import orjson
+
+from app.llm.base import ChatMessage, CompactMessage, LLMProvider, LLMResponse, MessageLog
+from app.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+_LOCK_PREFIX = "llm:sf:lock:"
+_RESULT_PREFIX = "llm:sf:result:"
+# Дольше таймаута запроса к провайдеру (120 с): пока лидер жив, его замок не истекает
+LEADER_TTL_SECONDS = 150.0
+# Результат живёт недолго — только чтобы ждущие воркеры успели его забрать; это не кэш
+RESULT_TTL_SECONDS = 15.0
+POLL_SECONDS = 0.1
+
+_inflight: dict[str, asyncio.Task] = {}
+
+
+def _wire(m: ChatMessage | CompactMessage) -> dict[str, Any]:
+    if isinstance(m, CompactMessage):
+        return m.to_api()
+    return CompactMessage(m.role, m.content, m.tool_calls, m.tool_call_id).to_api()
+
+
+def request_key(provider_id: str, model_id: str, messages: list[ChatMessage] | MessageLog, params: dict) -> str:
+    """Canonical hash of a chat request: provider, model, messages (wire format), tools and sampling params."""
+    payload = {"provider": provider_id, "model": model_id, "messages": [_wire(m) for m in messages], "params": params}
+    return hashlib.sha256(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+async def _across_workers(key: str, call: Callable[[], Awaitable[LLMResponse]]) -> LLMResponse:
+    redis = get_redis()
+    if not redis:
+        return await call()
+    lock, result_key = _LOCK_PREFIX + key, _RESULT_PREFIX + key
+    for _ in range(3):
+        try:
+            leader = await redis.set(lock, "1", nx=True, px=int(LEADER_TTL_SECONDS * 1000))
+        except Exception as e:
+            logger.warning("LLM single-flight lock failed, calling the provider directly: %s", e)
+            return await call()
+        if leader:
+            try:
+                response = await call()
+            except BaseException:
+                try:
+                    await redis.delete(lock)
+                except Exception as e:
+                    logger.warning("LLM single-flight unlock failed: %s", e)
+                raise
+            try:
+                async with redis.pipeline(transaction=True) as pipe:
+                    pipe.set(result_key, response.model_dump_json(), px=int(RESULT_TTL_SECONDS * 1000))
+                    pipe.delete(lock)
+                    await pipe.execute()
+            except Exception as e:
+                logger.warning("LLM single-flight result publish failed: %s", e)
+            return response
+        deadline = time.monotonic() + LEADER_TTL_SECONDS
+        while time.monotonic() < deadline:
+            await asyncio.sleep(POLL_SECONDS)
+            try:
+                async with redis.pipeline(transaction=False) as pipe:
+                    pipe.get(result_key)
+                    pipe.exists(lock)
+                    result, locked = await pipe.execute()
+            except Exception as e:
+                logger.warning("LLM single-flight poll failed, calling the provider directly: %s", e)
+                return await call()
+            if result is not None:
+                return LLMResponse.model_validate_json(result)
+            if not locked:
+                break  # лидер упал, не опубликовав результат — пробуем стать лидером сами
+    return await call()
+
+
+async def chat_single_flight(
+    provider: LLMProvider,
+    *,
+    messages: list[ChatMessage] | MessageLog,
+    model_id: str,
+    **params: Any,
+) -> LLMResponse:
+    """provider.chat(...) shared with every identical request in flight (same process or, via Redis, any worker)."""
+    key = request_key(provider.provider_id, model_id, messages, params)
+    task = _inflight.get(key)
+    if task is None:
+        call = lambda: provider.chat(messages=messages, model_id=model_id, **params)  # noqa: E731
+        task = asyncio.create_task(_across_workers(key, call))
+        _inflight[key] = task
+        task.add_done_callback(lambda t: _done(key, t))
+    # shield: отмена одного из ожидающих не отменяет общий вызов для остальных
+    return await asyncio.shield(task)
+
+
+def _done(key: str, task: asyncio.Task) -> None:
+    if _inflight.get(key) is task:
+        del _inflight[key]
+    if not task.cancelled():
+        task.exception()  # все ожидающие могли уйти: исключение считается полученным, без "never retrieved"
@@ -5,14 +5,16 @@ from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.requests import Request
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, PlainTextResponse
 
-from app.api import accounts, agents, auth, chats, tickets, voice_temp
+from app.api import accounts, agents, auth, chats, search, tickets, transfer, voice_temp
 from app.config import get_settings
 from app.llm.openrouter import OpenRouterProvider
 from app.llm.registry import llm_registry
 from app.redis_client import close_redis, init_redis
 from app.storage.db import close_db, init_db
+from app.services.idempotency import IdempotencyError
+from app.storage.sharding import ShardMovingError
 
 logger = logging.getLogger(__name__)
 
@@ -59,6 +61,17 @@ app.add_middleware(
 )
 
 
+@app.exception_handler(ShardMovingError)
+async def shard_moving_handler(request: Request, exc: ShardMovingError):
+    """The chat's bucket is being moved to another shard: writes resume in a few seconds."""
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "5"})
+
+
+@app.exception_handler(IdempotencyError)
+async def idempotency_handler(request: Request, exc: IdempotencyError):
+    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail})
+
+
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     """Return 500 as JSON so CORS middleware adds headers; let HTTPException through."""
@@ -75,10 +88,21 @@ app.include_router(auth.router)
 app.include_router(accounts.router)
 app.include_router(agents.router)
 app.include_router(chats.router)
+app.include_router(search.router)
 app.include_router(tickets.router)
+app.include_router(transfer.router)
 app.include_router(voice_temp.router)
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Prometheus text format: DB pool checkout wait, timeouts, saturation; LLM response cache and routing."""
+    from app.llm.response_cache import render_prometheus as render_llm_cache
+    from app.llm.routing import render_prometheus as render_llm_routing
+    from app.storage.pool_metrics import render_prometheus
+    return render_prometheus() + render_llm_cache() + render_llm_routing()
+
+
 @app.get("/health")
 def health():
     from app.mcp.playwright_client import is_playwright_mcp_available
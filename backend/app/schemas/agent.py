@@ -12,6 +12,7 @@ class AgentOut(BaseModel):
     systemPrompt: str
     modelId: Optional[str] = None
     supportedCategories: Optional[str] = None  # Comma-separated, for ticket routing
+    answerCache: bool = False  # Reuse answers to near-duplicate first messages (agents without tools)
 
 
 class AgentCreateIn(BaseModel):
@@ -20,6 +21,7 @@ class AgentCreateIn(BaseModel):
     systemPrompt: str = ""
     icon: Optional[str] = None
     supportedCategories: Optional[str] = None
+    answerCache: bool = False
 
 
 class AgentUpdateIn(BaseModel):
@@ -29,3 +31,4 @@ class AgentUpdateIn(BaseModel):
     systemPrompt: Optional[str] = None
     modelId: Optional[str] = None
     supportedCategories: Optional[str] = None
+    answerCache: Optional[bool] = None
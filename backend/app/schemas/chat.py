@@ -10,6 +10,8 @@ class MessageOut(BaseModel):
     role: str
     content: str
     createdAt: str  # ISO datetime
+    seq: int  # per-chat, monotonic: cursor for since_seq / before_seq
+    provenance: Optional[str] = None  # set when the reply did not come from the LLM, e.g. "answer_cache:…"
 
     class Config:
         from_attributes = True
@@ -29,6 +31,7 @@ class ChatWithMessagesOut(BaseModel):
     modelId: str
     agentId: Optional[str] = None
     messages: list[MessageOut]
+    hasMore: bool = False  # with limit: more messages beyond this page (newer for since_seq, older otherwise)
 
 
 class SendMessageIn(BaseModel):
@@ -40,6 +43,7 @@ class SendMessageIn(BaseModel):
 class SendMessageOut(BaseModel):
     content: str
     audioBase64: Optional[str] = None  # Present when withVoice=True (ElevenLabs TTS)
+    parts: Optional[list[str]] = None  # content split into channel-sized messages (bots send them in order)
 
 
 class SetModelIn(BaseModel):
@@ -54,3 +58,19 @@ class CreateChatIn(BaseModel):
     modelId: Optional[str] = None
     channel: Optional[str] = None  # telegram, whatsapp
     externalId: Optional[str] = None  # telegram chat_id, whatsapp number
+
+
+class MessageSearchHitOut(BaseModel):
+    id: str
+    chatId: str
+    chatTitle: str
+    role: str
+    createdAt: str  # ISO datetime
+    seq: int  # open the chat around this message: GET /api/chats/{chatId}?before_seq=seq+1
+    rank: float
+    snippet: str  # matched fragments as HTML: message text escaped, terms wrapped in <mark></mark>
+
+
+class MessageSearchOut(BaseModel):
+    hits: list[MessageSearchHitOut]
+    nextCursor: Optional[str] = None  # pass as cursor= for the next page; None on the last page
@@ -0,0 +1,213 @@
+"""
+Answer cache for first messages, opt-in per agent (agents.answer_cache). Most support chats open with a variation
+of the same dozen questions: a first message similar enough to one already answered gets the stored answer
+without an LLM call, and the reply message records where it came from (messages.provenance).
+
+Similarity: MinHash signatures over character n-grams of the normalized text, looked up through an LSH band
+index; the best candidate is used when its estimated Jaccard similarity reaches ANSWER_CACHE_THRESHOLD.
+One index per (agent, model, system prompt): a changed system prompt starts an empty index, and editing the agent
+drops its old ones. Indexes live in process memory and in Redis (one hash per index) when REDIS_URL is set;
+workers reload them from Redis every RELOAD_SECONDS.
+Only turns without tools are cached: an answer built from tool results is not reusable.
+"""
+import hashlib
+import logging
+import random
+import re
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+import orjson
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import get_settings
+from app.redis_client import get_redis
+from app.storage.db import run_after_commit
+
+logger = logging.getLogger(__name__)
+
+_KEY_PREFIX = "ans:"
+NUM_PERM = 64
+# 16 полос по 4 строки: кандидат находится с вероятностью ~0.5 при сходстве 0.5 и >0.99 при 0.8
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+NGRAM = 4
+# Длинные первые сообщения уникальны — не тратим на них CPU
+MAX_QUESTION_CHARS = 1000
+RELOAD_SECONDS = 60.0
+MAX_INDEXES = 256
+
+_PRIME = (1 << 61) - 1
+_rng = random.Random(0x616769656E73)
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERM)]
+_WORD = re.compile(r"\w+")
+
+
+class CachedAnswer(NamedTuple):
+    answer: str
+    provenance: str
+
+
+def normalize(text: str) -> str:
+    """Lowercase words separated by single spaces: case, punctuation and spacing do not matter."""
+    return " ".join(_WORD.findall(text.lower()))
+
+
+def signature(text: str) -> Optional[tuple[int, ...]]:
+    """MinHash of the text's character n-grams (None for empty or too long text)."""
+    norm = normalize(text)
+    if not norm or len(norm) > MAX_QUESTION_CHARS:
+        return None
+    grams = {norm[i:i + NGRAM] for i in range(max(len(norm) - NGRAM + 1, 1))}
+    hashes = [int.from_bytes(hashlib.blake2b(g.encode(), digest_size=8).digest(), "little") for g in grams]
+    return tuple(min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS)
+
+
+def similarity(a: tuple[int, ...], b: tuple[int, ...]) -> float:
+    """Estimated Jaccard similarity of the n-gram sets."""
+    return sum(x == y for x, y in zip(a, b)) / NUM_PERM
+
+
+def _bands(sig: tuple[int, ...]) -> list[tuple]:
+    return [(i, sig[i * ROWS:(i + 1) * ROWS]) for i in range(BANDS)]
+
+
+class _Index:
+    def __init__(self) -> None:
+        # entry_id -> (signature, answer), по порядку добавления: первый — самый старый
+        self.entries: dict[str, tuple[tuple[int, ...], str]] = {}
+        self.buckets: dict[tuple, set[str]] = {}
+        self.loaded_at = 0.0
+
+    def add(self, entry_id: str, sig: tuple[int, ...], answer: str) -> list[str]:
+        """Add an entry; returns ids evicted to stay within ANSWER_CACHE_MAX_ENTRIES."""
+        if entry_id in self.entries:
+            return []
+        self.entries[entry_id] = (sig, answer)
+        for band in _bands(sig):
+            self.buckets.setdefault(band, set()).add(entry_id)
+        evicted = []
+        while len(self.entries) > get_settings().answer_cache_max_entries:
+            old_id = next(iter(self.entries))
+            self._remove(old_id)
+            evicted.append(old_id)
+        return evicted
+
+    def _remove(self, entry_id: str) -> None:
+        sig, _ = self.entries.pop(entry_id)
+        for band in _bands(sig):
+            ids = self.buckets.get(band)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del self.buckets[band]
+
+    def best(self, sig: tuple[int, ...]) -> Optional[tuple[str, str, float]]:
+        candidates = set()
+        for band in _bands(sig):
+            candidates |= self.buckets.get(band, set())
+        best = None
+        for entry_id in candidates:
+            stored, answer = self.entries[entry_id]
+            score = similarity(sig, stored)
+            if best is None or score > best[2]:
+                best = (entry_id, answer, score)
+        return best
+
+
+_indexes: "OrderedDict[str, _Index]" = OrderedDict()
+
+
+def _namespace(agent_id: str, model_id: str, system_prompt: Optional[str]) -> str:
+    prompt_hash = hashlib.sha256((system_prompt or "").encode()).hexdigest()[:16]
+    return f"{agent_id}:{model_id}:{prompt_hash}"
+
+
+async def _index(ns: str) -> _Index:
+    index = _indexes.get(ns)
+    if index is None:
+        index = _indexes[ns] = _Index()
+        while len(_indexes) > MAX_INDEXES:
+            _indexes.popitem(last=False)
+    _indexes.move_to_end(ns)
+    redis = get_redis()
+    if not redis or time.monotonic() - index.loaded_at < RELOAD_SECONDS:
+        return index
+    index.loaded_at = time.monotonic()
+    try:
+        stored = await redis.hgetall(_KEY_PREFIX + ns)
+    except Exception as e:
+        logger.warning("Answer cache load failed for %s: %s", ns, e)
+        return index
+    # Пересобираем целиком: так до воркера доходят и чужие ответы, и инвалидация
+    fresh = _Index()
+    fresh.loaded_at = index.loaded_at
+    for entry_id, value in stored.items():
+        sig, answer = orjson.loads(value)
+        fresh.add(entry_id, tuple(sig), answer)
+    _indexes[ns] = fresh
+    return fresh
+
+
+async def lookup_answer(
+    agent_id: str, model_id: str, system_prompt: Optional[str], question: str
+) -> Optional[CachedAnswer]:
+    """Stored answer to a near-duplicate first message of this agent, or None."""
+    sig = signature(question)
+    if sig is None:
+        return None
+    best = (await _index(_namespace(agent_id, model_id, system_prompt))).best(sig)
+    if best is None or best[2] < get_settings().answer_cache_threshold:
+        return None
+    entry_id, answer, score = best
+    return CachedAnswer(answer, f"answer_cache:{entry_id}:{score:.2f}")
+
+
+async def _store(ns: str, entry_id: str, sig: tuple[int, ...], answer: str) -> None:
+    evicted = (await _index(ns)).add(entry_id, sig, answer)
+    redis = get_redis()
+    if not redis:
+        return
+    key = _KEY_PREFIX + ns
+    try:
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, entry_id, orjson.dumps([sig, answer]).decode())
+            if evicted:
+                pipe.hdel(key, *evicted)
+            pipe.expire(key, get_settings().answer_cache_ttl_seconds)
+            await pipe.execute()
+    except Exception as e:
+        logger.warning("Answer cache store failed for %s: %s", ns, e)
+
+
+def remember_answer(
+    session: AsyncSession,
+    agent_id: str,
+    model_id: str,
+    system_prompt: Optional[str],
+    question: str,
+    answer: str,
+) -> None:
+    """Store the LLM's answer to a first message once the transaction commits."""
+    sig = signature(question)
+    if sig is None or not answer:
+        return
+    ns = _namespace(agent_id, model_id, system_prompt)
+    entry_id = hashlib.sha256(normalize(question).encode()).hexdigest()[:16]
+    run_after_commit(session, lambda: _store(ns, entry_id, sig, answer))
+
+
+async def invalidate_agent_answers(agent_id: str) -> None:
+    """Drop every index of the agent (after its system prompt or cache setting changed)."""
+    for ns in [ns for ns in _indexes if ns.startswith(agent_id + ":")]:
+        del _indexes[ns]
+    redis = get_redis()
+    if not redis:
+        return
+    try:
+        keys = [key async for key in redis.scan_iter(match=f"{_KEY_PREFIX}{agent_id}:*", count=500)]
+        if keys:
+            await redis.delete(*keys)
+    except Exception as e:
+        logger.warning("Answer cache invalidation failed for agent %s: %s", agent_id, e)
@@ -0,0 +1,70 @@
+"""Per-channel output profiles: generation budget, brevity instruction, message size for splitting replies."""
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass(frozen=True)
+class ChannelProfile:
+    max_tokens: int = 4096
+    # Appended to the system prompt; empty = no instruction
+    brevity_instruction: str = ""
+    # Max characters per outgoing message; None = send as one message
+    max_message_chars: Optional[int] = None
+
+
+_MESSENGER_BREVITY = (
+    "Отвечай кратко и по делу, как в мессенджере: несколько коротких абзацев, без длинных списков и таблиц. "
+    "Если нужен подробный ответ — дай суть и предложи продолжить."
+)
+
+# Keyed by ChatModel.channel; web chats have channel=None
+CHANNEL_PROFILES: dict[Optional[str], ChannelProfile] = {
+    None: ChannelProfile(),
+    # Telegram: 4096 chars per message
+    "telegram": ChannelProfile(max_tokens=1024, brevity_instruction=_MESSENGER_BREVITY, max_message_chars=4000),
+    # WhatsApp: 4096 chars per message
+    "whatsapp": ChannelProfile(max_tokens=1024, brevity_instruction=_MESSENGER_BREVITY, max_message_chars=4000),
+}
+
+
+def get_channel_profile(channel: Optional[str]) -> ChannelProfile:
+    return CHANNEL_PROFILES.get(channel) or CHANNEL_PROFILES[None]
+
+
+def apply_brevity(system_prompt: Optional[str], profile: ChannelProfile) -> Optional[str]:
+    """System prompt with the channel's brevity instruction appended."""
+    if not profile.brevity_instruction:
+        return system_prompt
+    if not system_prompt:
+        return profile.brevity_instruction
+    return f"{system_prompt}\n\n{profile.brevity_instruction}"
+
+
+def split_message(text: str, limit: int) -> list[str]:
+    """Split text into parts of at most limit chars, preferring paragraph, line, sentence, then word boundaries."""
+    if len(text) <= limit:
+        return [text]
+    parts: list[str] = []
+    rest = text
+    while len(rest) > limit:
+        cut = limit
+        for sep in ("\n\n", "\n", ". ", " "):
+            i = rest.rfind(sep, 0, limit)
+            # Не режем слишком коротко: граница должна быть во второй половине окна
+            if i >= limit // 2:
+                cut = i + len(sep)
+                break
+        part = rest[:cut].rstrip()
+        if part:
+            parts.append(part)
+        rest = rest[cut:].lstrip()
+    if rest:
+        parts.append(rest)
+    return parts
+
+
+def split_for_channel(text: str, channel: Optional[str]) -> list[str]:
+    limit = get_channel_profile(channel).max_message_chars
+    if not limit:
+        return [text]
+    return split_message(text, limit)
@@ -1,8 +1,10 @@
 """Chat service: send message to LLM, persist, return response."""
 import json
+from typing import Optional
+
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.llm.base import ChatMessage
+from app.llm.base import CompactMessage, MessageLog
 from app.llm.registry import get_llm_registry
 from app.mcp.playwright_client import (
     PLAYWRIGHT_TOOL_PREFIX,
@@ -10,28 +12,25 @@ from app.mcp.playwright_client import (
     get_playwright_tools,
     is_playwright_mcp_available,
 )
+from app.services.answer_cache import lookup_answer, remember_answer
+from app.services.channel_profiles import apply_brevity, get_channel_profile
 from app.mcp.zapier_client import call_zapier_tool, get_zapier_tools, is_zapier_mcp_configured
+from app.config import get_settings
+from app.storage.history_cache import fill_history, get_history, pending_seqs
 from app.storage.repositories import (
     account_get_by_channel,
     account_get_or_create,
     agent_get,
+    chat_get,
     chat_get_with_messages,
     chat_set_model,
     chat_set_agent,
     chat_update_title,
     message_add,
+    messages_page,
 )
 
 
-async def get_system_prompt(session: AsyncSession, agent_id: str | None) -> str | None:
-    if not agent_id:
-        return None
-    agent = await agent_get(session, agent_id)
-    if not agent or not agent.system_prompt:
-        return None
-    return agent.system_prompt
-
-
 async def resolve_model_for_chat(session: AsyncSession, chat_id: str, requested_model_id: str | None) -> str:
     """Resolve which model to use: request override, else chat's model_id, else default."""
     chat = await chat_get_with_messages(session, chat_id)
@@ -45,28 +44,60 @@ async def resolve_model_for_chat(session: AsyncSession, chat_id: str, requested_
 MAX_TOOL_ROUNDS = 5
 
 
+async def load_history(session: AsyncSession, chat) -> list[tuple[str, str]]:
+    """
+    (role, content) of the chat's last CHAT_HISTORY_CACHE_SIZE committed messages: from the Redis hot-history
+    cache, else from the database (and the cache is refilled). Messages added in this transaction are left out.
+    """
+    cached = await get_history(chat.id)
+    if cached is not None:
+        return cached
+    limit = get_settings().chat_history_cache_size
+    pending = pending_seqs(session, chat.id)
+    if chat.archived_at is not None:
+        # Архивный чат: chat_get_with_messages вернёт сообщения в таблицу
+        full = await chat_get_with_messages(session, chat.id)
+        rows = full.messages if full else []
+    else:
+        rows, _ = await messages_page(session, chat.id, limit=limit + len(pending))
+    committed = [(m.seq, m.role, m.content) for m in rows if m.seq not in pending][-limit:]
+    await fill_history(chat.id, committed)
+    return [(role, content) for _seq, role, content in committed]
+
+
 async def generate_reply(
     session: AsyncSession,
     chat_id: str,
     user_message: str,
     model_id: str | None = None,
-) -> str:
-    """Load chat history, call LLM (with optional MCP tools), return assistant content."""
-    chat = await chat_get_with_messages(session, chat_id)
+    *,
+    user_message_committed: bool = False,
+) -> tuple[str, Optional[str]]:
+    """
+    Load chat history (last messages, see load_history), call LLM (with optional MCP tools).
+    user_message_committed: user_message was already committed as the chat's last message (realtime voice
+    saves it before replying), so it is taken out of the loaded history instead of being sent twice.
+    Returns (assistant content, provenance): provenance is set when the reply did not come from the LLM
+    (answer cache), for messages.provenance.
+    """
+    chat = await chat_get(session, chat_id)
     if not chat:
         raise ValueError("Chat not found")
     effective_model = model_id or chat.model_id or "openrouter/auto"
     registry = get_llm_registry()
     resolved = registry.get_provider_for_model(effective_model)
     if not resolved:
-        return "No LLM provider configured for this model. Please set OPENROUTER_API_KEY or add another provider."
+        return "No LLM provider configured for this model. Please set OPENROUTER_API_KEY or add another provider.", None
     _provider_id, provider = resolved
-    system_prompt = await get_system_prompt(session, chat.agent_id)
-    messages: list[ChatMessage] = [
-        ChatMessage(role=m.role, content=m.content)
-        for m in chat.messages
-    ]
-    messages.append(ChatMessage(role="user", content=user_message))
+    profile = get_channel_profile(chat.channel)
+    agent = await agent_get(session, chat.agent_id) if chat.agent_id else None
+    system_prompt = apply_brevity(agent.system_prompt if agent and agent.system_prompt else None, profile)
+    history = await load_history(session, chat)
+    if user_message_committed and history and history[-1][0] == "user":
+        history = history[:-1]
+    # Compact messages, serialized once per turn: tool rounds re-send the encoded history (MessageLog)
+    messages = MessageLog(CompactMessage(role, content) for role, content in history)
+    messages.append(CompactMessage("user", user_message))
 
     # Zapier MCP: per-account (channel+external_id). Web chats without channel use env.
     mcp_url = None
@@ -82,24 +113,31 @@ async def generate_reply(
         playwright_tools = await get_playwright_tools()
         tools = tools + playwright_tools
 
+    # Кэш ответов агента: только первое сообщение чата и только без инструментов
+    use_answer_cache = (
+        agent is not None and agent.answer_cache and not tools and not any(role == "user" for role, _ in history)
+    )
+    if use_answer_cache:
+        cached = await lookup_answer(agent.id, effective_model, system_prompt, user_message)
+        if cached:
+            return cached.answer, cached.provenance
+
     for _ in range(MAX_TOOL_ROUNDS):
+        # Диалоговый ответ: напрямую provider.chat, без response_cache и single-flight (ответы не взаимозаменяемы)
         response = await provider.chat(
             messages=messages,
             model_id=effective_model,
             system_prompt=system_prompt,
+            max_tokens=profile.max_tokens,
             tools=tools if tools else None,
         )
         if not response.tool_calls:
-            return response.content or ""
+            if use_answer_cache and response.finish_reason not in ("error", "unknown"):
+                remember_answer(session, agent.id, effective_model, system_prompt, user_message, response.content)
+            return response.content or "", None
 
         # Append assistant message with tool_calls, then run tools and append tool results
-        messages.append(
-            ChatMessage(
-                role="assistant",
-                content=response.content or None,
-                tool_calls=response.tool_calls,
-            )
-        )
+        messages.append(CompactMessage("assistant", response.content or None, tool_calls=response.tool_calls))
         for tc in response.tool_calls:
             fn = (tc or {}).get("function") or {}
             name = fn.get("name") or ""
@@ -113,8 +151,6 @@ async def generate_reply(
             else:
                 result = await call_zapier_tool(name, args, mcp_url, mcp_secret)
             call_id = (tc or {}).get("id") or ""
-            messages.append(
-                ChatMessage(role="tool", content=result, tool_call_id=call_id)
-            )
+            messages.append(CompactMessage("tool", result, tool_call_id=call_id))
         # Next iteration: LLM will see tool results and may return text or more tool_calls
-    return response.content or "(Достигнут лимит вызовов инструментов.)"
+    return response.content or "(Достигнут лимит вызовов инструментов.)", None
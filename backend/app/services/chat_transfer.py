@@ -0,0 +1,315 @@
+"""
+Bulk transfer of chats as NDJSON, with constant memory in both directions.
+
+One JSON object per line, chats first and then their messages in seq order:
+  {"type": "chat", "id", "title", "modelId", "agentId", "channel", "externalId", "createdAt", "updatedAt"}
+  {"type": "message", "id", "chatId", "role", "content", "createdAt", "seq"}
+
+Export streams a server-side cursor. Import COPYs batches into temp staging tables and then inserts with
+ON CONFLICT DO NOTHING, so importing the same file twice is a no-op. A message must come after its chat.
+With DATABASE_SHARDS both directions go shard by shard; chats keep their ids and land on the shard of the id.
+Messages of archived chats are read from their segment (the chat stays archived).
+"""
+import uuid
+import zlib
+from datetime import datetime, timezone
+from typing import AsyncIterable, AsyncIterator, Optional
+
+import orjson
+from sqlalchemy import and_, select, text
+
+from app.storage.archive import load_archived_messages
+from app.storage.db import get_engine, get_read_session
+from app.storage.history_cache import invalidate_history
+from app.storage.models import ChatModel, MessageModel, uuid7
+from app.storage.sharding import MAIN, bind_to, shard_engines, shard_for_id, shard_ids, shards_for_user
+
+EXPORT_FLUSH_BYTES = 64 * 1024
+EXPORT_YIELD_PER = 1000
+IMPORT_BATCH = 5000
+
+CHAT_COLUMNS = ["id", "title", "model_id", "agent_id", "channel", "external_id", "created_at", "updated_at"]
+MESSAGE_COLUMNS = ["ord", "id", "chat_id", "role", "content", "created_at", "seq"]
+
+# ON COMMIT DROP: staging живёт одну транзакцию-батч (работает и за pgbouncer в transaction mode)
+STAGE_CHATS = (
+    "CREATE TEMP TABLE import_chats (id uuid, title text, model_id text, agent_id uuid, channel text, "
+    "external_id text, created_at timestamp, updated_at timestamp) ON COMMIT DROP"
+)
+STAGE_MESSAGES = (
+    "CREATE TEMP TABLE import_messages (ord bigint, id uuid, chat_id uuid, role text, content text, "
+    "created_at timestamp, seq integer) ON COMMIT DROP"
+)
+INSERT_CHATS = (
+    "INSERT INTO chats (id, title, model_id, agent_id, channel, external_id, created_at, updated_at, last_seq) "
+    # Агента может не быть в целевом окружении — тогда чат без агента
+    "SELECT s.id, s.title, s.model_id, a.id, s.channel, s.external_id, s.created_at, s.updated_at, 0 "
+    "FROM import_chats s LEFT JOIN agents a ON a.id = s.agent_id "
+    "ON CONFLICT (id) DO NOTHING"
+)
+# Остальные шарды: агенты живут только на main, agent_id уже сверен с ним в import_ndjson
+INSERT_CHATS_SHARD = (
+    "INSERT INTO chats (id, title, model_id, agent_id, channel, external_id, created_at, updated_at, last_seq) "
+    "SELECT id, title, model_id, agent_id, channel, external_id, created_at, updated_at, 0 FROM import_chats "
+    "ON CONFLICT (id) DO NOTHING"
+)
+# seq из файла сохраняется; без seq номер выдаёт триггер messages_assign_seq (в порядке строк файла)
+INSERT_MESSAGES = (
+    "INSERT INTO messages (id, chat_id, role, content, created_at, seq) "
+    "SELECT s.id, s.chat_id, s.role, s.content, s.created_at, s.seq FROM import_messages s "
+    "WHERE EXISTS (SELECT 1 FROM chats c WHERE c.id = s.chat_id) "
+    "ORDER BY s.ord "
+    "ON CONFLICT DO NOTHING"
+)
+BUMP_LAST_SEQ = (
+    "UPDATE chats c SET last_seq = GREATEST(c.last_seq, x.max_seq) FROM ("
+    "SELECT chat_id, max(seq) AS max_seq FROM messages "
+    "WHERE chat_id IN (SELECT DISTINCT chat_id FROM import_messages) GROUP BY chat_id) x "
+    "WHERE c.id = x.chat_id"
+)
+
+
+class ChatImportError(ValueError):
+    """Malformed import line; the message says which one."""
+
+
+# ---------- Export ----------
+async def export_ndjson(
+    *,
+    channel: Optional[str] = None,
+    external_id: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    compress: bool = False,
+) -> AsyncIterator[bytes]:
+    """
+    NDJSON (gzip if compress) of the chats of a channel user and/or chats active in [since, until);
+    with a range only the messages created inside it are exported. Reads from the replica when configured.
+    """
+    # Колонки без таймзоны хранят UTC
+    since, until = (
+        dt.astimezone(timezone.utc).replace(tzinfo=None) if dt is not None and dt.tzinfo else dt for dt in (since, until)
+    )
+    chat_filters = []
+    message_filters = [MessageModel.chat_id == ChatModel.id]
+    if channel is not None and external_id is not None:
+        chat_filters += [ChatModel.channel == channel, ChatModel.external_id == external_id]
+    if since is not None:
+        chat_filters.append(ChatModel.updated_at >= since)
+        message_filters.append(MessageModel.created_at >= since)
+    if until is not None:
+        chat_filters.append(ChatModel.created_at < until)
+        message_filters.append(MessageModel.created_at < until)
+    q = (
+        select(
+            ChatModel.id, ChatModel.title, ChatModel.model_id, ChatModel.agent_id, ChatModel.channel,
+            ChatModel.external_id, ChatModel.created_at, ChatModel.updated_at, ChatModel.archive_key,
+            MessageModel.id.label("message_id"), MessageModel.role, MessageModel.content,
+            MessageModel.created_at.label("message_created_at"), MessageModel.seq,
+        )
+        .select_from(ChatModel)
+        .outerjoin(MessageModel, and_(*message_filters))
+        .where(*chat_filters)
+        .order_by(ChatModel.id, MessageModel.seq)
+        .execution_options(yield_per=EXPORT_YIELD_PER)
+    )
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None  # 31 = gzip container
+    buf = bytearray()
+    current_chat = None
+    shards = shards_for_user(channel, external_id) if channel is not None and external_id is not None else shard_ids()
+    for shard in shards:
+        async with get_read_session() as session:
+            # session.stream: серверный курсор, в памяти только текущая пачка строк
+            result = await session.stream(q, bind_arguments=bind_to(shard))
+            async for row in result:
+                if row.id != current_chat:
+                    current_chat = row.id
+                    buf += orjson.dumps({
+                        "type": "chat",
+                        "id": row.id,
+                        "title": row.title,
+                        "modelId": row.model_id,
+                        "agentId": row.agent_id,
+                        "channel": row.channel,
+                        "externalId": row.external_id,
+                        "createdAt": row.created_at,
+                        "updatedAt": row.updated_at,
+                    }, option=orjson.OPT_APPEND_NEWLINE)
+                    if row.archive_key is not None:
+                        # Сообщения архивного чата лежат в сегменте (в messages их нет) — читаем его целиком
+                        for m in await load_archived_messages(row.archive_key):
+                            if (since is not None and m["created_at"] < since) or (
+                                until is not None and m["created_at"] >= until
+                            ):
+                                continue
+                            buf += orjson.dumps({
+                                "type": "message",
+                                "id": m["id"],
+                                "chatId": row.id,
+                                "role": m["role"],
+                                "content": m["content"],
+                                "createdAt": m["created_at"],
+                                "seq": m["seq"],
+                            }, option=orjson.OPT_APPEND_NEWLINE)
+                if row.message_id is not None:
+                    buf += orjson.dumps({
+                        "type": "message",
+                        "id": row.message_id,
+                        "chatId": row.id,
+                        "role": row.role,
+                        "content": row.content,
+                        "createdAt": row.message_created_at,
+                        "seq": row.seq,
+                    }, option=orjson.OPT_APPEND_NEWLINE)
+                if len(buf) >= EXPORT_FLUSH_BYTES:
+                    yield compressor.compress(bytes(buf)) if compressor else bytes(buf)
+                    buf.clear()
+    if compressor:
+        yield compressor.compress(bytes(buf)) + compressor.flush()
+    elif buf:
+        yield bytes(buf)
+
+
+# ---------- Import ----------
+async def _lines(chunks: AsyncIterable[bytes], gzipped: bool) -> AsyncIterator[bytes]:
+    decompressor = zlib.decompressobj(47) if gzipped else None  # 47 = gzip or zlib header, auto-detected
+    tail = b""
+    async for chunk in chunks:
+        if decompressor:
+            chunk = decompressor.decompress(chunk)
+        *lines, tail = (tail + chunk).split(b"\n")
+        for line in lines:
+            yield line
+    if decompressor:
+        tail += decompressor.flush()
+    for line in tail.split(b"\n"):
+        yield line
+
+
+def _uuid(value, line_no: int, field: str, required: bool = True) -> Optional[uuid.UUID]:
+    if value is None and not required:
+        return None
+    try:
+        return uuid.UUID(str(value))
+    except ValueError:
+        raise ChatImportError(f"line {line_no}: {field} is not a UUID: {value!r}")
+
+
+def _datetime(value, line_no: int, field: str) -> datetime:
+    if value is None:
+        return datetime.utcnow()
+    try:
+        dt = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ChatImportError(f"line {line_no}: {field} is not an ISO datetime: {value!r}")
+    # Колонки без таймзоны хранят UTC
+    return dt.replace(tzinfo=None) if dt.tzinfo is None else datetime.utcfromtimestamp(dt.timestamp())
+
+
+def _chat_record(d: dict, line_no: int) -> tuple:
+    return (
+        _uuid(d.get("id"), line_no, "id"),
+        d.get("title") or "New chat",
+        d.get("modelId") or "openrouter/auto",
+        _uuid(d.get("agentId"), line_no, "agentId", required=False),
+        d.get("channel"),
+        d.get("externalId"),
+        _datetime(d.get("createdAt"), line_no, "createdAt"),
+        _datetime(d.get("updatedAt") or d.get("createdAt"), line_no, "updatedAt"),
+    )
+
+
+def _message_record(d: dict, line_no: int) -> tuple:
+    if not d.get("role") or d.get("content") is None:
+        raise ChatImportError(f"line {line_no}: message needs role and content")
+    seq = d.get("seq")
+    if seq is not None and (not isinstance(seq, int) or seq < 1):
+        raise ChatImportError(f"line {line_no}: seq must be a positive integer")
+    return (
+        line_no,
+        _uuid(d["id"], line_no, "id") if d.get("id") else uuid7(),
+        _uuid(d.get("chatId"), line_no, "chatId"),
+        d["role"],
+        d["content"],
+        _datetime(d.get("createdAt"), line_no, "createdAt"),
+        seq,
+    )
+
+
+async def _flush(conn, chats: list[tuple], messages: list[tuple], main: bool = True) -> tuple[int, int]:
+    async with conn.begin():
+        await conn.execute(text(STAGE_CHATS))
+        await conn.execute(text(STAGE_MESSAGES))
+        raw = (await conn.get_raw_connection()).driver_connection
+        if chats:
+            await raw.copy_records_to_table("import_chats", records=chats, columns=CHAT_COLUMNS)
+        if messages:
+            await raw.copy_records_to_table("import_messages", records=messages, columns=MESSAGE_COLUMNS)
+        chats_inserted = (await conn.execute(text(INSERT_CHATS if main else INSERT_CHATS_SHARD))).rowcount
+        messages_inserted = (await conn.execute(text(INSERT_MESSAGES))).rowcount
+        if messages:
+            await conn.execute(text(BUMP_LAST_SEQ))
+    return chats_inserted, messages_inserted
+
+
+async def _known_agents(chats: list[tuple]) -> set:
+    ids = list({c[3] for c in chats if c[3] is not None})
+    if not ids:
+        return set()
+    async with get_engine().connect() as conn:
+        r = await conn.execute(text("SELECT id FROM agents WHERE id = ANY(:ids)"), {"ids": ids})
+        return {row.id for row in r}
+
+
+async def import_ndjson(chunks: AsyncIterable[bytes], *, gzipped: bool = False) -> dict:
+    """
+    Import an NDJSON stream (see module docstring) into the primary (each chat's shard when sharded). Each batch
+    of IMPORT_BATCH lines is COPYed and committed on its own; rows whose id (or chat_id + seq) already exists are
+    skipped. Returns counters.
+    """
+    counts = {"chats": 0, "messages": 0, "chatsSkipped": 0, "messagesSkipped": 0}
+    chats: list[tuple] = []
+    messages: list[tuple] = []
+
+    async def flush() -> None:
+        by_shard: dict[str, tuple[list, list]] = {}
+        for c in chats:
+            by_shard.setdefault(shard_for_id(c[0]), ([], []))[0].append(c)
+        for m in messages:
+            by_shard.setdefault(shard_for_id(m[2]), ([], []))[1].append(m)
+        known_agents = await _known_agents(chats) if set(by_shard) - {MAIN} else set()
+        for shard, (shard_chats, shard_messages) in by_shard.items():
+            if shard != MAIN:
+                shard_chats = [(*c[:3], c[3] if c[3] in known_agents else None, *c[4:]) for c in shard_chats]
+            async with shard_engines()[shard].connect() as conn:
+                inserted_chats, inserted_messages = await _flush(conn, shard_chats, shard_messages, shard == MAIN)
+            counts["chats"] += inserted_chats
+            counts["chatsSkipped"] += len(shard_chats) - inserted_chats
+            counts["messages"] += inserted_messages
+            counts["messagesSkipped"] += len(shard_messages) - inserted_messages
+        # Кэш истории чатов, получивших сообщения в обход message_add
+        await invalidate_history(list({str(m[2]) for m in messages}))
+        chats.clear()
+        messages.clear()
+
+    line_no = 0
+    async for line in _lines(chunks, gzipped):
+        line_no += 1
+        if not line.strip():
+            continue
+        try:
+            d = orjson.loads(line)
+        except orjson.JSONDecodeError as e:
+            raise ChatImportError(f"line {line_no}: invalid JSON ({e})")
+        kind = d.get("type") if isinstance(d, dict) else None
+        if kind == "chat":
+            chats.append(_chat_record(d, line_no))
+        elif kind == "message":
+            messages.append(_message_record(d, line_no))
+        else:
+            raise ChatImportError(f"line {line_no}: type must be 'chat' or 'message'")
+        if len(chats) + len(messages) >= IMPORT_BATCH:
+            await flush()
+    if chats or messages:
+        await flush()
+    return counts
@@ -0,0 +1,163 @@
+"""
+Idempotency-Key for non-idempotent POSTs (/send, /send-voice). The first request with a key runs, and its response
+is stored once its transaction has committed; a retry with the same key gets the stored response back, and a
+retry that arrives while the first one is still running waits for it instead of running again.
+Keys live in Redis when REDIS_URL is set (shared by all backend replicas), else in process memory.
+"""
+import asyncio
+import hashlib
+import logging
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+import orjson
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import get_settings
+from app.redis_client import get_redis
+from app.storage.db import run_after_commit, run_after_rollback
+
+logger = logging.getLogger(__name__)
+
+_KEY_PREFIX = "idem:"
+_POLL_SECONDS = 0.25
+_local: dict[str, tuple[float, bytes]] = {}
+
+
+class IdempotencyError(Exception):
+    def __init__(self, status_code: int, detail: str) -> None:
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def fingerprint(*parts) -> str:
+    """Hash of the request payload: the same key with a different payload is rejected."""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else orjson.dumps(part))
+        h.update(b"\0")
+    return h.hexdigest()[:32]
+
+
+# ---------- Storage: Redis or process memory ----------
+async def _claim(key: str, value: bytes, ttl: float) -> bool:
+    redis = get_redis()
+    if redis:
+        return bool(await redis.set(key, value, nx=True, px=int(ttl * 1000)))
+    now = time.monotonic()
+    if len(_local) > 10000:
+        for k, (until, _) in list(_local.items()):
+            if until <= now:
+                del _local[k]
+    current = _local.get(key)
+    if current and current[0] > now:
+        return False
+    _local[key] = (now + ttl, value)
+    return True
+
+
+async def _get(key: str) -> Optional[dict]:
+    redis = get_redis()
+    if redis:
+        value = await redis.get(key)
+    else:
+        current = _local.get(key)
+        value = current[1] if current and current[0] > time.monotonic() else None
+    return orjson.loads(value) if value else None
+
+
+async def _store(key: str, value: bytes, ttl: float) -> None:
+    redis = get_redis()
+    if not redis:
+        _local[key] = (time.monotonic() + ttl, value)
+        return
+    try:
+        await redis.set(key, value, px=int(ttl * 1000))
+    except Exception as e:
+        # Уже закоммичено: ответ клиенту отдаём, повтор с этим ключом получит 409 до истечения заявки
+        logger.warning("Idempotency response store failed: %s", e)
+
+
+async def _release(key: str, token: str) -> None:
+    """Drop our pending claim (the request failed), so a retry runs again."""
+    current = await _get(key)
+    if current and current.get("token") == token:
+        redis = get_redis()
+        if redis:
+            await redis.delete(key)
+        else:
+            _local.pop(key, None)
+
+
+class Idempotent:
+    """State of one keyed request: `replay` is the stored response when this is a retry."""
+
+    def __init__(self, session: AsyncSession, key: Optional[str], fp: str, token: str) -> None:
+        self.replay: Optional[dict] = None
+        self._session = session
+        self._key = key
+        self._fp = fp
+        self._token = token
+
+    def complete(self, response: dict) -> dict:
+        """Store the response for retries once the session commits; returns it unchanged."""
+        if self._key:
+            value = orjson.dumps({"state": "done", "fp": self._fp, "response": response})
+            ttl = get_settings().idempotency_ttl_seconds
+            run_after_commit(self._session, lambda: _store(self._key, value, ttl))
+        return response
+
+
+@asynccontextmanager
+async def idempotent(
+    session: AsyncSession, scope: str, key: Optional[str], fp: str
+) -> AsyncIterator[Idempotent]:
+    """
+    Run the body at most once per (scope, key). Without a key the body just runs. A retry gets idem.replay set
+    (the body should return it as is); a concurrent duplicate waits up to IDEMPOTENCY_WAIT_SECONDS for the first
+    request's response. IdempotencyError: 422 for a key reused with another payload, 409 if still in progress.
+    """
+    if not key:
+        yield Idempotent(session, None, fp, "")
+        return
+    settings = get_settings()
+    storage_key = f"{_KEY_PREFIX}{scope}:{key}"
+    token = uuid.uuid4().hex
+    pending = orjson.dumps({"state": "pending", "fp": fp, "token": token})
+    idem = Idempotent(session, storage_key, fp, token)
+    deadline = time.monotonic() + settings.idempotency_wait_seconds
+    try:
+        while not await _claim(storage_key, pending, settings.idempotency_wait_seconds * 2):
+            current = await _get(storage_key)
+            if current is None:
+                continue  # первый запрос упал и снял заявку — выполняем сами
+            if current["fp"] != fp:
+                raise IdempotencyError(422, "Idempotency-Key was already used for a different request")
+            if current["state"] == "done":
+                idem.replay = current["response"]
+                break
+            if time.monotonic() >= deadline:
+                raise IdempotencyError(409, "A request with this Idempotency-Key is still in progress")
+            await asyncio.sleep(_POLL_SECONDS)
+    except IdempotencyError:
+        raise
+    except Exception as e:
+        # Redis недоступен: выполняем запрос как без ключа, дубли сериализует блокировка чата
+        logger.warning("Idempotency store unavailable, running without Idempotency-Key: %s", e)
+        idem = Idempotent(session, None, fp, "")
+    if idem.replay is not None or idem._key is None:
+        yield idem
+        return
+    try:
+        yield idem
+    except BaseException:
+        try:
+            await _release(storage_key, token)
+        except Exception as e:
+            logger.warning("Idempotency key release failed: %s", e)
+        raise
+    # Тело прошло, но коммит в get_db ещё впереди: если он упадёт, снимаем заявку, чтобы повтор не ждал 409
+    run_after_rollback(session, lambda: _release(storage_key, token))
@@ -3,6 +3,8 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.llm.base import ChatMessage
 from app.llm.registry import get_llm_registry
+from app.llm.response_cache import response_cache
+from app.llm.single_flight import chat_single_flight
 from app.storage.repositories import (
     agents_supporting_category,
     agent_list,
@@ -13,6 +15,11 @@ from app.storage.repositories import (
 
 # Categories used for classification and routing
 SUPPORT_CATEGORIES = "technical, billing, general, other"
+# Версия промпта классификации: поднимать при смене формулировки или разбора ответа (ключ кэша ответов)
+CLASSIFY_PROMPT_VERSION = "1"
+
+# Кэш поверх single-flight: повторная классификация того же текста (в т.ч. из create_ticket) не ходит в LLM
+_classify_chat = response_cache("classify_support", CLASSIFY_PROMPT_VERSION)(chat_single_flight)
 
 
 async def classify_support_message(text: str) -> str:
@@ -30,10 +37,13 @@ async def classify_support_message(text: str) -> str:
         f"Categories: {SUPPORT_CATEGORIES}. Reply with only the single category word, nothing else.\n\n"
         f"Request: {text[:500]}"
     )
-    response = await provider.chat(
+    # Детерминированный вызов: одинаковые классификации в полёте делят один запрос к LLM, ответы кэшируются
+    response = await _classify_chat(
+        provider,
         messages=[ChatMessage(role="user", content=prompt)],
         model_id="openrouter/auto",
         max_tokens=20,
+        temperature=0.0,
     )
     raw = (response.content or "").strip().lower()
     for cat in SUPPORT_CATEGORIES.split(","):
@@ -0,0 +1,251 @@
+"""
+Cold-chat archive. Moves the messages of chats idle for ARCHIVE_AFTER_DAYS out of `messages` into one
+zstd-compressed NDJSON segment per chat under ARCHIVE_DIR (same message lines as /api/transfer/export) and leaves
+a stub on the chat: archived_at, archive_key, archive_preview (for chat lists). chat_get_with_messages moves the
+messages back (rehydrate_chat) the next time the chat is opened. Run from cron / a scheduled job:
+
+    python -m app.storage.archive                 # chats idle ARCHIVE_AFTER_DAYS days
+    python -m app.storage.archive --days 7 --limit 1000
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional
+
+import orjson
+import zstandard
+from sqlalchemy import delete, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app.config import get_settings
+from app.storage.consistency import mark_written
+from app.storage.db import close_db, wait_for_db
+from app.storage.models import ChatModel, MessageModel
+from app.storage.sharding import engine_for_chat, shard_engines
+
+logger = logging.getLogger(__name__)
+
+ZSTD_LEVEL = 10  # архивируется офлайн, так что жмём сильнее; скорость распаковки от уровня почти не зависит
+SCAN_BATCH = 200
+REHYDRATE_BATCH = 1000
+
+
+class LocalArchiveStore:
+    """Segments as files under a directory. An object storage backend needs the same put/get/delete."""
+
+    def __init__(self, root: str) -> None:
+        self.root = Path(root)
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self.root / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        # Сегмент должен лежать на диске целиком до того, как сообщения удалятся из таблицы
+        os.replace(tmp, path)
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            return (self.root / key).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key: str) -> None:
+        (self.root / key).unlink(missing_ok=True)
+
+
+_store: Optional[LocalArchiveStore] = None
+
+
+def get_archive_store() -> LocalArchiveStore:
+    global _store
+    if _store is None:
+        _store = LocalArchiveStore(get_settings().archive_dir)
+    return _store
+
+
+def _segment_key(chat_id: str) -> str:
+    return f"{chat_id[:2]}/{chat_id}.ndjson.zst"
+
+
+def _encode_segment(chat_id: str, rows: list) -> bytes:
+    lines = b"".join(
+        orjson.dumps({
+            "type": "message",
+            "id": r.id,
+            "chatId": chat_id,
+            "role": r.role,
+            "content": r.content,
+            "createdAt": r.created_at,
+            "seq": r.seq,
+            "provenance": r.provenance,
+        }, option=orjson.OPT_APPEND_NEWLINE)
+        for r in rows
+    )
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(lines)
+
+
+def _decode_segment(data: bytes) -> list[dict]:
+    messages = []
+    for line in zstandard.ZstdDecompressor().decompress(data).splitlines():
+        if not line:
+            continue
+        d = orjson.loads(line)
+        messages.append({
+            "id": d["id"],
+            "chat_id": d["chatId"],
+            "role": d["role"],
+            "content": d["content"],
+            "created_at": datetime.fromisoformat(d["createdAt"]),
+            "seq": d["seq"],
+            # Сегменты, записанные до появления messages.provenance, его не содержат
+            "provenance": d.get("provenance"),
+        })
+    return messages
+
+
+def _preview(rows: list) -> Optional[str]:
+    for r in reversed(rows):
+        if r.role in ("user", "assistant") and r.content:
+            return (r.content[:80] + "…") if len(r.content) > 80 else r.content
+    return None
+
+
+async def load_archived_messages(key: Optional[str]) -> list[dict]:
+    """Messages of a segment as MessageModel column dicts in seq order ([] if the segment is gone)."""
+    if not key:
+        return []
+    data = await asyncio.to_thread(get_archive_store().get, key)
+    if data is None:
+        return []
+    return await asyncio.to_thread(_decode_segment, data)
+
+
+async def archive_chat(chat_id: str, cutoff: datetime) -> int:
+    """Archive one chat if it is still idle since cutoff. Returns the number of archived messages (0 = skipped)."""
+    async with engine_for_chat(chat_id).begin() as conn:
+        # SKIP LOCKED: в чат прямо сейчас пишут — значит, он не холодный
+        chat = (await conn.execute(
+            select(ChatModel.id)
+            .where(ChatModel.id == chat_id, ChatModel.archived_at.is_(None), ChatModel.updated_at < cutoff)
+            .with_for_update(skip_locked=True)
+        )).one_or_none()
+        if chat is None:
+            return 0
+        rows = (await conn.execute(
+            select(
+                MessageModel.id, MessageModel.role, MessageModel.content, MessageModel.created_at, MessageModel.seq,
+                MessageModel.provenance,
+            )
+            .where(MessageModel.chat_id == chat_id)
+            .order_by(MessageModel.seq)
+        )).all()
+        if not rows or rows[-1].created_at >= cutoff:
+            return 0
+        key = _segment_key(chat_id)
+        data = await asyncio.to_thread(_encode_segment, chat_id, rows)
+        await asyncio.to_thread(get_archive_store().put, key, data)
+        await conn.execute(
+            update(ChatModel)
+            .where(ChatModel.id == chat_id)
+            # updated_at явно: иначе onupdate сдвинет чат наверх списка
+            .values(archived_at=datetime.utcnow(), archive_key=key, archive_preview=_preview(rows),
+                    updated_at=ChatModel.updated_at)
+        )
+        await conn.execute(delete(MessageModel).where(MessageModel.chat_id == chat_id))
+    return len(rows)
+
+
+async def archive_idle_chats(days: int, limit: Optional[int] = None) -> dict:
+    """Archive chats not updated for `days` days (at most `limit` chats). Each chat is its own transaction."""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    stats = {"chats": 0, "messages": 0}
+    for engine in shard_engines().values():
+        await _archive_shard(engine, cutoff, limit, stats)
+    logger.info("Archived %d chats (%d messages) idle since %s", stats["chats"], stats["messages"], cutoff)
+    return stats
+
+
+async def _archive_shard(engine, cutoff: datetime, limit: Optional[int], stats: dict) -> None:
+    after = None
+    while limit is None or stats["chats"] < limit:
+        q = (
+            select(ChatModel.id, ChatModel.updated_at)
+            .where(ChatModel.archived_at.is_(None), ChatModel.updated_at < cutoff)
+            .order_by(ChatModel.updated_at, ChatModel.id)
+            .limit(SCAN_BATCH)
+        )
+        if after is not None:
+            q = q.where(tuple_(ChatModel.updated_at, ChatModel.id) > after)
+        async with engine.connect() as conn:
+            candidates = (await conn.execute(q)).all()
+        if not candidates:
+            break
+        for c in candidates:
+            if limit is not None and stats["chats"] >= limit:
+                break
+            archived = await archive_chat(c.id, cutoff)
+            if archived:
+                stats["chats"] += 1
+                stats["messages"] += archived
+        after = (candidates[-1].updated_at, candidates[-1].id)
+
+
+async def rehydrate_chat(chat_id: str) -> bool:
+    """
+    Move an archived chat's messages back into `messages` and clear the stub. True when the chat is hot now;
+    False when another transaction holds the chat row (the caller then reads the segment instead).
+    """
+    async with engine_for_chat(chat_id).begin() as conn:
+        chat = (await conn.execute(
+            select(ChatModel.archive_key).where(ChatModel.id == chat_id).with_for_update(skip_locked=True)
+        )).one_or_none()
+        if chat is None:
+            return False
+        key = chat.archive_key
+        if key is None:
+            return True
+        messages = await load_archived_messages(key)
+        for i in range(0, len(messages), REHYDRATE_BATCH):
+            # seq из сегмента: триггер нумерует только вставки без seq, last_seq чата не менялся
+            await conn.execute(
+                pg_insert(MessageModel).values(messages[i:i + REHYDRATE_BATCH]).on_conflict_do_nothing()
+            )
+        await conn.execute(
+            update(ChatModel)
+            .where(ChatModel.id == chat_id)
+            .values(archived_at=None, archive_key=None, archive_preview=None, updated_at=ChatModel.updated_at)
+        )
+    logger.info("Rehydrated chat %s (%d messages)", chat_id, len(messages))
+    await mark_written([f"chat_id:{chat_id}"])
+    await asyncio.to_thread(get_archive_store().delete, key)
+    return True
+
+
+async def _run(days: int, limit: Optional[int]) -> int:
+    try:
+        await wait_for_db()
+        await archive_idle_chats(days, limit)
+        return 0
+    finally:
+        await close_db()
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    parser = argparse.ArgumentParser(description="Archive messages of idle chats")
+    parser.add_argument("--days", type=int, default=get_settings().archive_after_days)
+    parser.add_argument("--limit", type=int, default=None, help="archive at most N chats")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(_run(args.days, args.limit)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Read-your-writes for replica reads. After a request writes, its consistency keys (account, chat, channel user)
+are pinned to the primary for DB_READ_YOUR_WRITES_SECONDS, so the same client never reads a lagging replica.
+Pins live in Redis when REDIS_URL is set (shared by all backend replicas), else in process memory.
+"""
+import logging
+import time
+
+from app.config import get_settings
+from app.redis_client import get_redis
+from app.storage.db import has_read_replica
+
+logger = logging.getLogger(__name__)
+
+_KEY_PREFIX = "ryw:"
+_local_pins: dict[str, float] = {}
+
+
+async def mark_written(keys: list[str]) -> None:
+    window = get_settings().db_read_your_writes_seconds
+    if not keys or window <= 0 or not has_read_replica():
+        return
+    redis = get_redis()
+    if redis:
+        try:
+            async with redis.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.set(_KEY_PREFIX + key, "1", px=int(window * 1000))
+                await pipe.execute()
+            return
+        except Exception as e:
+            logger.warning("Redis read-your-writes pin failed, using local pins: %s", e)
+    now = time.monotonic()
+    if len(_local_pins) > 10000:
+        for key, until in list(_local_pins.items()):
+            if until <= now:
+                del _local_pins[key]
+    for key in keys:
+        _local_pins[key] = now + window
+
+
+async def is_pinned(keys: list[str]) -> bool:
+    """True if any key was written within the window (read it from the primary)."""
+    if not keys or not has_read_replica():
+        return False
+    redis = get_redis()
+    if redis:
+        try:
+            return bool(await redis.exists(*(_KEY_PREFIX + k for k in keys)))
+        except Exception as e:
+            # Не знаем, была ли запись — безопаснее прочитать с primary
+            logger.warning("Redis read-your-writes check failed, reading from primary: %s", e)
+            return True
+    now = time.monotonic()
+    return any(_local_pins.get(k, 0) > now for k in keys)
@@ -1,14 +1,16 @@
 """Async database engine and session. PostgreSQL via DATABASE_URL."""
 import asyncio
 import logging
+import uuid
 from contextlib import asynccontextmanager
 from typing import AsyncGenerator
 
-from sqlalchemy import text
-from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
-from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import DeclarativeBase, Session
 
 from app.config import get_settings
+from app.storage.pool_metrics import instrumented_pool_class
 
 logger = logging.getLogger(__name__)
 
@@ -21,11 +23,32 @@ def _get_engine_url() -> str:
     return get_settings().database_url
 
 
-_engine = create_async_engine(
-    _get_engine_url(),
-    echo=get_settings().debug,
-    future=True,
-)
+def _create_engine(url: str, name: str) -> AsyncEngine:
+    settings = get_settings()
+    connect_args = {}
+    if settings.db_pgbouncer:
+        # Transaction pooling: следующая транзакция может попасть на другой backend-процесс,
+        # поэтому prepared statements не кэшируем и не переиспользуем их имена
+        connect_args = {
+            "statement_cache_size": 0,
+            "prepared_statement_cache_size": 0,
+            "prepared_statement_name_func": lambda: f"__asyncpg_{uuid.uuid4()}__",
+        }
+    return create_async_engine(
+        url,
+        echo=settings.debug,
+        future=True,
+        poolclass=instrumented_pool_class(name),
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_timeout=settings.db_pool_timeout,
+        pool_recycle=settings.db_pool_recycle,
+        pool_pre_ping=settings.db_pool_pre_ping,
+        connect_args=connect_args,
+    )
+
+
+_engine = _create_engine(_get_engine_url(), "primary")
 
 async_session_factory = async_sessionmaker(
     _engine,
@@ -35,6 +58,25 @@ async_session_factory = async_sessionmaker(
     autoflush=False,
 )
 
+# Optional read replica (DATABASE_READ_URL) for read-only sessions
+_read_engine = (
+    _create_engine(get_settings().database_read_url, "replica") if get_settings().database_read_url else None
+)
+
+
+def _read_only_factory(engine) -> async_sessionmaker:
+    # postgresql_readonly: каждая транзакция начинается как BEGIN READ ONLY
+    return async_sessionmaker(
+        engine.execution_options(postgresql_readonly=True),
+        class_=AsyncSession,
+        expire_on_commit=False,
+        autoflush=False,
+    )
+
+
+_primary_read_factory = _read_only_factory(_engine)
+_replica_read_factory = _read_only_factory(_read_engine) if _read_engine else None
+
 
 @asynccontextmanager
 async def get_session() -> AsyncGenerator[AsyncSession, None]:
@@ -42,42 +84,84 @@ async def get_session() -> AsyncGenerator[AsyncSession, None]:
         try:
             yield session
             await session.commit()
+            session.info.pop("after_rollback", None)
+            for callback in session.info.pop("after_commit", ()):
+                await callback()
         except Exception:
             await session.rollback()
+            session.info.pop("after_commit", None)
+            for callback in session.info.pop("after_rollback", ()):
+                try:
+                    await callback()
+                except Exception as e:
+                    logger.warning("after_rollback callback failed: %s", e)
             raise
         finally:
             await session.close()
 
 
-async def _run_migrations(conn) -> None:
-    """Create accounts table if missing; move Zapier to account level (drop from chats)."""
-    await conn.execute(text(
-        "CREATE TABLE IF NOT EXISTS accounts ("
-        "id VARCHAR(36) PRIMARY KEY, "
-        "channel VARCHAR(64) NOT NULL, "
-        "external_id VARCHAR(255) NOT NULL, "
-        "zapier_mcp_server_url VARCHAR(2048), "
-        "zapier_mcp_secret VARCHAR(512), "
-        "created_at TIMESTAMP WITHOUT TIME ZONE DEFAULT (now() AT TIME ZONE 'utc'), "
-        "updated_at TIMESTAMP WITHOUT TIME ZONE DEFAULT (now() AT TIME ZONE 'utc'), "
-        "CONSTRAINT uq_accounts_channel_external UNIQUE (channel, external_id))"
-    ))
-    for sql in (
-        "ALTER TABLE chats DROP COLUMN IF EXISTS zapier_mcp_server_url",
-        "ALTER TABLE chats DROP COLUMN IF EXISTS zapier_mcp_secret",
-    ):
-        await conn.execute(text(sql))
+def run_after_commit(session: AsyncSession, callback) -> None:
+    """Await `callback()` once get_session() has committed the session's transaction (never on rollback)."""
+    session.info.setdefault("after_commit", []).append(callback)
 
 
-async def init_db() -> None:
-    """Create tables if they don't exist; run migrations for new columns. Retries on connection errors."""
-    logger.info("Initializing database: %s", _get_engine_url())
+@event.listens_for(Session, "after_flush")
+def _mark_flushed(session: Session, flush_context) -> None:
+    session.info["wrote"] = True
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _mark_dml(state) -> None:
+    # Core insert()/update()/delete() через session.execute идут мимо flush
+    if state.is_insert or state.is_update or state.is_delete:
+        state.session.info["wrote"] = True
+
+
+def session_wrote(session: AsyncSession) -> bool:
+    """True if the session flushed ORM changes or executed INSERT/UPDATE/DELETE."""
+    return bool(session.info.get("wrote"))
+
+
+def run_after_rollback(session: AsyncSession, callback) -> None:
+    """Await `callback()` if get_session() rolls the session's transaction back (the body or the commit failed)."""
+    session.info.setdefault("after_rollback", []).append(callback)
+
+
+@asynccontextmanager
+async def get_read_session(use_primary: bool = False) -> AsyncGenerator[AsyncSession, None]:
+    """
+    Session for pure reads: READ ONLY transaction, never committed (closing the session rolls it back).
+    Goes to the replica when DATABASE_READ_URL is set, unless use_primary (read-your-writes window).
+    """
+    factory = _replica_read_factory if _replica_read_factory and not use_primary else _primary_read_factory
+    async with factory() as session:
+        yield session
+
+
+def has_read_replica() -> bool:
+    return _read_engine is not None
+
+
+def use_session_factories(write: async_sessionmaker, read: async_sessionmaker) -> None:
+    """Replace the session factories (sharding: sessions over all shards, replica routing off)."""
+    global async_session_factory, _primary_read_factory, _replica_read_factory
+    async_session_factory = write
+    _primary_read_factory = read
+    _replica_read_factory = None
+
+
+def get_engine():
+    return _engine
+
+
+async def wait_for_db() -> None:
+    """Wait until PostgreSQL accepts connections. Retries on connection errors, fails fast on bad credentials."""
+    logger.info("Connecting to database: %s", _get_engine_url())
     last_error = None
     for attempt in range(1, 6):
         try:
-            async with _engine.begin() as conn:
-                await conn.run_sync(Base.metadata.create_all)
-                await _run_migrations(conn)
+            async with _engine.connect() as conn:
+                await conn.execute(text("SELECT 1"))
             return
         except Exception as e:
             last_error = e
@@ -89,11 +173,70 @@ async def init_db() -> None:
                     "If you changed the password, run: docker compose down -v (then up again)."
                 )
                 raise
-            logger.warning("DB init attempt %s/5 failed: %s", attempt, err_name)
+            logger.warning("DB connect attempt %s/5 failed: %s", attempt, err_name)
             if attempt < 5:
                 await asyncio.sleep(2.0 * attempt)
     raise last_error
 
 
+async def _open_warm(engine: AsyncEngine):
+    conn = await engine.connect()
+    try:
+        await conn.execute(text("SELECT 1"))
+    except BaseException:
+        await conn.close()
+        raise
+    return conn
+
+
+async def warm_up_pool(engine: AsyncEngine, connections: int) -> None:
+    """
+    Open up to `connections` pooled connections at once and return them to the pool. Best effort: a failed
+    connect is logged, the connections that did open are still returned, startup goes on.
+    """
+    n = min(connections, get_settings().db_pool_size)
+    if n <= 0:
+        return
+    url = engine.url.render_as_string(hide_password=True)
+    # Держим все одновременно, иначе пул будет раз за разом отдавать одно и то же соединение; ждём все попытки,
+    # чтобы не бросить открывшиеся позже соединения мимо пула
+    results = await asyncio.gather(*(_open_warm(engine) for _ in range(n)), return_exceptions=True)
+    conns = [r for r in results if not isinstance(r, BaseException)]
+    await asyncio.gather(*(c.close() for c in conns), return_exceptions=True)
+    errors = [r for r in results if isinstance(r, BaseException)]
+    if errors:
+        logger.warning("DB pool warm-up opened %d of %d connections (%s): %s", len(conns), n, url, errors[0])
+        return
+    logger.info("Warmed up %d DB connections (%s)", n, url)
+
+
+async def init_db() -> None:
+    """
+    Wait for the database and check the schema version. Migrations are applied by
+    `python -m app.storage.migrate` (or here when DB_AUTO_MIGRATE=true, e.g. local dev).
+    """
+    from app.storage import sharding
+    from app.storage.migrations import apply_pending, check_schema
+
+    await wait_for_db()
+    engines = sharding.shard_engines()
+    for engine in engines.values():
+        if get_settings().db_auto_migrate:
+            await apply_pending(engine)
+        else:
+            await check_schema(engine)
+    await sharding.init_sharding()
+    warmup = get_settings().db_pool_warmup
+    for engine in engines.values():
+        await warm_up_pool(engine, warmup)
+    if _read_engine:
+        await warm_up_pool(_read_engine, warmup)
+
+
 async def close_db() -> None:
+    from app.storage import sharding
+
+    await sharding.close_sharding()
     await _engine.dispose()
+    if _read_engine:
+        await _read_engine.dispose()
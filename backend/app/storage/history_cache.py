@@ -0,0 +1,100 @@
+"""
+Hot chat history in Redis: the last CHAT_HISTORY_CACHE_SIZE messages of active chats, so a turn builds the LLM
+context without re-reading the chat from Postgres. Write-through: message_add appends once its transaction has
+committed; a miss reads the database and refills. Idle chats expire after CHAT_HISTORY_CACHE_TTL_SECONDS.
+No-op when REDIS_URL is not set.
+
+One sorted set per chat: score = seq, member = orjson [seq, role, content]. Appends and refills are both ZADDs, so
+they merge in any order. A marker member (score 0) is written by refills only: a set created by appends alone
+(after it expired) is incomplete and counts as a miss.
+"""
+import logging
+from typing import Optional
+
+import orjson
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import get_settings
+from app.redis_client import get_redis
+from app.storage.db import run_after_commit
+
+logger = logging.getLogger(__name__)
+
+_KEY_PREFIX = "hist:"
+_FILLED = "~"
+
+
+def _key(chat_id: str) -> str:
+    return _KEY_PREFIX + chat_id
+
+
+def _encode(seq: int, role: str, content: str) -> str:
+    return orjson.dumps([seq, role, content]).decode()
+
+
+async def _write(chat_id: str, messages: list[tuple[int, str, str]], filled: bool) -> None:
+    redis = get_redis()
+    settings = get_settings()
+    mapping = {_encode(*m): m[0] for m in messages}
+    if filled:
+        mapping[_FILLED] = 0
+    if not mapping:
+        return
+    key = _key(chat_id)
+    try:
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.zadd(key, mapping)
+            # Маркер (ранг 0) и N последних по seq
+            pipe.zremrangebyrank(key, 1, -(settings.chat_history_cache_size + 1))
+            pipe.expire(key, settings.chat_history_cache_ttl_seconds)
+            await pipe.execute()
+    except Exception as e:
+        logger.warning("History cache write failed for chat %s: %s", chat_id, e)
+        # Недописанный набор хуже отсутствующего
+        await invalidate_history([chat_id])
+
+
+async def get_history(chat_id: str) -> Optional[list[tuple[str, str]]]:
+    """Cached (role, content) of the chat's last messages in seq order, or None on a miss."""
+    redis = get_redis()
+    if not redis:
+        return None
+    try:
+        members = await redis.zrange(_key(chat_id), 0, -1)
+    except Exception as e:
+        logger.warning("History cache read failed for chat %s: %s", chat_id, e)
+        return None
+    if not members or members[0] != _FILLED:
+        return None
+    return [tuple(orjson.loads(m)[1:]) for m in members[1:]]
+
+
+async def fill_history(chat_id: str, messages: list[tuple[int, str, str]]) -> None:
+    """Refill after a miss with committed (seq, role, content) rows, oldest first."""
+    if get_redis():
+        await _write(chat_id, messages[-get_settings().chat_history_cache_size:], filled=True)
+
+
+def remember_message(session: AsyncSession, chat_id: str, seq: int, role: str, content: str) -> None:
+    """Append a message added in `session` once the transaction commits (dropped on rollback)."""
+    pending = session.info.setdefault("history_pending", {})
+    if chat_id not in pending:
+        pending[chat_id] = []
+        if get_redis():
+            run_after_commit(session, lambda: _write(chat_id, pending[chat_id], filled=False))
+    pending[chat_id].append((seq, role, content))
+
+
+def pending_seqs(session: AsyncSession, chat_id: str) -> set[int]:
+    """Seqs of messages added in `session` but not committed yet: not part of the history before the commit."""
+    return {m[0] for m in session.info.get("history_pending", {}).get(chat_id, ())}
+
+
+async def invalidate_history(chat_ids: list[str]) -> None:
+    redis = get_redis()
+    if not redis or not chat_ids:
+        return
+    try:
+        await redis.delete(*(_key(c) for c in chat_ids))
+    except Exception as e:
+        logger.warning("History cache invalidation failed: %s", e)
@@ -0,0 +1,61 @@
+"""
+Schema migration command (run once per deploy, not by every app replica):
+
+    python -m app.storage.migrate            # apply pending migrations (under advisory lock)
+    python -m app.storage.migrate status     # list applied / pending versions
+
+With DATABASE_SHARDS every shard database is migrated.
+"""
+import argparse
+import asyncio
+import logging
+import sys
+
+from app.storage.db import close_db, wait_for_db
+from app.storage.migrations import applied_versions, apply_pending, load_migrations
+from app.storage.sharding import shard_engines
+
+logger = logging.getLogger(__name__)
+
+
+async def _status() -> int:
+    pending = 0
+    engines = shard_engines()
+    for name, engine in engines.items():
+        async with engine.connect() as conn:
+            done = await applied_versions(conn)
+        if len(engines) > 1:
+            print(f"[{name}]")
+        for m in load_migrations():
+            state = "applied" if m.VERSION in done else "pending"
+            pending += m.VERSION not in done
+            print(f"{m.VERSION:04d}  {state:<8} {m.DESCRIPTION}")
+    return 1 if pending else 0
+
+
+async def _run(command: str) -> int:
+    try:
+        await wait_for_db()
+        if command == "status":
+            return await _status()
+        for name, engine in shard_engines().items():
+            applied = await apply_pending(engine)
+            if applied:
+                logger.info("Applied migrations on %s: %s", name, ", ".join(f"{v:04d}" for v in applied))
+            else:
+                logger.info("Schema of %s is up to date", name)
+        return 0
+    finally:
+        await close_db()
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    parser = argparse.ArgumentParser(description="Agiens schema migrations")
+    parser.add_argument("command", nargs="?", default="upgrade", choices=["upgrade", "status"])
+    args = parser.parse_args()
+    sys.exit(asyncio.run(_run(args.command)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Versioned schema migrations. Each module vNNNN_<name>.py defines:
+  VERSION: int, DESCRIPTION: str, TRANSACTIONAL: bool (False for CREATE INDEX CONCURRENTLY etc.),
+  async def upgrade(conn) -> None
+Applied versions are recorded in schema_version. Migrations are applied once, under a Postgres advisory
+lock, by `python -m app.storage.migrate`; app startup only checks that nothing is pending.
+"""
+import asyncio
+import importlib
+import logging
+import pkgutil
+from types import ModuleType
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION_TABLE = "schema_version"
+# pg_advisory_lock key shared by all migrators ("agiens" in ASCII)
+MIGRATION_LOCK_ID = 0x616769656E73
+
+
+class SchemaVersionError(RuntimeError):
+    """Database schema is behind the code: migrations are pending."""
+
+
+async def drop_if_invalid(conn, name: str) -> None:
+    """A failed CONCURRENTLY build leaves an INVALID index that IF NOT EXISTS would silently keep: drop it."""
+    r = await conn.execute(
+        text(
+            "SELECT NOT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = :name AND c.relnamespace = current_schema()::regnamespace"
+        ),
+        {"name": name},
+    )
+    if r.scalar():
+        await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+
+def load_migrations() -> list[ModuleType]:
+    """All migration modules of this package, ordered by VERSION."""
+    modules = []
+    for info in pkgutil.iter_modules(__path__):
+        if info.name.startswith("v") and info.name[1:5].isdigit():
+            modules.append(importlib.import_module(f"{__name__}.{info.name}"))
+    modules.sort(key=lambda m: m.VERSION)
+    versions = [m.VERSION for m in modules]
+    if len(versions) != len(set(versions)):
+        raise RuntimeError(f"Duplicate migration versions: {versions}")
+    return modules
+
+
+async def _ensure_version_table(conn) -> None:
+    await conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE} ("
+        "version INTEGER PRIMARY KEY, "
+        "description VARCHAR(255) NOT NULL, "
+        "applied_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() AT TIME ZONE 'utc'))"
+    ))
+
+
+async def applied_versions(conn) -> set[int]:
+    """Versions recorded in schema_version (empty if the table does not exist yet)."""
+    r = await conn.execute(text("SELECT to_regclass(:t) IS NOT NULL"), {"t": SCHEMA_VERSION_TABLE})
+    if not r.scalar():
+        return set()
+    r = await conn.execute(text(f"SELECT version FROM {SCHEMA_VERSION_TABLE}"))
+    return {row[0] for row in r}
+
+
+async def pending_migrations(engine: AsyncEngine) -> list[ModuleType]:
+    async with engine.connect() as conn:
+        done = await applied_versions(conn)
+    return [m for m in load_migrations() if m.VERSION not in done]
+
+
+async def check_schema(engine: AsyncEngine) -> None:
+    """Raise SchemaVersionError if any migration is pending. Read-only: no DDL, no locks."""
+    pending = await pending_migrations(engine)
+    if pending:
+        raise SchemaVersionError(
+            "Database schema is behind: pending migrations "
+            + ", ".join(f"{m.VERSION:04d}" for m in pending)
+            + ". Run: python -m app.storage.migrate"
+        )
+
+
+async def _record(conn, migration: ModuleType) -> None:
+    await conn.execute(
+        text(f"INSERT INTO {SCHEMA_VERSION_TABLE} (version, description) VALUES (:v, :d)"),
+        {"v": migration.VERSION, "d": migration.DESCRIPTION},
+    )
+
+
+async def _acquire_lock(conn, poll_seconds: float = 1.0) -> None:
+    """
+    Poll pg_try_advisory_lock instead of blocking in pg_advisory_lock: a backend waiting inside a statement
+    holds a snapshot, and CREATE INDEX CONCURRENTLY in the lock holder would wait for it forever.
+    """
+    while True:
+        r = await conn.execute(text("SELECT pg_try_advisory_lock(:k)"), {"k": MIGRATION_LOCK_ID})
+        if r.scalar():
+            return
+        logger.info("Another migrator holds the migration lock; waiting")
+        await asyncio.sleep(poll_seconds)
+
+
+async def apply_pending(engine: AsyncEngine) -> list[int]:
+    """
+    Apply migrations not yet recorded in schema_version, holding a session advisory lock so concurrent
+    migrators (several replicas / deploy jobs) run them exactly once. Returns applied versions.
+    """
+    applied = []
+    async with engine.connect() as lock_conn:
+        lock_conn = await lock_conn.execution_options(isolation_level="AUTOCOMMIT")
+        await _acquire_lock(lock_conn)
+        try:
+            await _ensure_version_table(lock_conn)
+            # Перечитываем под локом: другой мигратор мог уже всё применить, пока мы ждали
+            done = await applied_versions(lock_conn)
+            for migration in load_migrations():
+                if migration.VERSION in done:
+                    continue
+                logger.info("Applying migration %04d: %s", migration.VERSION, migration.DESCRIPTION)
+                if getattr(migration, "TRANSACTIONAL", True):
+                    async with engine.begin() as conn:
+                        await migration.upgrade(conn)
+                        await _record(conn, migration)
+                else:
+                    # CONCURRENTLY нельзя выполнять внутри транзакции; миграция должна быть идемпотентной
+                    async with engine.connect() as conn:
+                        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+                        await migration.upgrade(conn)
+                        await _record(conn, migration)
+                applied.append(migration.VERSION)
+        finally:
+            await lock_conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": MIGRATION_LOCK_ID})
+    return applied
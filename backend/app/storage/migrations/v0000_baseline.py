@@ -0,0 +1,63 @@
+"""Baseline schema (what create_all + the old ad-hoc startup DDL produced). Idempotent for existing databases."""
+from sqlalchemy import text
+
+VERSION = 0
+DESCRIPTION = "baseline schema"
+TRANSACTIONAL = True
+
+STATEMENTS = [
+    "CREATE TABLE IF NOT EXISTS accounts ("
+    "id VARCHAR(36) PRIMARY KEY, "
+    "channel VARCHAR(64) NOT NULL, "
+    "external_id VARCHAR(255) NOT NULL, "
+    "zapier_mcp_server_url VARCHAR(2048), "
+    "zapier_mcp_secret VARCHAR(512), "
+    "created_at TIMESTAMP WITHOUT TIME ZONE DEFAULT (now() AT TIME ZONE 'utc'), "
+    "updated_at TIMESTAMP WITHOUT TIME ZONE DEFAULT (now() AT TIME ZONE 'utc'), "
+    "CONSTRAINT uq_accounts_channel_external UNIQUE (channel, external_id))",
+    "CREATE INDEX IF NOT EXISTS ix_accounts_channel ON accounts (channel)",
+    "CREATE INDEX IF NOT EXISTS ix_accounts_external_id ON accounts (external_id)",
+    "CREATE TABLE IF NOT EXISTS agents ("
+    "id VARCHAR(36) PRIMARY KEY, "
+    "name VARCHAR(255) NOT NULL, "
+    "description TEXT NOT NULL, "
+    "icon VARCHAR(64) NOT NULL, "
+    "system_prompt TEXT NOT NULL, "
+    "model_id VARCHAR(255), "
+    "supported_categories VARCHAR(512), "
+    "created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS chats ("
+    "id VARCHAR(36) PRIMARY KEY, "
+    "title VARCHAR(512) NOT NULL, "
+    "model_id VARCHAR(255) NOT NULL, "
+    "agent_id VARCHAR(36) REFERENCES agents (id), "
+    "channel VARCHAR(64), "
+    "external_id VARCHAR(255), "
+    "created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL, "
+    "updated_at TIMESTAMP WITHOUT TIME ZONE NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS ix_chats_channel ON chats (channel)",
+    "CREATE INDEX IF NOT EXISTS ix_chats_external_id ON chats (external_id)",
+    "CREATE TABLE IF NOT EXISTS messages ("
+    "id VARCHAR(36) PRIMARY KEY, "
+    "chat_id VARCHAR(36) NOT NULL REFERENCES chats (id), "
+    "role VARCHAR(32) NOT NULL, "
+    "content TEXT NOT NULL, "
+    "created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS tickets ("
+    "id VARCHAR(36) PRIMARY KEY, "
+    "chat_id VARCHAR(36) NOT NULL REFERENCES chats (id), "
+    "status VARCHAR(64) NOT NULL, "
+    "category VARCHAR(128) NOT NULL, "
+    "assigned_agent_id VARCHAR(36), "
+    "priority INTEGER NOT NULL, "
+    "created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL, "
+    "updated_at TIMESTAMP WITHOUT TIME ZONE NOT NULL)",
+    # Zapier MCP переехал на уровень аккаунта
+    "ALTER TABLE chats DROP COLUMN IF EXISTS zapier_mcp_server_url",
+    "ALTER TABLE chats DROP COLUMN IF EXISTS zapier_mcp_secret",
+]
+
+
+async def upgrade(conn) -> None:
+    for sql in STATEMENTS:
+        await conn.execute(text(sql))
@@ -0,0 +1,49 @@
+"""Indexes for hot query paths; unique tickets.chat_id (removes duplicate tickets left by the send race)."""
+from sqlalchemy import text
+
+from app.storage.migrations import drop_if_invalid
+
+VERSION = 1
+DESCRIPTION = "hot path indexes, unique tickets.chat_id"
+TRANSACTIONAL = False
+
+# name -> CREATE statement (must match __table_args__ in app/storage/models.py)
+INDEXES = {
+    # messages_for_chat / selectinload(ChatModel.messages): WHERE chat_id ORDER BY created_at
+    "ix_messages_chat_id_created_at":
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_messages_chat_id_created_at ON messages (chat_id, created_at)",
+    # ticket_list: WHERE status ORDER BY updated_at DESC (backward scan)
+    "ix_tickets_status_updated_at":
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_tickets_status_updated_at ON tickets (status, updated_at)",
+    # ticket_list without status filter
+    "ix_tickets_updated_at":
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_tickets_updated_at ON tickets (updated_at)",
+    # chat_list for a channel user: WHERE channel, external_id ORDER BY updated_at DESC
+    "ix_chats_channel_external_updated":
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_chats_channel_external_updated "
+        "ON chats (channel, external_id, updated_at)",
+    # ticket_get_by_chat; backs the uq_tickets_chat_id constraint
+    "uq_tickets_chat_id":
+        "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_tickets_chat_id ON tickets (chat_id)",
+}
+
+
+async def upgrade(conn) -> None:
+    # Дубликаты тикетов из гонки в /send: оставляем самый ранний тикет чата
+    await conn.execute(text(
+        "DELETE FROM tickets t USING tickets older "
+        "WHERE t.chat_id = older.chat_id "
+        "AND (older.created_at, older.id) < (t.created_at, t.id)"
+    ))
+    for name, sql in INDEXES.items():
+        await drop_if_invalid(conn, name)
+        await conn.execute(text(sql))
+    r = await conn.execute(text(
+        "SELECT 1 FROM pg_constraint WHERE conname = 'uq_tickets_chat_id' "
+        "AND conrelid = 'tickets'::regclass"
+    ))
+    if not r.scalar():
+        # Constraint поверх готового индекса — без повторного сканирования таблицы
+        await conn.execute(text(
+            "ALTER TABLE tickets ADD CONSTRAINT uq_tickets_chat_id UNIQUE USING INDEX uq_tickets_chat_id"
+        ))
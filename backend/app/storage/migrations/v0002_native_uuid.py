@@ -0,0 +1,209 @@
+"""
+Native uuid keys instead of VARCHAR(36), converted online (no table rewrite under an exclusive lock):
+  1. add shadow <col>_new uuid columns, kept in sync for new writes by a trigger;
+  2. backfill existing rows in small batches;
+  3. build replacement indexes CONCURRENTLY and validate NOT NULL checks while the app keeps writing;
+  4. swap columns, primary keys and foreign keys in one short transaction (metadata only);
+  5. validate the re-created foreign keys (online).
+Every step is idempotent, so a failed run can simply be restarted.
+"""
+import asyncio
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from app.storage.migrations import drop_if_invalid
+
+VERSION = 2
+DESCRIPTION = "native uuid primary and foreign keys"
+TRANSACTIONAL = False
+
+logger = logging.getLogger(__name__)
+
+# table -> id-carrying columns (the first one is the primary key)
+COLUMNS = {
+    "agents": ["id"],
+    "accounts": ["id"],
+    "chats": ["id", "agent_id"],
+    "messages": ["id", "chat_id"],
+    "tickets": ["id", "chat_id", "assigned_agent_id"],
+}
+NOT_NULL = {("messages", "chat_id"), ("tickets", "chat_id")} | {(t, "id") for t in COLUMNS}
+# (table, column, referenced table); names follow Postgres' default <table>_<column>_fkey
+FOREIGN_KEYS = [("chats", "agent_id", "agents"), ("messages", "chat_id", "chats"), ("tickets", "chat_id", "chats")]
+# indexes over converted columns, rebuilt on the shadow column: name -> (table, CREATE statement)
+INDEXES = {
+    "ix_messages_chat_id_created_at": (
+        "messages",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_messages_chat_id_created_at_new "
+        "ON messages (chat_id_new, created_at)",
+    ),
+    "uq_tickets_chat_id": (
+        "tickets",
+        "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_tickets_chat_id_new ON tickets (chat_id_new)",
+    ),
+}
+BATCH_SIZE = 5000
+SWAP_LOCK_TIMEOUT = "5s"
+SWAP_ATTEMPTS = 10
+
+TRY_UUID_SQL = (
+    "CREATE OR REPLACE FUNCTION agiens_try_uuid(v text) RETURNS uuid LANGUAGE sql IMMUTABLE AS $$ "
+    "SELECT CASE WHEN v ~* '^[0-9a-f]{8}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{12}$' "
+    "THEN v::uuid END $$"
+)
+
+
+def _assignments(table: str, prefix: str = "") -> str:
+    return ", ".join(f"{c}_new = agiens_try_uuid({prefix}{c})" for c in COLUMNS[table])
+
+
+async def _column_type(conn, table: str, column: str) -> str | None:
+    r = await conn.execute(
+        text(
+            "SELECT data_type FROM information_schema.columns "
+            "WHERE table_schema = current_schema() AND table_name = :t AND column_name = :c"
+        ),
+        {"t": table, "c": column},
+    )
+    return r.scalar()
+
+
+async def _prepare(conn) -> None:
+    """Steps 1-3: shadow columns, sync triggers, backfill, indexes, validated NOT NULL checks."""
+    await conn.execute(text(TRY_UUID_SQL))
+    for table, cols in COLUMNS.items():
+        for c in cols:
+            await conn.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {c}_new uuid"))
+        await conn.execute(text(
+            f"CREATE OR REPLACE FUNCTION agiens_uuid_sync_{table}() RETURNS trigger LANGUAGE plpgsql AS $$ "
+            f"BEGIN {'; '.join(f'NEW.{c}_new := agiens_try_uuid(NEW.{c})' for c in cols)}; RETURN NEW; END $$"
+        ))
+        exists = await conn.execute(
+            text("SELECT 1 FROM pg_trigger WHERE tgname = :n AND tgrelid = CAST(:t AS regclass)"),
+            {"n": f"agiens_uuid_sync_{table}", "t": table},
+        )
+        if not exists.scalar():
+            await conn.execute(text(
+                f"CREATE TRIGGER agiens_uuid_sync_{table} BEFORE INSERT OR UPDATE ON {table} "
+                f"FOR EACH ROW EXECUTE FUNCTION agiens_uuid_sync_{table}()"
+            ))
+
+    # Бэкфилл мелкими батчами: каждая пачка — отдельная короткая транзакция (AUTOCOMMIT)
+    for table in COLUMNS:
+        total = 0
+        while True:
+            r = await conn.execute(
+                text(
+                    f"UPDATE {table} SET {_assignments(table)} WHERE id IN ("
+                    f"SELECT id FROM {table} WHERE id_new IS NULL AND agiens_try_uuid(id) IS NOT NULL "
+                    f"LIMIT :n)"
+                ),
+                {"n": BATCH_SIZE},
+            )
+            if not r.rowcount:
+                break
+            total += r.rowcount
+        logger.info("Backfilled %s: %d rows", table, total)
+
+    for table in COLUMNS:
+        await drop_if_invalid(conn, f"{table}_id_new_key")
+        await conn.execute(text(
+            f"CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {table}_id_new_key ON {table} (id_new)"
+        ))
+    for name, (_table, sql) in INDEXES.items():
+        await drop_if_invalid(conn, f"{name}_new")
+        await conn.execute(text(sql))
+
+    # CHECK ... NOT VALID + VALIDATE не блокирует запись; потом SET NOT NULL обходится без скана таблицы
+    for table, column in sorted(NOT_NULL):
+        check = f"{table}_{column}_new_not_null"
+        r = await conn.execute(
+            text("SELECT 1 FROM pg_constraint WHERE conname = :n AND conrelid = CAST(:t AS regclass)"),
+            {"n": check, "t": table},
+        )
+        if not r.scalar():
+            await conn.execute(text(
+                f"ALTER TABLE {table} ADD CONSTRAINT {check} CHECK ({column}_new IS NOT NULL) NOT VALID"
+            ))
+        await conn.execute(text(f"ALTER TABLE {table} VALIDATE CONSTRAINT {check}"))
+
+
+async def _swap(conn) -> None:
+    """Step 4, inside one transaction: every statement here is a catalog-only change."""
+    await conn.execute(text(f"SET LOCAL lock_timeout = '{SWAP_LOCK_TIMEOUT}'"))
+    await conn.execute(text(f"LOCK TABLE {', '.join(COLUMNS)} IN ACCESS EXCLUSIVE MODE"))
+    for table in COLUMNS:
+        # Догоняем строки, записанные до появления триггера (обычно ни одной)
+        await conn.execute(text(f"UPDATE {table} SET {_assignments(table)} WHERE id_new IS NULL"))
+        await conn.execute(text(f"DROP TRIGGER IF EXISTS agiens_uuid_sync_{table} ON {table}"))
+        await conn.execute(text(f"DROP FUNCTION IF EXISTS agiens_uuid_sync_{table}()"))
+
+    r = await conn.execute(text(
+        "SELECT conrelid::regclass::text, conname FROM pg_constraint "
+        f"WHERE contype = 'f' AND conrelid = ANY (ARRAY[{', '.join(repr(t) for t in COLUMNS)}]::regclass[])"
+    ))
+    for table, name in r.all():
+        await conn.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"'))
+
+    for table, cols in COLUMNS.items():
+        r = await conn.execute(
+            text("SELECT conname FROM pg_constraint WHERE contype = 'p' AND conrelid = CAST(:t AS regclass)"),
+            {"t": table},
+        )
+        for (pkey,) in r.all():
+            await conn.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT "{pkey}"'))
+        for c in cols:
+            if (table, c) in NOT_NULL:
+                await conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {c}_new SET NOT NULL"))
+                await conn.execute(text(f"ALTER TABLE {table} DROP CONSTRAINT {table}_{c}_new_not_null"))
+            # DROP COLUMN — только каталог; зависимые старые индексы удаляются вместе с колонкой
+            await conn.execute(text(f"ALTER TABLE {table} DROP COLUMN {c}"))
+            await conn.execute(text(f"ALTER TABLE {table} RENAME COLUMN {c}_new TO {c}"))
+        await conn.execute(text(
+            f"ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY USING INDEX {table}_id_new_key"
+        ))
+
+    await conn.execute(text(
+        "ALTER INDEX ix_messages_chat_id_created_at_new RENAME TO ix_messages_chat_id_created_at"
+    ))
+    await conn.execute(text(
+        "ALTER TABLE tickets ADD CONSTRAINT uq_tickets_chat_id UNIQUE USING INDEX uq_tickets_chat_id_new"
+    ))
+    for table, column, ref in FOREIGN_KEYS:
+        await conn.execute(text(
+            f"ALTER TABLE {table} ADD CONSTRAINT {table}_{column}_fkey "
+            f"FOREIGN KEY ({column}) REFERENCES {ref} (id) NOT VALID"
+        ))
+    await conn.execute(text("DROP FUNCTION IF EXISTS agiens_try_uuid(text)"))
+
+
+async def _validate_foreign_keys(conn) -> None:
+    """Step 5: VALIDATE takes SHARE UPDATE EXCLUSIVE only, reads and writes continue."""
+    for table, column, _ref in FOREIGN_KEYS:
+        r = await conn.execute(
+            text(
+                "SELECT NOT convalidated FROM pg_constraint "
+                "WHERE conname = :n AND conrelid = CAST(:t AS regclass)"
+            ),
+            {"n": f"{table}_{column}_fkey", "t": table},
+        )
+        if r.scalar():
+            await conn.execute(text(f"ALTER TABLE {table} VALIDATE CONSTRAINT {table}_{column}_fkey"))
+
+
+async def upgrade(conn) -> None:
+    if await _column_type(conn, "accounts", "id") != "uuid":
+        await _prepare(conn)
+        for attempt in range(1, SWAP_ATTEMPTS + 1):
+            try:
+                async with conn.engine.begin() as tx:
+                    await _swap(tx)
+                break
+            except DBAPIError as e:
+                if "lock timeout" not in str(e) or attempt == SWAP_ATTEMPTS:
+                    raise
+                logger.warning("Swap could not take table locks (attempt %d); retrying", attempt)
+                await asyncio.sleep(attempt)
+    await _validate_foreign_keys(conn)
@@ -0,0 +1,117 @@
+"""
+Per-chat monotonic messages.seq. The database assigns it on insert: trigger messages_assign_seq bumps
+chats.last_seq (row lock, so concurrent inserts into one chat get consecutive numbers in commit order).
+Existing chats start with last_seq NULL = "not numbered yet": the trigger skips them, and the backfill numbers
+their messages by (created_at, id) in batches of chats. Numbers that are already assigned are never changed,
+so the migration can be re-run, and replicas still on the old code get numbers as soon as their chat is done.
+"""
+from sqlalchemy import text
+
+from app.storage.migrations import drop_if_invalid
+
+VERSION = 3
+DESCRIPTION = "per-chat message seq"
+TRANSACTIONAL = False
+
+CHAT_BATCH = 500
+
+TRIGGER_FUNCTION = (
+    "CREATE OR REPLACE FUNCTION messages_assign_seq() RETURNS trigger LANGUAGE plpgsql AS $$ "
+    "BEGIN "
+    "IF NEW.seq IS NULL THEN "
+    "UPDATE chats SET last_seq = last_seq + 1 WHERE id = NEW.chat_id AND last_seq IS NOT NULL "
+    "RETURNING last_seq INTO NEW.seq; "
+    "END IF; "
+    "RETURN NEW; "
+    "END $$"
+)
+
+
+async def _number_chats(conn, chat_ids: list) -> None:
+    """Number the still unnumbered messages of these chats after their last_seq, then advance last_seq."""
+    # FOR UPDATE на чатах: вставки через триггер ждут, пока батч не пронумерован
+    await conn.execute(text("SELECT 1 FROM chats WHERE id = ANY(:ids) ORDER BY id FOR UPDATE"), {"ids": chat_ids})
+    await conn.execute(
+        text(
+            "UPDATE messages m SET seq = n.seq FROM ("
+            "SELECT m2.id, COALESCE(c.last_seq, 0) "
+            "+ row_number() OVER (PARTITION BY m2.chat_id ORDER BY m2.created_at, m2.id) AS seq "
+            "FROM messages m2 JOIN chats c ON c.id = m2.chat_id "
+            "WHERE m2.chat_id = ANY(:ids) AND m2.seq IS NULL) n "
+            "WHERE m.id = n.id"
+        ),
+        {"ids": chat_ids},
+    )
+    await conn.execute(
+        text(
+            "UPDATE chats c SET last_seq = COALESCE((SELECT max(seq) FROM messages WHERE chat_id = c.id), 0) "
+            "WHERE id = ANY(:ids)"
+        ),
+        {"ids": chat_ids},
+    )
+
+
+async def _set_not_null(conn, table: str, column: str) -> None:
+    """NOT NULL без долгой блокировки: CHECK NOT VALID -> VALIDATE -> SET NOT NULL (без скана)."""
+    r = await conn.execute(
+        text(
+            "SELECT is_nullable = 'YES' FROM information_schema.columns "
+            "WHERE table_schema = current_schema() AND table_name = :t AND column_name = :c"
+        ),
+        {"t": table, "c": column},
+    )
+    if not r.scalar():
+        return
+    check = f"{table}_{column}_not_null"
+    r = await conn.execute(
+        text("SELECT 1 FROM pg_constraint WHERE conname = :n AND conrelid = CAST(:t AS regclass)"),
+        {"n": check, "t": table},
+    )
+    if not r.scalar():
+        await conn.execute(text(f"ALTER TABLE {table} ADD CONSTRAINT {check} CHECK ({column} IS NOT NULL) NOT VALID"))
+    await conn.execute(text(f"ALTER TABLE {table} VALIDATE CONSTRAINT {check}"))
+    await conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL"))
+    await conn.execute(text(f"ALTER TABLE {table} DROP CONSTRAINT {check}"))
+
+
+async def upgrade(conn) -> None:
+    # Без DEFAULT: у существующих чатов last_seq = NULL («ещё не пронумерован»)
+    await conn.execute(text("ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_seq INTEGER"))
+    await conn.execute(text("ALTER TABLE messages ADD COLUMN IF NOT EXISTS seq INTEGER"))
+    await conn.execute(text(TRIGGER_FUNCTION))
+    r = await conn.execute(text(
+        "SELECT 1 FROM pg_trigger WHERE tgname = 'messages_assign_seq' AND tgrelid = 'messages'::regclass"
+    ))
+    if not r.scalar():
+        await conn.execute(text(
+            "CREATE TRIGGER messages_assign_seq BEFORE INSERT ON messages "
+            "FOR EACH ROW EXECUTE FUNCTION messages_assign_seq()"
+        ))
+    # Новые чаты (уже под триггером) сразу нумеруются с 1
+    await conn.execute(text("ALTER TABLE chats ALTER COLUMN last_seq SET DEFAULT 0"))
+
+    # Бэкфилл пачками чатов, каждая пачка — своя короткая транзакция
+    while True:
+        r = await conn.execute(
+            text("SELECT id FROM chats WHERE last_seq IS NULL ORDER BY id LIMIT :n"), {"n": CHAT_BATCH}
+        )
+        chat_ids = [row[0] for row in r]
+        if not chat_ids:
+            break
+        async with conn.engine.begin() as tx:
+            await _number_chats(tx, chat_ids)
+    # Вставки, начатые до блокировки чата и закоммиченные после его нумерации, остались без seq
+    r = await conn.execute(text("SELECT DISTINCT chat_id FROM messages WHERE seq IS NULL"))
+    chat_ids = [row[0] for row in r]
+    if chat_ids:
+        async with conn.engine.begin() as tx:
+            await _number_chats(tx, chat_ids)
+
+    await drop_if_invalid(conn, "uq_messages_chat_id_seq")
+    await conn.execute(text(
+        "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_messages_chat_id_seq ON messages (chat_id, seq)"
+    ))
+    # История читается по seq; индекс по created_at из v0001 больше не нужен
+    await conn.execute(text("DROP INDEX CONCURRENTLY IF EXISTS ix_messages_chat_id_created_at"))
+    await _set_not_null(conn, "chats", "last_seq")
+    await _set_not_null(conn, "messages", "seq")
@@ -0,0 +1,66 @@
+"""
+Full-text search over messages: messages.search_vector (tsvector) kept up to date by a trigger on insert and on
+content updates, backfilled in keyset batches by id, with a GIN index built CONCURRENTLY. Online and re-runnable.
+"""
+import logging
+
+from sqlalchemy import text
+
+from app.storage.migrations import drop_if_invalid
+
+logger = logging.getLogger(__name__)
+
+VERSION = 4
+DESCRIPTION = "message full-text search"
+TRANSACTIONAL = False
+
+BATCH_SIZE = 5000
+
+# 'russian' стеммит кириллицу, а латиницу (asciiword) — english_stem, так что годится для смешанных текстов.
+# Должно совпадать с SEARCH_CONFIG в app/storage/repositories.py
+TRIGGER_FUNCTION = (
+    "CREATE OR REPLACE FUNCTION messages_search_vector() RETURNS trigger LANGUAGE plpgsql AS $$ "
+    "BEGIN "
+    # tsvector ограничен 1 МБ: очень длинные сообщения индексируем по началу
+    "NEW.search_vector := to_tsvector('russian', left(NEW.content, 100000)); "
+    "RETURN NEW; "
+    "END $$"
+)
+
+
+async def upgrade(conn) -> None:
+    await conn.execute(text("ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector"))
+    await conn.execute(text(TRIGGER_FUNCTION))
+    r = await conn.execute(text(
+        "SELECT 1 FROM pg_trigger WHERE tgname = 'messages_search_vector' AND tgrelid = 'messages'::regclass"
+    ))
+    if not r.scalar():
+        await conn.execute(text(
+            "CREATE TRIGGER messages_search_vector BEFORE INSERT OR UPDATE OF content ON messages "
+            "FOR EACH ROW EXECUTE FUNCTION messages_search_vector()"
+        ))
+
+    # Бэкфилл: keyset по первичному ключу, без повторного скана уже обработанной части таблицы
+    total = 0
+    last_id = None
+    while True:
+        after = "WHERE id > :last " if last_id is not None else ""
+        r = await conn.execute(
+            text(
+                f"WITH batch AS (SELECT id FROM messages {after}ORDER BY id LIMIT :n), "
+                "upd AS (UPDATE messages m SET search_vector = to_tsvector('russian', left(m.content, 100000)) "
+                "FROM batch WHERE m.id = batch.id AND m.search_vector IS NULL RETURNING 1) "
+                "SELECT (SELECT id FROM batch ORDER BY id DESC LIMIT 1), (SELECT count(*) FROM upd)"
+            ),
+            {"last": last_id, "n": BATCH_SIZE},
+        )
+        last_id, updated = r.one()
+        if last_id is None:
+            break
+        total += updated
+    logger.info("Backfilled messages.search_vector: %d rows", total)
+
+    await drop_if_invalid(conn, "ix_messages_search_vector")
+    await conn.execute(text(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_messages_search_vector ON messages USING gin (search_vector)"
+    ))
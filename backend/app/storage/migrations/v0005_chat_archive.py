@@ -0,0 +1,20 @@
+"""Cold-chat archive stub on chats (archived_at, archive_key, archive_preview) and the archive job's candidate index."""
+from sqlalchemy import text
+
+from app.storage.migrations import drop_if_invalid
+
+VERSION = 5
+DESCRIPTION = "chat archive stub"
+TRANSACTIONAL = False
+
+
+async def upgrade(conn) -> None:
+    # Nullable без DEFAULT: только каталог, без переписывания таблицы
+    await conn.execute(text("ALTER TABLE chats ADD COLUMN IF NOT EXISTS archived_at TIMESTAMP WITHOUT TIME ZONE"))
+    await conn.execute(text("ALTER TABLE chats ADD COLUMN IF NOT EXISTS archive_key VARCHAR(255)"))
+    await conn.execute(text("ALTER TABLE chats ADD COLUMN IF NOT EXISTS archive_preview VARCHAR(512)"))
+    await drop_if_invalid(conn, "ix_chats_updated_at_not_archived")
+    await conn.execute(text(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_chats_updated_at_not_archived "
+        "ON chats (updated_at) WHERE archived_at IS NULL"
+    ))
@@ -0,0 +1,36 @@
+"""
+Shard map for hash sharding (app/storage/sharding.py): bucket -> shard, plus the sharding epoch. Only the tables
+in the main database are used. agiens_shard_bucket(id) is the bucket (low 10 bits of a chat id) for the rebalancer's index.
+"""
+from sqlalchemy import text
+
+from app.storage.migrations import drop_if_invalid
+
+VERSION = 6
+DESCRIPTION = "shard map"
+TRANSACTIONAL = False
+
+SHARD_BUCKET_FUNCTION = (
+    # Младшие 10 бит uuid: последние 3 hex-цифры, маска 1023
+    "CREATE OR REPLACE FUNCTION agiens_shard_bucket(id uuid) RETURNS integer LANGUAGE sql IMMUTABLE PARALLEL SAFE "
+    "AS $$ SELECT ('x' || right(id::text, 3))::bit(12)::integer & 1023 $$"
+)
+
+
+async def upgrade(conn) -> None:
+    await conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS shard_map ("
+        "bucket INTEGER PRIMARY KEY, "
+        "shard VARCHAR(64) NOT NULL, "
+        # moving: ведро переносится, запись в него отклоняется (ShardMovingError)
+        "moving BOOLEAN NOT NULL DEFAULT false)"
+    ))
+    await conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS shard_state (key VARCHAR(64) PRIMARY KEY, value VARCHAR(255) NOT NULL)"
+    ))
+    await conn.execute(text(SHARD_BUCKET_FUNCTION))
+    # Ребалансировщик выбирает чаты ведра: WHERE agiens_shard_bucket(id) = :bucket
+    await drop_if_invalid(conn, "ix_chats_shard_bucket")
+    await conn.execute(text(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_chats_shard_bucket ON chats (agiens_shard_bucket(id))"
+    ))
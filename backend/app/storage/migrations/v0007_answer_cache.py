@@ -0,0 +1,12 @@
+"""Opt-in answer cache per agent (agents.answer_cache) and reply provenance on messages (messages.provenance)."""
+from sqlalchemy import text
+
+VERSION = 7
+DESCRIPTION = "agent answer cache, message provenance"
+TRANSACTIONAL = True
+
+
+async def upgrade(conn) -> None:
+    # Константный DEFAULT и nullable без DEFAULT: только каталог, без переписывания таблиц
+    await conn.execute(text("ALTER TABLE agents ADD COLUMN IF NOT EXISTS answer_cache BOOLEAN NOT NULL DEFAULT false"))
+    await conn.execute(text("ALTER TABLE messages ADD COLUMN IF NOT EXISTS provenance VARCHAR(255)"))
@@ -1,23 +1,95 @@
 """SQLAlchemy models for accounts, chats, messages, agents, tickets."""
+import hashlib
+import os
+import time
 import uuid
 from datetime import datetime
 from typing import Optional
 
-from sqlalchemy import DateTime, ForeignKey, String, Text, Integer, UniqueConstraint
+from sqlalchemy import (
+    Boolean, DateTime, FetchedValue, ForeignKey, Index, String, Text, Integer, UniqueConstraint, Uuid, text
+)
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from app.storage.db import Base
 
+_NIL_UUID = uuid.UUID(int=0)
+
+
+def uuid7() -> uuid.UUID:
+    """UUIDv7 (RFC 9562): 48-bit Unix ms timestamp + 74 random bits. Time-ordered, so B-tree inserts stay local."""
+    ms = time.time_ns() // 1_000_000
+    rand = int.from_bytes(os.urandom(10), "big")
+    return uuid.UUID(int=(
+        (ms & 0xFFFF_FFFF_FFFF) << 80
+        | 0x7 << 76
+        | ((rand >> 62) & 0xFFF) << 64
+        | 0b10 << 62
+        | (rand & ((1 << 62) - 1))
+    ))
+
 
 def gen_uuid() -> str:
-    return str(uuid.uuid4())
+    return str(uuid7())
+
+
+# Shard bucket of a chat (app/storage/sharding.py) = the low 10 bits of its id. A channel user's chats get ids in the
+# bucket of (channel, external_id), so they stay together; messages and tickets follow their chat_id
+SHARD_BUCKETS = 1024
+
+
+def user_shard_bucket(channel: str, external_id: str) -> int:
+    digest = hashlib.blake2b(f"{channel}:{external_id}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % SHARD_BUCKETS
+
+
+def gen_uuid_in_bucket(bucket: int) -> str:
+    """UUIDv7 whose low bits are `bucket` (version, variant and timestamp stay intact)."""
+    return str(uuid.UUID(int=(uuid7().int & ~(SHARD_BUCKETS - 1)) | bucket))
+
+
+def new_chat_id(channel: Optional[str] = None, external_id: Optional[str] = None) -> str:
+    if channel is None or external_id is None:
+        return gen_uuid()
+    return gen_uuid_in_bucket(user_shard_bucket(channel, external_id))
+
+
+def _chat_id_default(context) -> str:
+    params = context.get_current_parameters()
+    return new_chat_id(params.get("channel"), params.get("external_id"))
+
+
+class UUIDStr(TypeDecorator):
+    """
+    Native Postgres UUID column exposed to Python (and the API) as str.
+    A malformed id binds as the nil UUID, so a lookup by a bad id finds nothing instead of raising a DB error.
+    """
+
+    impl = Uuid
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        return dialect.type_descriptor(Uuid(as_uuid=True))
+
+    def process_bind_param(self, value, dialect):
+        if value is None or isinstance(value, uuid.UUID):
+            return value
+        try:
+            return uuid.UUID(str(value))
+        except ValueError:
+            return _NIL_UUID
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else str(value)
 
 
 class AccountModel(Base):
     """User account by channel (e.g. telegram) + external_id. Zapier MCP stored here for all user's chats."""
     __tablename__ = "accounts"
 
-    id: Mapped[str] = mapped_column(String(36), primary_key=True, default=gen_uuid)
+    id: Mapped[str] = mapped_column(UUIDStr, primary_key=True, default=gen_uuid)
     channel: Mapped[str] = mapped_column(String(64), nullable=False, index=True)
     external_id: Mapped[str] = mapped_column(String(255), nullable=False, index=True)
     zapier_mcp_server_url: Mapped[Optional[str]] = mapped_column(String(2048), nullable=True)
@@ -31,7 +103,7 @@ class AccountModel(Base):
 class AgentModel(Base):
     __tablename__ = "agents"
 
-    id: Mapped[str] = mapped_column(String(36), primary_key=True, default=gen_uuid)
+    id: Mapped[str] = mapped_column(UUIDStr, primary_key=True, default=gen_uuid)
     name: Mapped[str] = mapped_column(String(255), nullable=False)
     description: Mapped[str] = mapped_column(Text, default="")
     icon: Mapped[str] = mapped_column(String(64), default="")
@@ -39,45 +111,79 @@ class AgentModel(Base):
     model_id: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
     # Comma-separated categories this agent handles (e.g. "technical,billing") for ticket routing
     supported_categories: Mapped[Optional[str]] = mapped_column(String(512), nullable=True)
+    # Near-duplicate first messages get a stored answer without an LLM call (app/services/answer_cache.py)
+    answer_cache: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False, server_default=text("false"))
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
 
 class ChatModel(Base):
     __tablename__ = "chats"
 
-    id: Mapped[str] = mapped_column(String(36), primary_key=True, default=gen_uuid)
+    id: Mapped[str] = mapped_column(UUIDStr, primary_key=True, default=_chat_id_default)
     title: Mapped[str] = mapped_column(String(512), default="New chat")
     model_id: Mapped[str] = mapped_column(String(255), default="openrouter/auto")
-    agent_id: Mapped[Optional[str]] = mapped_column(String(36), ForeignKey("agents.id"), nullable=True)
+    agent_id: Mapped[Optional[str]] = mapped_column(UUIDStr, ForeignKey("agents.id"), nullable=True)
     # Multi-channel: telegram, whatsapp, etc.
     channel: Mapped[Optional[str]] = mapped_column(String(64), nullable=True, index=True)
     external_id: Mapped[Optional[str]] = mapped_column(String(255), nullable=True, index=True)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Last assigned messages.seq; bumped by the messages_assign_seq trigger (migration v0003), not by the app
+    last_seq: Mapped[int] = mapped_column(Integer, nullable=False, server_default="0")
+    # Archive stub (app/storage/archive.py): messages live in segment archive_key until the chat is opened again
+    archived_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    archive_key: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    archive_preview: Mapped[Optional[str]] = mapped_column(String(512), nullable=True)
+
+    messages: Mapped[list["MessageModel"]] = relationship("MessageModel", back_populates="chat", order_by="MessageModel.seq")
 
-    messages: Mapped[list["MessageModel"]] = relationship("MessageModel", back_populates="chat", order_by="MessageModel.created_at")
+    # Hot path indexes are created on existing DBs by migration v0001 (CONCURRENTLY)
+    __table_args__ = (
+        Index("ix_chats_channel_external_updated", "channel", "external_id", "updated_at"),
+        # Archive job candidates: WHERE archived_at IS NULL AND updated_at < cutoff
+        Index("ix_chats_updated_at_not_archived", "updated_at", postgresql_where=text("archived_at IS NULL")),
+    )
 
 
 class MessageModel(Base):
     __tablename__ = "messages"
 
-    id: Mapped[str] = mapped_column(String(36), primary_key=True, default=gen_uuid)
-    chat_id: Mapped[str] = mapped_column(String(36), ForeignKey("chats.id"), nullable=False)
+    id: Mapped[str] = mapped_column(UUIDStr, primary_key=True, default=gen_uuid)
+    chat_id: Mapped[str] = mapped_column(UUIDStr, ForeignKey("chats.id"), nullable=False)
     role: Mapped[str] = mapped_column(String(32), nullable=False)  # user, assistant, system
     content: Mapped[str] = mapped_column(Text, nullable=False)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    # Per-chat 1, 2, 3… assigned by the database on insert (trigger messages_assign_seq), returned via RETURNING
+    seq: Mapped[int] = mapped_column(Integer, nullable=False, server_default=FetchedValue())
+    # Where a reply came from when it is not a fresh LLM answer, e.g. "answer_cache:<entry>:<similarity>"
+    provenance: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    # Full-text search, set from content by trigger messages_search_vector; deferred so history loads skip it
+    search_vector: Mapped[Optional[str]] = mapped_column(
+        TSVECTOR, nullable=True, server_default=FetchedValue(), deferred=True
+    )
 
     chat: Mapped["ChatModel"] = relationship("ChatModel", back_populates="messages")
 
+    __table_args__ = (
+        Index("uq_messages_chat_id_seq", "chat_id", "seq", unique=True),
+        Index("ix_messages_search_vector", "search_vector", postgresql_using="gin"),
+    )
+
 
 class TicketModel(Base):
     __tablename__ = "tickets"
 
-    id: Mapped[str] = mapped_column(String(36), primary_key=True, default=gen_uuid)
-    chat_id: Mapped[str] = mapped_column(String(36), ForeignKey("chats.id"), nullable=False)
+    id: Mapped[str] = mapped_column(UUIDStr, primary_key=True, default=gen_uuid)
+    chat_id: Mapped[str] = mapped_column(UUIDStr, ForeignKey("chats.id"), nullable=False)
     status: Mapped[str] = mapped_column(String(64), default="open")  # open, assigned, resolved, escalated
     category: Mapped[str] = mapped_column(String(128), default="general")
-    assigned_agent_id: Mapped[Optional[str]] = mapped_column(String(36), nullable=True)
+    assigned_agent_id: Mapped[Optional[str]] = mapped_column(UUIDStr, nullable=True)
     priority: Mapped[int] = mapped_column(Integer, default=0)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint("chat_id", name="uq_tickets_chat_id"),
+        Index("ix_tickets_status_updated_at", "status", "updated_at"),
+        Index("ix_tickets_updated_at", "updated_at"),
+    )
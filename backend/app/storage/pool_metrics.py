@@ -0,0 +1,117 @@
+"""
+Connection pool metrics: checkout wait time, timeouts and saturation per engine ("primary", "replica"),
+rendered in Prometheus text format by GET /metrics.
+"""
+import time
+from typing import Optional
+
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+# Верхние границы бакетов гистограммы ожидания соединения, секунды
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class CheckoutStats:
+    def __init__(self) -> None:
+        self.bucket_counts = [0] * len(WAIT_BUCKETS)
+        self.count = 0
+        self.total_seconds = 0.0
+        self.timeouts = 0
+
+    def observe(self, seconds: float) -> None:
+        self.count += 1
+        self.total_seconds += seconds
+        for i, bound in enumerate(WAIT_BUCKETS):
+            if seconds <= bound:
+                self.bucket_counts[i] += 1
+                break
+
+
+_stats: dict[str, CheckoutStats] = {}
+_pools: dict[str, "InstrumentedPool"] = {}
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """QueuePool that times every checkout (including the wait for a free connection). Set metrics_name."""
+
+    metrics_name = "primary"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # engine.dispose() пересоздаёт пул тем же классом: метрики продолжают копиться под тем же именем
+        _pools[self.metrics_name] = self
+        _stats.setdefault(self.metrics_name, CheckoutStats())
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            _stats[self.metrics_name].timeouts += 1
+            raise
+        finally:
+            _stats[self.metrics_name].observe(time.perf_counter() - started)
+
+
+def instrumented_pool_class(name: str) -> type[InstrumentedPool]:
+    return type(f"InstrumentedPool_{name}", (InstrumentedPool,), {"metrics_name": name})
+
+
+def pool_snapshot(name: str) -> Optional[dict]:
+    pool = _pools.get(name)
+    if pool is None:
+        return None
+    capacity = pool.size() + max(pool._max_overflow, 0)
+    checked_out = pool.checkedout()
+    return {
+        "size": pool.size(),
+        "max_overflow": pool._max_overflow,
+        "checked_out": checked_out,
+        "idle": pool.checkedin(),
+        "saturation": checked_out / capacity if capacity else 0.0,
+    }
+
+
+def render_prometheus() -> str:
+    lines = [
+        "# HELP agiens_db_pool_checked_out Connections currently checked out of the pool",
+        "# TYPE agiens_db_pool_checked_out gauge",
+    ]
+    snapshots = {name: pool_snapshot(name) for name in _pools}
+    for name, snap in snapshots.items():
+        lines.append(f'agiens_db_pool_checked_out{{pool="{name}"}} {snap["checked_out"]}')
+    lines += ["# HELP agiens_db_pool_idle Idle connections in the pool", "# TYPE agiens_db_pool_idle gauge"]
+    for name, snap in snapshots.items():
+        lines.append(f'agiens_db_pool_idle{{pool="{name}"}} {snap["idle"]}')
+    lines += [
+        "# HELP agiens_db_pool_capacity pool_size + max_overflow",
+        "# TYPE agiens_db_pool_capacity gauge",
+    ]
+    for name, snap in snapshots.items():
+        lines.append(f'agiens_db_pool_capacity{{pool="{name}"}} {snap["size"] + max(snap["max_overflow"], 0)}')
+    lines += [
+        "# HELP agiens_db_pool_saturation checked_out / capacity (1.0 = requests queue for a connection)",
+        "# TYPE agiens_db_pool_saturation gauge",
+    ]
+    for name, snap in snapshots.items():
+        lines.append(f'agiens_db_pool_saturation{{pool="{name}"}} {snap["saturation"]:.4f}')
+    lines += [
+        "# HELP agiens_db_pool_checkout_wait_seconds Time to get a connection from the pool",
+        "# TYPE agiens_db_pool_checkout_wait_seconds histogram",
+    ]
+    for name, stats in _stats.items():
+        cumulative = 0
+        for bound, n in zip(WAIT_BUCKETS, stats.bucket_counts):
+            cumulative += n
+            lines.append(f'agiens_db_pool_checkout_wait_seconds_bucket{{pool="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'agiens_db_pool_checkout_wait_seconds_bucket{{pool="{name}",le="+Inf"}} {stats.count}')
+        lines.append(f'agiens_db_pool_checkout_wait_seconds_sum{{pool="{name}"}} {stats.total_seconds:.6f}')
+        lines.append(f'agiens_db_pool_checkout_wait_seconds_count{{pool="{name}"}} {stats.count}')
+    lines += [
+        "# HELP agiens_db_pool_checkout_timeouts_total Checkouts that gave up after DB_POOL_TIMEOUT",
+        "# TYPE agiens_db_pool_checkout_timeouts_total counter",
+    ]
+    for name, stats in _stats.items():
+        lines.append(f'agiens_db_pool_checkout_timeouts_total{{pool="{name}"}} {stats.timeouts}')
+    return "\n".join(lines) + "\n"
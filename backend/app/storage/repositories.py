@@ -1,12 +1,18 @@
 """Repositories for accounts, chats, messages, agents, tickets."""
+import html
 from datetime import datetime
 from typing import Optional
 
-from sqlalchemy import select, update
+from sqlalchemy import Row, and_, func, literal, or_, select, union_all, update
+from sqlalchemy.dialects.postgresql import REAL, REGCONFIG, insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 
-from app.storage.models import AccountModel, AgentModel, ChatModel, MessageModel, TicketModel
+from app.storage.db import get_read_session
+from app.storage.history_cache import remember_message
+from app.storage.models import AccountModel, AgentModel, ChatModel, MessageModel, TicketModel, gen_uuid, new_chat_id
+from app.storage.sharding import bind_to, shard_for_id, shards_for_user
 
 
 # ---------- Accounts ----------
@@ -15,19 +21,30 @@ async def account_get_or_create(
     channel: str,
     external_id: str,
 ) -> AccountModel:
+    """
+    One statement: INSERT ... ON CONFLICT DO NOTHING RETURNING, else the existing row. DO NOTHING rather than
+    DO UPDATE: this runs on every channel reply, and the "already exists" path should not write a row version.
+    """
+    now = datetime.utcnow()
+    inserted = (
+        pg_insert(AccountModel)
+        .values(id=gen_uuid(), channel=channel, external_id=external_id, created_at=now, updated_at=now)
+        .on_conflict_do_nothing(index_elements=[AccountModel.channel, AccountModel.external_id])
+        .returning(*AccountModel.__table__.c)
+        .cte("inserted")
+    )
+    existing = select(AccountModel.__table__).where(
+        AccountModel.channel == channel,
+        AccountModel.external_id == external_id,
+    )
     r = await session.execute(
-        select(AccountModel).where(
-            AccountModel.channel == channel,
-            AccountModel.external_id == external_id,
-        )
+        select(AccountModel).from_statement(union_all(select(inserted), existing).limit(1))
     )
     acc = r.scalar_one_or_none()
     if acc:
         return acc
-    acc = AccountModel(channel=channel, external_id=external_id)
-    session.add(acc)
-    await session.flush()
-    return acc
+    # Конкурентная вставка ещё не была видна снимку этого запроса — теперь закоммичена
+    return await account_get_by_channel(session, channel, external_id)
 
 
 async def account_get(session: AsyncSession, id: str) -> Optional[AccountModel]:
@@ -61,9 +78,10 @@ async def account_set_mcp(
         values["zapier_mcp_server_url"] = server_url.strip() or None
     if secret is not None:
         values["zapier_mcp_secret"] = secret.strip() or None
-    await session.execute(update(AccountModel).where(AccountModel.id == id).values(**values))
-    await session.flush()
-    return await account_get(session, id)
+    r = await session.execute(
+        update(AccountModel).where(AccountModel.id == id).values(**values).returning(AccountModel)
+    )
+    return r.scalar_one_or_none()
 
 
 # ---------- Agents ----------
@@ -96,6 +114,7 @@ async def agent_create(
     system_prompt: str = "",
     model_id: Optional[str] = None,
     supported_categories: Optional[str] = None,
+    answer_cache: bool = False,
 ) -> AgentModel:
     a = AgentModel(
         name=name,
@@ -104,6 +123,7 @@ async def agent_create(
         system_prompt=system_prompt,
         model_id=model_id,
         supported_categories=supported_categories,
+        answer_cache=answer_cache,
     )
     session.add(a)
     await session.flush()
@@ -120,6 +140,7 @@ async def agent_update(
     system_prompt: Optional[str] = None,
     model_id: Optional[str] = None,
     supported_categories: Optional[str] = None,
+    answer_cache: Optional[bool] = None,
 ) -> Optional[AgentModel]:
     values = {}
     if name is not None:
@@ -134,11 +155,14 @@ async def agent_update(
         values["model_id"] = model_id
     if supported_categories is not None:
         values["supported_categories"] = supported_categories
+    if answer_cache is not None:
+        values["answer_cache"] = answer_cache
     if not values:
         return await agent_get(session, id)
-    await session.execute(update(AgentModel).where(AgentModel.id == id).values(**values))
-    await session.flush()
-    return await agent_get(session, id)
+    r = await session.execute(
+        update(AgentModel).where(AgentModel.id == id).values(**values).returning(AgentModel)
+    )
+    return r.scalar_one_or_none()
 
 
 # ---------- Chats ----------
@@ -154,7 +178,8 @@ async def chat_list(
             ChatModel.external_id == external_id,
         )
     r = await session.execute(q)
-    return list(r.scalars().all())
+    # С шардами это склейка результатов нескольких баз: порядок восстанавливаем здесь
+    return sorted(r.scalars().all(), key=lambda c: c.updated_at, reverse=True)
 
 
 async def chat_get(session: AsyncSession, id: str) -> Optional[ChatModel]:
@@ -164,17 +189,46 @@ async def chat_get(session: AsyncSession, id: str) -> Optional[ChatModel]:
     return r.scalar_one_or_none()
 
 
-async def chat_get_with_messages(session: AsyncSession, id: str) -> Optional[ChatModel]:
+async def chat_get_row(session: AsyncSession, id: str) -> Optional[Row]:
+    """Chat header (id, title, model_id, agent_id, archived_at) as a plain row, for read-only endpoints."""
+    r = await session.execute(
+        select(ChatModel.id, ChatModel.title, ChatModel.model_id, ChatModel.agent_id, ChatModel.archived_at)
+        .where(ChatModel.id == id)
+    )
+    return r.one_or_none()
+
+
+async def chat_get_with_messages(session: AsyncSession, id: str, rehydrate: bool = True) -> Optional[ChatModel]:
+    """
+    Chat with all its messages (ordered by seq). An archived chat is rehydrated first, unless rehydrate=False
+    (chat lists: then messages holds only what was written since archiving, see archive_preview).
+    """
     r = await session.execute(
         select(ChatModel)
         .where(ChatModel.id == id)
         .options(selectinload(ChatModel.messages))
     )
+    # messages come ordered by seq (relationship order_by)
     chat = r.scalar_one_or_none()
-    if not chat:
-        return None
-    # messages already loaded via selectinload; keep order by created_at
-    chat.messages.sort(key=lambda m: m.created_at)
+    if chat is not None and chat.archived_at is not None and rehydrate:
+        chat = await _chat_unarchive(chat)
+    return chat
+
+
+async def _chat_unarchive(chat: ChatModel) -> Optional[ChatModel]:
+    from app.storage.archive import load_archived_messages, rehydrate_chat
+
+    if await rehydrate_chat(chat.id):
+        # Перечитываем с primary: сессия вызывающего может смотреть на реплику, которая ещё не догнала
+        async with get_read_session(use_primary=True) as primary:
+            r = await primary.execute(
+                select(ChatModel).where(ChatModel.id == chat.id).options(selectinload(ChatModel.messages))
+            )
+            return r.scalar_one_or_none()
+    # Строку чата держит другая транзакция (или транзакция вызывающего): отдаём архив, ничего не записывая
+    hot_ids = {m.id for m in chat.messages}
+    archived = [MessageModel(**m) for m in await load_archived_messages(chat.archive_key) if m["id"] not in hot_ids]
+    set_committed_value(chat, "messages", sorted([*archived, *chat.messages], key=lambda m: m.seq))
     return chat
 
 
@@ -184,7 +238,7 @@ async def chat_create(
     channel: Optional[str] = None,
     external_id: Optional[str] = None,
 ) -> ChatModel:
-    c = ChatModel(model_id=model_id, channel=channel, external_id=external_id)
+    c = ChatModel(id=new_chat_id(channel, external_id), model_id=model_id, channel=channel, external_id=external_id)
     session.add(c)
     await session.flush()
     return c
@@ -195,13 +249,18 @@ async def chat_get_by_channel(
     channel: str,
     external_id: str,
 ) -> Optional[ChatModel]:
+    """Most recently active chat of a channel user (a user may have several, see /new in the bot)."""
     r = await session.execute(
-        select(ChatModel).where(
+        select(ChatModel)
+        .where(
             ChatModel.channel == channel,
             ChatModel.external_id == external_id,
         )
+        .order_by(ChatModel.updated_at.desc())
+        .limit(1)
     )
-    return r.scalar_one_or_none()
+    # По строке с каждого шарда пользователя (его шард и main) — берём самую свежую
+    return max(r.scalars().all(), key=lambda c: c.updated_at, default=None)
 
 
 async def chat_get_or_create_for_channel(
@@ -210,22 +269,50 @@ async def chat_get_or_create_for_channel(
     external_id: str,
     model_id: str = "openrouter/auto",
 ) -> ChatModel:
+    """
+    Chats are not unique per (channel, external_id), so there is no ON CONFLICT arbiter: concurrent callers
+    are serialized by a transaction advisory lock on the pair instead, and only the first one inserts.
+    """
+    await session.execute(
+        select(func.pg_advisory_xact_lock(func.hashtextextended(f"chat:{channel}:{external_id}", 0))),
+        # Блокировка в той базе, куда пойдёт новый чат пользователя
+        bind_arguments=bind_to(shards_for_user(channel, external_id)[0]),
+    )
     existing = await chat_get_by_channel(session, channel, external_id)
     if existing:
         return existing
     return await chat_create(session, model_id=model_id, channel=channel, external_id=external_id)
 
 
+async def chat_lock(session: AsyncSession, id: str) -> None:
+    """
+    Serialize work on one chat (concurrent /send for the same chat): a transaction advisory lock, released when
+    the caller's transaction ends. Waits for the holder instead of failing.
+    """
+    await session.execute(
+        select(func.pg_advisory_xact_lock(func.hashtextextended(f"chat-send:{id}", 0))),
+        bind_arguments=bind_to(shard_for_id(id)),
+    )
+
+
 async def chat_set_model(session: AsyncSession, id: str, model_id: str) -> Optional[ChatModel]:
-    await session.execute(update(ChatModel).where(ChatModel.id == id).values(model_id=model_id, updated_at=datetime.utcnow()))
-    await session.flush()
-    return await chat_get(session, id)
+    r = await session.execute(
+        update(ChatModel)
+        .where(ChatModel.id == id)
+        .values(model_id=model_id, updated_at=datetime.utcnow())
+        .returning(ChatModel)
+    )
+    return r.scalar_one_or_none()
 
 
 async def chat_set_agent(session: AsyncSession, id: str, agent_id: Optional[str]) -> Optional[ChatModel]:
-    await session.execute(update(ChatModel).where(ChatModel.id == id).values(agent_id=agent_id, updated_at=datetime.utcnow()))
-    await session.flush()
-    return await chat_get(session, id)
+    r = await session.execute(
+        update(ChatModel)
+        .where(ChatModel.id == id)
+        .values(agent_id=agent_id, updated_at=datetime.utcnow())
+        .returning(ChatModel)
+    )
+    return r.scalar_one_or_none()
 
 
 async def chat_update_title(session: AsyncSession, id: str, title: str) -> None:
@@ -239,20 +326,165 @@ async def message_add(
     chat_id: str,
     role: str,
     content: str,
+    provenance: Optional[str] = None,
 ) -> MessageModel:
-    m = MessageModel(chat_id=chat_id, role=role, content=content)
+    m = MessageModel(chat_id=chat_id, role=role, content=content, provenance=provenance)
     session.add(m)
     await session.flush()
+    remember_message(session, chat_id, m.seq, role, content)
     return m
 
 
 async def messages_for_chat(session: AsyncSession, chat_id: str) -> list[MessageModel]:
     r = await session.execute(
-        select(MessageModel).where(MessageModel.chat_id == chat_id).order_by(MessageModel.created_at)
+        select(MessageModel).where(MessageModel.chat_id == chat_id).order_by(MessageModel.seq)
     )
     return list(r.scalars().all())
 
 
+async def messages_page(
+    session: AsyncSession,
+    chat_id: str,
+    *,
+    since_seq: Optional[int] = None,
+    before_seq: Optional[int] = None,
+    limit: Optional[int] = None,
+) -> tuple[list[Row], bool]:
+    """
+    Messages of a chat in seq order, via the (chat_id, seq) index. since_seq: incremental sync, the oldest
+    `limit` messages newer than it; otherwise the newest `limit` (older than before_seq when paging back).
+    Returns (rows, has_more): whether more newer (since_seq) or older messages remain.
+    Plain Core rows (id, role, content, created_at, seq, provenance), no ORM objects: this is the read path for
+    long chats.
+    """
+    q = select(
+        MessageModel.id, MessageModel.role, MessageModel.content, MessageModel.created_at, MessageModel.seq,
+        MessageModel.provenance,
+    ).where(MessageModel.chat_id == chat_id)
+    if since_seq is not None:
+        q = q.where(MessageModel.seq > since_seq).order_by(MessageModel.seq)
+    else:
+        if before_seq is not None:
+            q = q.where(MessageModel.seq < before_seq)
+        q = q.order_by(MessageModel.seq.desc())
+    if limit is not None:
+        q = q.limit(limit + 1)
+    r = await session.execute(q)
+    messages = list(r.all())
+    has_more = limit is not None and len(messages) > limit
+    if has_more:
+        messages = messages[:limit]
+    if since_seq is None:
+        messages.reverse()
+    return messages, has_more
+
+
+def messages_page_of(
+    messages: list,
+    *,
+    since_seq: Optional[int] = None,
+    before_seq: Optional[int] = None,
+    limit: Optional[int] = None,
+) -> tuple[list, bool]:
+    """messages_page over an already loaded, seq-ordered list (e.g. chat_get_with_messages of an archived chat)."""
+    if since_seq is not None:
+        selected = [m for m in messages if m.seq > since_seq]
+        has_more = limit is not None and len(selected) > limit
+        return (selected[:limit] if has_more else selected), has_more
+    selected = [m for m in messages if before_seq is None or m.seq < before_seq]
+    has_more = limit is not None and len(selected) > limit
+    return (selected[-limit:] if has_more else selected), has_more
+
+
+# Text search configuration of messages.search_vector (migration v0004)
+SEARCH_CONFIG = "russian"
+# ts_headline не экранирует текст: отмечаем совпадения управляющими символами, HTML собирает search_snippet_html
+_MATCH_START, _MATCH_STOP = "\x02", "\x03"
+SEARCH_HEADLINE_OPTIONS = f"StartSel={_MATCH_START}, StopSel={_MATCH_STOP}, MaxWords=30, MinWords=10, MaxFragments=2"
+# sort=rank считает ts_rank_cd только для стольких самых новых совпадений: не ранжируем миллионы строк на частое слово
+SEARCH_RANK_CANDIDATES = 10000
+
+
+def search_snippet_html(snippet: str) -> str:
+    """HTML-escaped snippet with matched terms wrapped in <mark></mark>."""
+    first, *matches = snippet.split(_MATCH_START)
+    parts = [html.escape(first, quote=False)]
+    for chunk in matches:
+        marked, _, rest = chunk.partition(_MATCH_STOP)
+        parts.append(f"<mark>{html.escape(marked, quote=False)}</mark>{html.escape(rest, quote=False)}")
+    return "".join(parts)
+
+
+async def messages_search(
+    session: AsyncSession,
+    query: str,
+    *,
+    channel: Optional[str] = None,
+    external_id: Optional[str] = None,
+    sort: str = "rank",
+    after: Optional[tuple] = None,
+    limit: int = 20,
+) -> tuple[list[Row], bool]:
+    """
+    Messages matching a web-style query (words, "phrases", -exclusions, or) via the GIN index on search_vector,
+    optionally only in the chats of one channel user. sort="rank": by ts_rank_cd, after = (rank, id) of the last
+    hit, among the newest SEARCH_RANK_CANDIDATES matches; sort="recent": newest first, after = (id,).
+    Returns (rows, has_more); rows carry chat_title, rank and a snippet (see search_snippet_html), which is computed
+    for the returned page only. Messages of archived chats are not in the index and are not found.
+    """
+    config = literal(SEARCH_CONFIG, REGCONFIG)
+    tsquery = func.websearch_to_tsquery(config, query)
+    rank = func.ts_rank_cd(MessageModel.search_vector, tsquery)
+    conditions = [MessageModel.search_vector.bool_op("@@")(tsquery)]
+    if channel is not None and external_id is not None:
+        conditions += [ChatModel.channel == channel, ChatModel.external_id == external_id]
+    q = (
+        select(
+            MessageModel.id, MessageModel.chat_id, MessageModel.role, MessageModel.content,
+            MessageModel.created_at, MessageModel.seq, ChatModel.title.label("chat_title"), rank.label("rank"),
+        )
+        .join(ChatModel, ChatModel.id == MessageModel.chat_id)
+        .where(*conditions)
+    )
+    if sort == "rank":
+        candidates = (
+            select(MessageModel.id)
+            .join(ChatModel, ChatModel.id == MessageModel.chat_id)
+            .where(*conditions)
+            .order_by(MessageModel.id.desc())
+            .limit(SEARCH_RANK_CANDIDATES)
+        )
+        q = q.where(MessageModel.id.in_(candidates.scalar_subquery()))
+    if sort == "recent":
+        # id — UUIDv7, порядок по id = порядок по времени создания
+        if after is not None:
+            q = q.where(MessageModel.id < after[0])
+        q = q.order_by(MessageModel.id.desc())
+    else:
+        if after is not None:
+            after_rank = literal(after[0], REAL)
+            q = q.where(or_(rank < after_rank, and_(rank == after_rank, MessageModel.id < after[1])))
+        q = q.order_by(rank.desc(), MessageModel.id.desc())
+    page = q.limit(limit + 1).subquery()
+    # ts_headline перечитывает текст целиком — только для строк страницы
+    snippet = func.ts_headline(config, page.c.content, tsquery, SEARCH_HEADLINE_OPTIONS).label("snippet")
+    order = [page.c.id.desc()] if sort == "recent" else [page.c.rank.desc(), page.c.id.desc()]
+    r = await session.execute(
+        select(
+            page.c.id, page.c.chat_id, page.c.chat_title, page.c.role, page.c.created_at, page.c.seq,
+            page.c.rank, snippet,
+        ).order_by(*order)
+    )
+    rows = list(r.all())
+    if sort == "recent":
+        rows.sort(key=lambda row: row.id, reverse=True)
+    else:
+        rows.sort(key=lambda row: (row.rank, row.id), reverse=True)
+    # Без ключа пользователя поиск идёт по всем шардам, и строк может прийти до (limit + 1) с каждого
+    has_more = len(rows) > limit
+    return rows[:limit], has_more
+
+
 # ---------- Tickets ----------
 async def ticket_get_by_chat(session: AsyncSession, chat_id: str) -> Optional[TicketModel]:
     r = await session.execute(select(TicketModel).where(TicketModel.chat_id == chat_id))
@@ -264,7 +496,7 @@ async def ticket_list(session: AsyncSession, status: Optional[str] = None) -> li
     if status:
         q = q.where(TicketModel.status == status)
     r = await session.execute(q)
-    return list(r.scalars().all())
+    return sorted(r.scalars().all(), key=lambda t: t.updated_at, reverse=True)
 
 
 async def ticket_get(session: AsyncSession, id: str) -> Optional[TicketModel]:
@@ -297,9 +529,10 @@ async def ticket_update(
         values["assigned_agent_id"] = assigned_agent_id
     if priority is not None:
         values["priority"] = priority
-    await session.execute(update(TicketModel).where(TicketModel.id == id).values(**values))
-    await session.flush()
-    return await ticket_get(session, id)
+    r = await session.execute(
+        update(TicketModel).where(TicketModel.id == id).values(**values).returning(TicketModel)
+    )
+    return r.scalar_one_or_none()
 
 
 async def ticket_escalate(session: AsyncSession, id: str) -> Optional[TicketModel]:
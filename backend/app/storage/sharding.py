@@ -0,0 +1,482 @@
+"""
+Hash sharding of chat data across several Postgres databases: DATABASE_SHARDS="s1=url,s2=url", DATABASE_URL is
+shard "main". Unset = one database, nothing here is active.
+
+The routing unit is a bucket, the low 10 bits of a chat id (SHARD_BUCKETS); messages and the ticket of a chat
+go where the chat is (by chat_id). Chats of a channel user are created in the bucket of hash(channel, external_id),
+so all chats of one user live on one shard. shard_map (main DB) assigns buckets to shards;
+each process reloads it every SHARD_MAP_REFRESH_SECONDS.
+
+Chats created before `init` (ids older than the sharding epoch) stay on main for good, so listings by user read
+the user's shard plus main. Accounts, agents and the shard map are global and live on main only.
+
+Sessions are SQLAlchemy ShardedSessions: statements filtering by chat id / chat_id go to that chat's
+shard, by (channel, external_id) to the user's shards, anything else (admin listings like ticket_list) to every
+shard, and the repository merges the partial results.
+
+    python -m app.storage.sharding init                    # start sharding: epoch, all buckets on main
+    python -m app.storage.sharding status
+    python -m app.storage.sharding move --to s2 17 18 19   # move buckets
+    python -m app.storage.sharding rebalance               # spread buckets evenly over all shards
+"""
+import argparse
+import asyncio
+import logging
+import sys
+import time
+import uuid
+from collections import Counter
+from typing import Optional
+
+from sqlalchemy import String, cast, delete, func, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.elements import BindParameter
+
+from app.config import get_settings
+from app.storage import db
+from app.storage.models import (
+    SHARD_BUCKETS,
+    ChatModel,
+    MessageModel,
+    TicketModel,
+    new_chat_id,
+    user_shard_bucket,
+)
+
+logger = logging.getLogger(__name__)
+
+MAIN = "main"
+# Глобальные таблицы: только на main
+GLOBAL_TABLES = {"accounts", "agents", "shard_map", "shard_state", "schema_version"}
+# Колонки с id чата, по которому определяется шард. По id сообщения/тикета шард не вычислить (у импортированных
+# сообщений и у записей старых чатов он не в ведре чата), такие запросы идут на все шарды
+ROUTING_COLUMNS = {("chats", "id"), ("messages", "chat_id"), ("tickets", "chat_id")}
+COPY_BATCH = 500
+
+
+class ShardMovingError(RuntimeError):
+    """Write to a bucket that is being moved to another shard; retry in a few seconds."""
+
+
+class ShardMap:
+    def __init__(self, owners: Optional[dict[int, str]] = None, moving: frozenset = frozenset(),
+                 epoch_ms: Optional[int] = None) -> None:
+        self.owners = owners or {}
+        self.moving = moving
+        self.epoch_ms = epoch_ms  # None = sharding not initialized, everything is on main
+
+    def owner(self, bucket: int) -> str:
+        return self.owners.get(bucket, MAIN)
+
+
+_map = ShardMap()
+_engines: dict[str, AsyncEngine] = {}
+_refresh_task: Optional[asyncio.Task] = None
+
+
+def is_enabled() -> bool:
+    return bool(get_settings().database_shards)
+
+
+def _parse_shards(spec: str) -> dict[str, str]:
+    shards = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, sep, url = item.strip().partition("=")
+        if not sep or not name.strip() or name.strip() == MAIN:
+            raise ValueError(f"DATABASE_SHARDS: expected name=url (name other than {MAIN!r}), got {item!r}")
+        shards[name.strip()] = url.strip()
+    return shards
+
+
+def shard_engines() -> dict[str, AsyncEngine]:
+    """Engine per shard, main first. Just {"main": primary engine} without DATABASE_SHARDS."""
+    if not _engines:
+        _engines[MAIN] = db.get_engine()
+        if is_enabled():
+            for name, url in _parse_shards(get_settings().database_shards).items():
+                _engines[name] = db._create_engine(url, f"shard_{name}")
+    return _engines
+
+
+def shard_ids() -> list[str]:
+    return list(shard_engines())
+
+
+def bind_to(shard: str) -> dict:
+    """bind_arguments that pin a Core statement (no ORM entity) to a shard; {} for a plain session."""
+    return {"shard_id": shard} if is_enabled() else {}
+
+
+# ---------- Routing ----------
+def _sharded_id(value) -> Optional[uuid.UUID]:
+    """The id as UUID when it was created after the sharding epoch (older ids live on main)."""
+    try:
+        u = uuid.UUID(str(value))
+    except ValueError:
+        return None
+    if _map.epoch_ms is None or u.version != 7 or (u.int >> 80) < _map.epoch_ms:
+        return None
+    return u
+
+
+def shard_for_id(value) -> str:
+    """Shard of a chat id."""
+    u = _sharded_id(value)
+    return MAIN if u is None else _map.owner(u.int & (SHARD_BUCKETS - 1))
+
+
+def shards_for_user(channel: str, external_id: str) -> list[str]:
+    """Shards with the chats of a channel user: the user's bucket, plus main for chats from before the epoch."""
+    if _map.epoch_ms is None:
+        return [MAIN]
+    shard = _map.owner(user_shard_bucket(channel, external_id))
+    return [shard] if shard == MAIN else [shard, MAIN]
+
+
+def engine_for_chat(chat_id: str) -> AsyncEngine:
+    return shard_engines()[shard_for_id(chat_id)]
+
+
+def _check_writable(value) -> None:
+    u = _sharded_id(value)
+    if u is not None and (u.int & (SHARD_BUCKETS - 1)) in _map.moving:
+        raise ShardMovingError(f"bucket {u.int & (SHARD_BUCKETS - 1)} is being moved, retry shortly")
+
+
+def _criteria(statement, params: dict) -> tuple[list, Optional[tuple[str, str]]]:
+    """Routing ids and (channel, external_id) compared with `=` / IN anywhere in the statement."""
+    ids = []
+    user = {}
+
+    def visit_binary(binary) -> None:
+        table = getattr(binary.left, "table", None)
+        if table is None or not isinstance(binary.right, BindParameter):
+            return
+        if binary.operator not in (operators.eq, operators.in_op):
+            return
+        # selectinload передаёт значения IN через параметры выполнения, а не в самом bindparam
+        bind = binary.right
+        value = params[bind.key] if bind.key in params else bind.effective_value
+        key = (getattr(table, "name", None), binary.left.name)
+        if key in ROUTING_COLUMNS:
+            ids.extend(value if isinstance(value, (list, tuple)) else [value])
+        elif key in (("chats", "channel"), ("chats", "external_id")) and binary.operator is operators.eq:
+            user[key[1]] = value
+
+    visitors.traverse(statement, {}, {"binary": visit_binary})
+    if "channel" in user and "external_id" in user:
+        return ids, (user["channel"], user["external_id"])
+    return ids, None
+
+
+def _execute_chooser(context) -> list[str]:
+    mapper = context.bind_mapper
+    if mapper is not None and mapper.local_table.name in GLOBAL_TABLES:
+        return [MAIN]
+    params = context.parameters if isinstance(context.parameters, dict) else {}
+    ids, user = _criteria(context.statement, params)
+    if ids:
+        if context.is_update or context.is_delete:
+            for value in ids:
+                _check_writable(value)
+        return sorted({shard_for_id(value) for value in ids})
+    if user:
+        return shards_for_user(*user)
+    # Scatter: запрос без ключа шардирования идёт на все шарды, результаты сливает репозиторий
+    return shard_ids()
+
+
+def _identity_chooser(mapper, primary_key, *, lazy_loaded_from=None, **kw) -> list[str]:
+    if mapper.local_table.name in GLOBAL_TABLES:
+        return [MAIN]
+    if lazy_loaded_from is not None and lazy_loaded_from.identity_token is not None:
+        return [lazy_loaded_from.identity_token]
+    if mapper.local_table.name == "chats":
+        return [shard_for_id(primary_key[0])]
+    return shard_ids()
+
+
+def _shard_chooser(mapper, instance, clause=None, **kw) -> str:
+    """Shard for flushing an object. A new chat gets its id here: column defaults run after the shard is chosen."""
+    if instance is None or mapper.local_table.name in GLOBAL_TABLES:
+        return MAIN
+    if isinstance(instance, ChatModel):
+        if instance.id is None:
+            instance.id = new_chat_id(instance.channel, instance.external_id)
+        key = instance.id
+    else:
+        key = instance.chat_id
+    _check_writable(key)
+    return shard_for_id(key)
+
+
+class _ShardedSession(ShardedSession):
+    def get_bind(self, mapper=None, *, shard_id=None, instance=None, clause=None, **kw):
+        # Core-запросы без ORM-сущности (advisory lock, text()) — на main, если shard_id не задан явно
+        if shard_id is None and mapper is None and instance is None:
+            shard_id = MAIN
+        return super().get_bind(mapper, shard_id=shard_id, instance=instance, clause=clause, **kw)
+
+
+def _session_factory(read_only: bool) -> async_sessionmaker:
+    shards = {
+        name: (engine.execution_options(postgresql_readonly=True) if read_only else engine).sync_engine
+        for name, engine in shard_engines().items()
+    }
+    return async_sessionmaker(
+        class_=AsyncSession,
+        sync_session_class=_ShardedSession,
+        expire_on_commit=False,
+        autoflush=False,
+        shards=shards,
+        shard_chooser=_shard_chooser,
+        identity_chooser=_identity_chooser,
+        execute_chooser=_execute_chooser,
+    )
+
+
+# ---------- Shard map ----------
+async def _read_map(conn) -> ShardMap:
+    rows = (await conn.execute(text("SELECT bucket, shard, moving FROM shard_map"))).all()
+    epoch = (await conn.execute(text("SELECT value FROM shard_state WHERE key = 'epoch_ms'"))).scalar()
+    return ShardMap(
+        {r.bucket: r.shard for r in rows},
+        frozenset(r.bucket for r in rows if r.moving),
+        int(epoch) if epoch is not None else None,
+    )
+
+
+async def load_shard_map() -> None:
+    global _map
+    async with db.get_engine().connect() as conn:
+        new_map = await _read_map(conn)
+    unknown = set(new_map.owners.values()) - set(shard_engines())
+    if unknown:
+        raise RuntimeError(f"shard_map refers to shards missing from DATABASE_SHARDS: {sorted(unknown)}")
+    _map = new_map
+
+
+async def _refresh_loop() -> None:
+    interval = get_settings().shard_map_refresh_seconds
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await load_shard_map()
+        except Exception as e:
+            logger.error("Shard map refresh failed, keeping the previous map: %s", e)
+
+
+async def init_sharding() -> None:
+    """Load the shard map, switch sessions to ShardedSession and keep the map fresh. No-op without shards."""
+    global _refresh_task
+    if not is_enabled():
+        return
+    await load_shard_map()
+    if db.has_read_replica():
+        logger.warning("DATABASE_READ_URL is ignored when DATABASE_SHARDS is set")
+    db.use_session_factories(_session_factory(read_only=False), _session_factory(read_only=True))
+    if _refresh_task is None:
+        _refresh_task = asyncio.create_task(_refresh_loop())
+    logger.info("Sharding: %d shards, epoch %s", len(shard_engines()), _map.epoch_ms)
+
+
+async def close_sharding() -> None:
+    global _refresh_task
+    if _refresh_task is not None:
+        _refresh_task.cancel()
+        _refresh_task = None
+    for name, engine in list(_engines.items()):
+        if name != MAIN:
+            await engine.dispose()
+
+
+# ---------- Admin: init / status / move / rebalance ----------
+async def init_map() -> None:
+    """Start sharding (idempotent): set the epoch, map every bucket to main, drop agent FKs on other shards."""
+    async with db.get_engine().begin() as conn:
+        epoch = (await conn.execute(text("SELECT value FROM shard_state WHERE key = 'epoch_ms'"))).scalar()
+        if epoch is None:
+            epoch = str(time.time_ns() // 1_000_000)
+            await conn.execute(text("INSERT INTO shard_state (key, value) VALUES ('epoch_ms', :v)"), {"v": epoch})
+        await conn.execute(
+            text("INSERT INTO shard_map (bucket, shard) SELECT b, :main FROM generate_series(0, :n - 1) b "
+                 "ON CONFLICT DO NOTHING"),
+            {"main": MAIN, "n": SHARD_BUCKETS},
+        )
+    # agents есть только на main: внешний ключ chats.agent_id на остальных шардах не выполним
+    for name, engine in shard_engines().items():
+        if name == MAIN:
+            continue
+        async with engine.begin() as conn:
+            r = await conn.execute(text(
+                "SELECT conname FROM pg_constraint WHERE contype = 'f' "
+                "AND conrelid = 'chats'::regclass AND confrelid = 'agents'::regclass"
+            ))
+            for (constraint,) in r.all():
+                await conn.execute(text(f"ALTER TABLE chats DROP CONSTRAINT {constraint}"))
+    logger.info("Sharding initialized, epoch %s", epoch)
+
+
+async def _current_map() -> ShardMap:
+    async with db.get_engine().connect() as conn:
+        current = await _read_map(conn)
+    if current.epoch_ms is None:
+        raise RuntimeError("Sharding is not initialized: run `python -m app.storage.sharding init` first")
+    return current
+
+
+def _bucket_chats(buckets: list[int], epoch_ms: int):
+    """Chats of these buckets created after the epoch (earlier ones never leave main)."""
+    return (
+        func.agiens_shard_bucket(ChatModel.id).in_(buckets),
+        ChatModel.id >= uuid.UUID(int=epoch_ms << 80),
+        func.substr(cast(ChatModel.id, String), 15, 1) == "7",
+    )
+
+
+_MESSAGE_COLUMNS = [c for c in MessageModel.__table__.c if c.name != "search_vector"]  # пересчитает триггер
+
+
+async def _copy_buckets(buckets: list[int], epoch_ms: int, source: AsyncEngine, target: AsyncEngine) -> int:
+    """Copy chats (with messages and tickets) of the buckets; ON CONFLICT DO NOTHING, so it can be re-run."""
+    copied = 0
+    after = None
+    while True:
+        q = select(ChatModel.__table__).where(*_bucket_chats(buckets, epoch_ms)).order_by(ChatModel.id).limit(COPY_BATCH)
+        if after is not None:
+            q = q.where(ChatModel.id > after)
+        async with source.connect() as src:
+            chats = [dict(r._mapping) for r in (await src.execute(q)).all()]
+            if not chats:
+                return copied
+            ids = [c["id"] for c in chats]
+            tickets = [dict(r._mapping) for r in (await src.execute(
+                select(TicketModel.__table__).where(TicketModel.chat_id.in_(ids))
+            )).all()]
+            async with target.begin() as dst:
+                await dst.execute(pg_insert(ChatModel.__table__).values(chats).on_conflict_do_nothing())
+                result = await src.stream(
+                    select(*_MESSAGE_COLUMNS).where(MessageModel.chat_id.in_(ids)).order_by(MessageModel.chat_id)
+                )
+                async for part in result.partitions(COPY_BATCH):
+                    await dst.execute(
+                        pg_insert(MessageModel.__table__).values([dict(r._mapping) for r in part]).on_conflict_do_nothing()
+                    )
+                if tickets:
+                    await dst.execute(pg_insert(TicketModel.__table__).values(tickets).on_conflict_do_nothing())
+        copied += len(chats)
+        after = ids[-1]
+
+
+async def _delete_buckets(buckets: list[int], epoch_ms: int, engine: AsyncEngine) -> None:
+    while True:
+        async with engine.begin() as conn:
+            ids = list((await conn.execute(
+                select(ChatModel.id).where(*_bucket_chats(buckets, epoch_ms)).limit(COPY_BATCH)
+            )).scalars())
+            if not ids:
+                return
+            await conn.execute(delete(TicketModel).where(TicketModel.chat_id.in_(ids)))
+            await conn.execute(delete(MessageModel).where(MessageModel.chat_id.in_(ids)))
+            await conn.execute(delete(ChatModel).where(ChatModel.id.in_(ids)))
+
+
+async def _set_buckets(buckets: list[int], **values) -> None:
+    sets = ", ".join(f"{k} = :{k}" for k in values)
+    async with db.get_engine().begin() as conn:
+        await conn.execute(text(f"UPDATE shard_map SET {sets} WHERE bucket = ANY(:buckets)"), {**values, "buckets": buckets})
+
+
+async def move_buckets(buckets: list[int], target: str, wait: float) -> None:
+    """
+    Move buckets to `target`: mark them moving (writes fail with ShardMovingError), wait until every process
+    has seen that, copy, flip the map, wait until nobody reads the old copy, delete it from the source.
+    """
+    engines = shard_engines()
+    if target not in engines:
+        raise ValueError(f"Unknown shard {target!r}; configured: {', '.join(engines)}")
+    current = await _current_map()
+    by_source: dict[str, list[int]] = {}
+    for b in buckets:
+        if current.owner(b) != target:
+            by_source.setdefault(current.owner(b), []).append(b)
+    if not by_source:
+        return
+    moving = [b for group in by_source.values() for b in group]
+    await _set_buckets(moving, moving=True)
+    await asyncio.sleep(wait)
+    for source, group in by_source.items():
+        copied = await _copy_buckets(group, current.epoch_ms, engines[source], engines[target])
+        logger.info("Copied %d chats of %d buckets %s -> %s", copied, len(group), source, target)
+    await _set_buckets(moving, shard=target, moving=False)
+    await asyncio.sleep(wait)
+    for source, group in by_source.items():
+        await _delete_buckets(group, current.epoch_ms, engines[source])
+    logger.info("Moved buckets %s to %s", moving, target)
+
+
+async def rebalance(wait: float, batch: int) -> None:
+    """Spread buckets evenly: bucket b belongs to shard_ids()[b % number of shards]."""
+    names = shard_ids()
+    current = await _current_map()
+    plan: dict[str, list[int]] = {}
+    for b in range(SHARD_BUCKETS):
+        desired = names[b % len(names)]
+        if current.owner(b) != desired:
+            plan.setdefault(desired, []).append(b)
+    for target, buckets in plan.items():
+        for i in range(0, len(buckets), batch):
+            await move_buckets(buckets[i:i + batch], target, wait)
+
+
+async def _status() -> None:
+    current = await _current_map()
+    counts = Counter(current.owner(b) for b in range(SHARD_BUCKETS))
+    print(f"epoch_ms {current.epoch_ms}")
+    for name in shard_ids():
+        print(f"{name:<12} {counts.get(name, 0):>5} buckets")
+    if current.moving:
+        print(f"moving: {sorted(current.moving)}")
+
+
+async def _run(args) -> int:
+    try:
+        await db.wait_for_db()
+        if args.command == "init":
+            await init_map()
+        elif args.command == "status":
+            await _status()
+        elif args.command == "move":
+            await move_buckets(args.buckets, args.to, args.wait)
+        elif args.command == "rebalance":
+            await rebalance(args.wait, args.batch)
+        return 0
+    finally:
+        await db.close_db()
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    parser = argparse.ArgumentParser(description="Agiens shard map administration")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("init")
+    sub.add_parser("status")
+    # Ожидание после смены карты: все процессы перечитали её и завершили транзакции, начатые по старой
+    default_wait = get_settings().shard_map_refresh_seconds + 60
+    move = sub.add_parser("move")
+    move.add_argument("--to", required=True)
+    move.add_argument("--wait", type=float, default=default_wait)
+    move.add_argument("buckets", type=int, nargs="+")
+    reb = sub.add_parser("rebalance")
+    reb.add_argument("--wait", type=float, default=default_wait)
+    reb.add_argument("--batch", type=int, default=32, help="buckets moved (and write-blocked) at a time")
+    sys.exit(asyncio.run(_run(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,7 @@ import base64
 import io
 import logging
 import threading
-from typing import Optional
+from typing import AsyncIterator, Callable, Optional
 
 import httpx
 
@@ -42,16 +42,24 @@ def _get_shared_httpx_client() -> httpx.Client:
         return _shared_httpx_client
 
 
+def _elevenlabs_kwargs() -> dict:
+    """ElevenLabs(...) kwargs: api key, shared httpx client (proxy/verify), optional base URL (fake server)."""
+    settings = get_settings()
+    kwargs: dict = {"api_key": settings.elevenlabs_api_key}
+    if _need_custom_httpx():
+        kwargs["httpx_client"] = _get_shared_httpx_client()
+    if settings.elevenlabs_base_url:
+        kwargs["base_url"] = settings.elevenlabs_base_url.rstrip("/")
+    return kwargs
+
+
 def _client():
     """Lazy ElevenLabs client to avoid import at module load when key is missing."""
     from elevenlabs.client import ElevenLabs
     settings = get_settings()
     if not settings.elevenlabs_api_key:
         return None
-    kwargs = {"api_key": settings.elevenlabs_api_key}
-    if _need_custom_httpx():
-        kwargs["httpx_client"] = _get_shared_httpx_client()
-    return ElevenLabs(**kwargs)
+    return ElevenLabs(**_elevenlabs_kwargs())
 
 
 def is_available() -> bool:
@@ -61,11 +69,7 @@ def is_available() -> bool:
 def _stt_sync(audio_bytes: bytes, filename: str, model_id: str) -> Optional[str]:
     """Sync STT (run in thread). Prefer filename with .webm for browser recordings."""
     from elevenlabs.client import ElevenLabs
-    settings = get_settings()
-    client_kwargs = {"api_key": settings.elevenlabs_api_key}
-    if _need_custom_httpx():
-        client_kwargs["httpx_client"] = _get_shared_httpx_client()
-    client = ElevenLabs(**client_kwargs)
+    client = ElevenLabs(**_elevenlabs_kwargs())
     if not audio_bytes or len(audio_bytes) < 100:
         logger.warning("STT: audio too short or empty (%s bytes)", len(audio_bytes) if audio_bytes else 0)
         return None
@@ -97,11 +101,7 @@ def _stt_sync(audio_bytes: bytes, filename: str, model_id: str) -> Optional[str]
 def _tts_sync(text: str, voice_id: str, model_id: str) -> Optional[bytes]:
     """Sync TTS (run in thread)."""
     from elevenlabs.client import ElevenLabs
-    settings = get_settings()
-    client_kwargs = {"api_key": settings.elevenlabs_api_key}
-    if _need_custom_httpx():
-        client_kwargs["httpx_client"] = _get_shared_httpx_client()
-    client = ElevenLabs(**client_kwargs)
+    client = ElevenLabs(**_elevenlabs_kwargs())
     if _need_custom_httpx():
         with _elevenlabs_call_lock:
             audio = client.text_to_speech.convert(
@@ -126,6 +126,36 @@ def _tts_sync(text: str, voice_id: str, model_id: str) -> Optional[bytes]:
     return None
 
 
+def _tts_stream_sync(
+    text: str,
+    voice_id: str,
+    model_id: str,
+    on_chunk: Callable[[bytes], None],
+    stop: threading.Event,
+) -> None:
+    """Sync streaming TTS (run in thread): push MP3 chunks to on_chunk until done or stop is set."""
+    from elevenlabs.client import ElevenLabs
+    client = ElevenLabs(**_elevenlabs_kwargs())
+
+    def _pump() -> None:
+        for chunk in client.text_to_speech.stream(
+            voice_id=voice_id,
+            text=text,
+            model_id=model_id,
+            output_format="mp3_44100_128",
+        ):
+            if stop.is_set():
+                return
+            if chunk:
+                on_chunk(chunk)
+
+    if _need_custom_httpx():
+        with _elevenlabs_call_lock:
+            _pump()
+    else:
+        _pump()
+
+
 def _log_elevenlabs_error(method: str, e: Exception) -> None:
     """Log ElevenLabs error; avoid traceback for known API restrictions (302/geo) and proxy errors."""
     err_msg = str(e).lower()
@@ -188,3 +218,44 @@ async def text_to_speech_base64(text: str) -> Optional[str]:
     """TTS and return base64-encoded MP3 for JSON response."""
     raw = await text_to_speech(text)
     return base64.b64encode(raw).decode("ascii") if raw else None
+
+
+async def text_to_speech_stream(text: str) -> AsyncIterator[bytes]:
+    """Synthesize text to MP3 and yield chunks as they arrive. Closing the generator stops the upstream stream."""
+    if not text.strip() or not _client():
+        return
+    settings = get_settings()
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    stop = threading.Event()
+
+    def _on_chunk(chunk: bytes) -> None:
+        loop.call_soon_threadsafe(queue.put_nowait, chunk)
+
+    async def _run() -> None:
+        try:
+            await asyncio.to_thread(
+                _tts_stream_sync,
+                text,
+                settings.elevenlabs_voice_id,
+                settings.elevenlabs_tts_model,
+                _on_chunk,
+                stop,
+            )
+        except Exception as e:
+            _log_elevenlabs_error("TTS stream", e)
+        finally:
+            queue.put_nowait(None)
+
+    producer = asyncio.create_task(_run())
+    try:
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        # Поток нельзя прервать — просим его остановиться на следующем чанке
+        stop.set()
+        if not producer.done():
+            producer.cancel()
@@ -0,0 +1,195 @@
+"""
+Realtime duplex voice over WebSocket: incremental STT while the user speaks, LLM on end-of-utterance,
+streamed TTS back, playback cancelled when the user interrupts (barge-in).
+
+Protocol (one socket per chat):
+  client → server
+    binary frame            — audio chunk (webm/ogg from MediaRecorder); each utterance starts with a container header
+    {"type": "eou"}         — end of utterance (otherwise detected after VOICE_EOU_SILENCE_MS without frames)
+    {"type": "interrupt"}   — stop the current reply; new audio frames during a reply do the same
+  server → client
+    {"type": "partial", "text"}   — incremental transcript of the audio received so far (only for the first
+                                    VOICE_PARTIAL_MAX_BYTES of an utterance)
+    {"type": "final", "text"}     — transcript of the finished utterance (saved as user message)
+    {"type": "reply", "content"}  — assistant text (saved as assistant message)
+    binary frames                 — MP3 chunks of the reply, then {"type": "audio_end"}
+    {"type": "interrupted"}       — reply/playback cancelled by barge-in
+"""
+import asyncio
+import json
+import logging
+import time
+from contextlib import aclosing, suppress
+from typing import Optional
+
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+from app.config import get_settings
+from app.services.chat_service import generate_reply
+from app.storage.db import get_session
+from app.storage.repositories import chat_set_model, message_add
+from app.voice.elevenlabs_client import speech_to_text, text_to_speech_stream
+
+logger = logging.getLogger(__name__)
+
+
+class VoiceSession:
+    """State of one duplex voice connection: current utterance buffer, partial STT and reply tasks."""
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        chat_id: str,
+        *,
+        model_id: Optional[str] = None,
+        with_voice: bool = True,
+        filename: str = "audio.webm",
+    ) -> None:
+        settings = get_settings()
+        self._ws = websocket
+        self._chat_id = chat_id
+        self._model_id = model_id
+        self._with_voice = with_voice
+        self._filename = filename
+        self._partial_interval = max(settings.voice_partial_interval_ms, 0) / 1000
+        self._partial_max_bytes = settings.voice_partial_max_bytes
+        self._eou_silence = max(settings.voice_eou_silence_ms, 1) / 1000
+        self._audio = bytearray()
+        self._last_partial_at = 0.0
+        self._partial_task: Optional[asyncio.Task] = None
+        self._reply_task: Optional[asyncio.Task] = None
+        self._send_lock = asyncio.Lock()
+
+    async def run(self) -> None:
+        try:
+            while True:
+                # Пока идёт фраза — ждём следующий кадр не дольше паузы конца фразы
+                timeout = self._eou_silence if self._audio else None
+                try:
+                    message = await asyncio.wait_for(self._ws.receive(), timeout)
+                except asyncio.TimeoutError:
+                    await self._end_of_utterance()
+                    continue
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message.get("bytes"):
+                    await self._on_audio(message["bytes"])
+                elif message.get("text"):
+                    await self._on_control(message["text"])
+        except WebSocketDisconnect:
+            pass
+        finally:
+            await self._cancel(self._partial_task)
+            await self._cancel(self._reply_task)
+
+    async def _on_control(self, raw: str) -> None:
+        try:
+            data = json.loads(raw)
+        except json.JSONDecodeError:
+            await self._send_json({"type": "error", "detail": "Invalid JSON"})
+            return
+        kind = data.get("type") if isinstance(data, dict) else None
+        if kind == "eou":
+            await self._end_of_utterance()
+        elif kind == "interrupt":
+            await self._interrupt()
+        else:
+            await self._send_json({"type": "error", "detail": f"Unknown message type: {kind}"})
+
+    async def _on_audio(self, chunk: bytes) -> None:
+        # Barge-in: пользователь заговорил во время ответа — отменяем ответ и воспроизведение
+        await self._interrupt()
+        if not self._audio:
+            self._last_partial_at = time.monotonic()
+        self._audio.extend(chunk)
+        if (
+            self._partial_interval
+            and len(self._audio) <= self._partial_max_bytes
+            and (self._partial_task is None or self._partial_task.done())
+            and time.monotonic() - self._last_partial_at >= self._partial_interval
+        ):
+            self._last_partial_at = time.monotonic()
+            self._partial_task = asyncio.create_task(self._partial_stt(bytes(self._audio)))
+
+    async def _partial_stt(self, audio: bytes) -> None:
+        text = await speech_to_text(audio, self._filename)
+        if text and text.strip():
+            await self._send_json({"type": "partial", "text": text.strip()})
+
+    async def _end_of_utterance(self) -> None:
+        audio = bytes(self._audio)
+        self._audio.clear()
+        await self._cancel(self._partial_task)
+        self._partial_task = None
+        if not audio:
+            return
+        await self._interrupt()
+        # Финальный STT и ответ — в задаче ответа: цикл приёма не ждёт STT, и barge-in отменяет и её
+        self._reply_task = asyncio.create_task(self._finish_utterance(audio))
+
+    async def _finish_utterance(self, audio: bytes) -> None:
+        text = await speech_to_text(audio, self._filename)
+        text = (text or "").strip()
+        await self._send_json({"type": "final", "text": text})
+        if text:
+            await self._respond(text)
+
+    async def _respond(self, user_text: str) -> None:
+        from app.storage.repositories import ticket_create, ticket_get_by_chat, ticket_update
+        from app.services.support_orchestration import classify_support_message, route_ticket_to_agent
+
+        try:
+            # Сообщение пользователя фиксируем сразу: при barge-in теряется только ответ
+            async with get_session() as session:
+                await message_add(session, self._chat_id, "user", user_text)
+                ticket = await ticket_get_by_chat(session, self._chat_id)
+                if not ticket:
+                    ticket = await ticket_create(session, self._chat_id)
+                    category = await classify_support_message(user_text)
+                    await ticket_update(session, ticket.id, category=category)
+                    await route_ticket_to_agent(session, ticket.id, category)
+                if self._model_id:
+                    await chat_set_model(session, self._chat_id, self._model_id)
+            async with get_session() as session:
+                content, provenance = await generate_reply(
+                    session, self._chat_id, user_text, self._model_id, user_message_committed=True
+                )
+                await message_add(session, self._chat_id, "assistant", content, provenance=provenance)
+            await self._send_json({"type": "reply", "content": content})
+            if not self._with_voice:
+                return
+            async with aclosing(text_to_speech_stream(content)) as chunks:
+                async for chunk in chunks:
+                    await self._send_bytes(chunk)
+            await self._send_json({"type": "audio_end"})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Realtime voice reply failed for chat %s: %s", self._chat_id, e, exc_info=True)
+            with suppress(Exception):
+                await self._send_json({"type": "error", "detail": "Reply failed"})
+
+    async def _interrupt(self) -> None:
+        task = self._reply_task
+        if task is None or task.done():
+            return
+        self._reply_task = None
+        await self._cancel(task)
+        await self._send_json({"type": "interrupted"})
+
+    @staticmethod
+    async def _cancel(task: Optional[asyncio.Task]) -> None:
+        if task is None or task.done():
+            return
+        task.cancel()
+        with suppress(asyncio.CancelledError, Exception):
+            await task
+
+    async def _send_json(self, data: dict) -> None:
+        async with self._send_lock:
+            with suppress(WebSocketDisconnect, RuntimeError):
+                await self._ws.send_text(json.dumps(data, ensure_ascii=False))
+
+    async def _send_bytes(self, data: bytes) -> None:
+        async with self._send_lock:
+            await self._ws.send_bytes(data)
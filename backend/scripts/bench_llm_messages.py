@@ -0,0 +1,105 @@
+"""
+Benchmark the CPU cost of building LLM requests for one reply turn: the old path (a pydantic ChatMessage per
+history message, a dict per message for every request, stdlib json via httpx) vs CompactMessage + MessageLog
+(history encoded once with orjson, tool rounds append to it). No network and no database: each turn builds the
+httpx requests for the first call and for every tool round, which is all the CPU generate_reply spends per turn.
+
+    cd backend
+    python -m scripts.bench_llm_messages --sizes 500 5000 --tool-rounds 2
+"""
+import argparse
+import json
+import time
+
+import httpx
+
+from app.llm.base import ChatMessage, CompactMessage, MessageLog
+from app.llm.openrouter import _request_body
+
+URL = "https://openrouter.ai/api/v1/chat/completions"
+SYSTEM_PROMPT = "You are a helpful support agent. Answer briefly."
+TOOL_CALL = {"id": "call_1", "type": "function", "function": {"name": "search", "arguments": "{\"q\": \"order\"}"}}
+
+
+def _history(size: int) -> list[tuple[str, str]]:
+    return [
+        ("user" if n % 2 == 0 else "assistant", "lorem ipsum dolor sit amet, привет " * (5 + n % 20))
+        for n in range(size)
+    ]
+
+
+def _legacy_to_api(m: ChatMessage) -> dict:
+    # Прежний openrouter._message_to_api
+    out = {"role": m.role}
+    if m.role == "tool":
+        out["content"] = m.content or ""
+        if m.tool_call_id:
+            out["tool_call_id"] = m.tool_call_id
+        return out
+    if m.tool_calls:
+        out["content"] = m.content if m.content else None
+        out["tool_calls"] = m.tool_calls
+        return out
+    out["content"] = m.content or ""
+    return out
+
+
+def _body(messages: list[dict]) -> dict:
+    return {"model": "openrouter/auto", "messages": messages, "temperature": 0.7, "max_tokens": 1024}
+
+
+def legacy_turn(history: list[tuple[str, str]], tool_rounds: int) -> list[bytes]:
+    messages = [ChatMessage(role=role, content=content) for role, content in history]
+    messages.append(ChatMessage(role="user", content="where is my order?"))
+    requests = []
+    for _ in range(tool_rounds + 1):
+        body = _body([{"role": "system", "content": SYSTEM_PROMPT}] + [_legacy_to_api(m) for m in messages])
+        requests.append(httpx.Request("POST", URL, json=body).content)
+        messages.append(ChatMessage(role="assistant", content=None, tool_calls=[TOOL_CALL]))
+        messages.append(ChatMessage(role="tool", content="order 42: shipped", tool_call_id="call_1"))
+    return requests
+
+
+def compact_turn(history: list[tuple[str, str]], tool_rounds: int) -> list[bytes]:
+    messages = MessageLog(CompactMessage(role, content) for role, content in history)
+    messages.append(CompactMessage("user", "where is my order?"))
+    requests = []
+    for _ in range(tool_rounds + 1):
+        body = {"model": "openrouter/auto", "temperature": 0.7, "max_tokens": 1024}
+        requests.append(httpx.Request("POST", URL, content=_request_body(body, messages, SYSTEM_PROMPT)).content)
+        messages.append(CompactMessage("assistant", None, tool_calls=[TOOL_CALL]))
+        messages.append(CompactMessage("tool", "order 42: shipped", tool_call_id="call_1"))
+    return requests
+
+
+def _cpu_per_turn(fn, history, tool_rounds: int, seconds: float) -> float:
+    turns = 0
+    started = time.process_time()
+    while time.process_time() - started < seconds:
+        fn(history, tool_rounds)
+        turns += 1
+    return (time.process_time() - started) / turns
+
+
+def main(sizes: list[int], tool_rounds: int, seconds: float) -> None:
+    print(f"CPU per turn, {tool_rounds} tool round(s) = {tool_rounds + 1} requests per turn")
+    for size in sizes:
+        history = _history(size)
+        legacy = legacy_turn(history, tool_rounds)
+        compact = compact_turn(history, tool_rounds)
+        assert [json.loads(b) for b in legacy] == [json.loads(b) for b in compact], "request bodies must match"
+        old = _cpu_per_turn(legacy_turn, history, tool_rounds, seconds)
+        new = _cpu_per_turn(compact_turn, history, tool_rounds, seconds)
+        print(
+            f"{size:>7} msgs  pydantic+json {old * 1000:>8.2f} ms   compact+orjson {new * 1000:>8.2f} ms   "
+            f"{old / new:.1f}x  ({len(compact[-1]) / 1024:.0f} KiB last request)"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[500, 5000])
+    parser.add_argument("--tool-rounds", type=int, default=2)
+    parser.add_argument("--seconds", type=float, default=3.0, help="CPU time per measurement")
+    args = parser.parse_args()
+    main(args.sizes, args.tool_rounds, args.seconds)
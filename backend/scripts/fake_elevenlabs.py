@@ -0,0 +1,56 @@
+"""
+Local fake ElevenLabs STT/TTS server for testing voice (send-voice and voice-stream) without network access.
+
+Run:    uvicorn scripts.fake_elevenlabs:app --port 8765
+Then:   ELEVENLABS_API_KEY=fake ELEVENLABS_BASE_URL=http://127.0.0.1:8765 uvicorn app.main:app --port 3001
+
+STT returns "fake transcript N bytes"; TTS returns silent-looking MP3 frames sized by text length,
+streamed in chunks with a small delay so barge-in can be exercised.
+"""
+import asyncio
+import os
+
+from fastapi import FastAPI, File, Form, Request, UploadFile
+from fastapi.responses import Response, StreamingResponse
+
+app = FastAPI(title="Fake ElevenLabs")
+
+STT_DELAY = float(os.getenv("FAKE_STT_DELAY", "0.2"))
+TTS_CHUNK_DELAY = float(os.getenv("FAKE_TTS_CHUNK_DELAY", "0.05"))
+# MPEG-1 Layer III frame header + padding: enough for players/clients that sniff the format
+_MP3_FRAME = b"\xff\xfb\x90\x64" + b"\x00" * 413
+
+
+def _fake_audio(text: str) -> list[bytes]:
+    return [_MP3_FRAME] * max(1, len(text) // 10)
+
+
+@app.post("/v1/speech-to-text")
+async def speech_to_text(file: UploadFile = File(...), model_id: str = Form("")):
+    raw = await file.read()
+    await asyncio.sleep(STT_DELAY)
+    text = f"fake transcript {len(raw)} bytes"
+    return {
+        "language_code": "en",
+        "language_probability": 1.0,
+        "text": text,
+        "words": [{"text": w, "start": 0.0, "end": 0.0, "type": "word", "logprob": 0.0} for w in text.split()],
+    }
+
+
+@app.post("/v1/text-to-speech/{voice_id}")
+async def text_to_speech(voice_id: str, request: Request):
+    body = await request.json()
+    return Response(content=b"".join(_fake_audio(body.get("text") or "")), media_type="audio/mpeg")
+
+
+@app.post("/v1/text-to-speech/{voice_id}/stream")
+async def text_to_speech_stream(voice_id: str, request: Request):
+    body = await request.json()
+
+    async def _chunks():
+        for frame in _fake_audio(body.get("text") or ""):
+            await asyncio.sleep(TTS_CHUNK_DELAY)
+            yield frame
+
+    return StreamingResponse(_chunks(), media_type="audio/mpeg")
@@ -2,15 +2,19 @@
 Telegram bot for Agiens: list chats, select/create chat, agents, edit prompt, text + voice.
 Uses effective_user.id as external_id so one user has many backend chats.
 """
+import asyncio
 import base64
 import io
 import logging
 import os
+from contextlib import asynccontextmanager, suppress
 
 import httpx
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
+from telegram.constants import ChatAction
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
@@ -26,6 +30,14 @@ logger = logging.getLogger(__name__)
 
 BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:3001").rstrip("/")
 CHANNEL = "telegram"
+# polling (one process) or webhook (behind nginx, several replicas — see webhook.py)
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+# Redis for user/chat state (current chat, prompt editing) — survives restarts, shared by replicas
+REDIS_URL = os.getenv("REDIS_URL", "").strip()
+BOT_STATE_TTL = int(os.getenv("BOT_STATE_TTL", str(30 * 24 * 3600)))
+BOT_STATE_FLUSH_INTERVAL = float(os.getenv("BOT_STATE_FLUSH_INTERVAL", "5"))
+# Bot API server; point to fake_bot_api.py for local load tests
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
 
 
 def _user_id(update: Update) -> str | None:
@@ -34,79 +46,246 @@ def _user_id(update: Update) -> str | None:
     return None
 
 
-async def _list_chats(user_id: str) -> list[dict]:
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        r = await client.get(
-            f"{BACKEND_URL}/api/chats",
-            params={"channel": CHANNEL, "externalId": user_id},
+# --- Backend HTTP client (one per bot process: keep-alive, HTTP/2, retries) ---
+
+BACKEND_RETRIES = int(os.getenv("BACKEND_RETRIES", "3"))
+BACKEND_RETRY_BACKOFF = float(os.getenv("BACKEND_RETRY_BACKOFF", "0.5"))
+_RETRY_STATUSES = {500, 502, 503, 504}
+# 5xx повторяем только для идемпотентных методов или с Idempotency-Key: иначе повтор POST /send заново запустит LLM
+_IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "PATCH", "DELETE"}
+
+_backend: httpx.AsyncClient | None = None
+
+
+async def init_backend_client(application: Application | None = None) -> None:
+    """Create the shared backend client (Application post_init hook)."""
+    global _backend
+    if _backend is None:
+        _backend = httpx.AsyncClient(
+            base_url=BACKEND_URL,
+            http2=True,
+            timeout=httpx.Timeout(30.0),
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60.0),
         )
-        if r.status_code != 200:
-            return []
-        return r.json()
+
+
+async def close_backend_client(application: Application | None = None) -> None:
+    """Close the shared backend client (Application post_shutdown hook)."""
+    global _backend
+    if _backend is not None:
+        await _backend.aclose()
+        _backend = None
+
+
+async def _backend_request(method: str, path: str, **kwargs) -> httpx.Response | None:
+    """
+    Request to backend via the shared client. Retries with exponential backoff on connect errors (any method:
+    the request never reached the backend) and on other transport errors and 5xx (idempotent methods, or a
+    request with an Idempotency-Key header). Returns None if the backend is unreachable.
+    """
+    if _backend is None:
+        await init_backend_client()
+    retry_safe = method in _IDEMPOTENT_METHODS or "Idempotency-Key" in (kwargs.get("headers") or {})
+    for attempt in range(BACKEND_RETRIES + 1):
+        last = attempt == BACKEND_RETRIES
+        try:
+            r = await _backend.request(method, path, **kwargs)
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+            if last:
+                logger.warning("Backend %s %s unreachable: %s", method, path, e)
+                return None
+        except httpx.TransportError as e:
+            # Запрос мог дойти до бэкенда (read timeout, разрыв соединения после коммита хода и т.п.) —
+            # повторяем только идемпотентные (с Idempotency-Key бэкенд вернёт первый ответ, а не сгенерирует второй)
+            if last or not retry_safe:
+                logger.warning("Backend %s %s failed: %s", method, path, e)
+                return None
+        else:
+            if r.status_code not in _RETRY_STATUSES or not retry_safe or last:
+                return r
+        await asyncio.sleep(BACKEND_RETRY_BACKOFF * (2 ** attempt))
+    return None
+
+
+async def _list_chats(user_id: str) -> list[dict]:
+    r = await _backend_request(
+        "GET",
+        "/api/chats",
+        params={"channel": CHANNEL, "externalId": user_id},
+    )
+    if r is None or r.status_code != 200:
+        return []
+    return r.json()
 
 
 async def _create_chat(user_id: str) -> dict | None:
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        r = await client.post(
-            f"{BACKEND_URL}/api/chats",
-            json={"channel": CHANNEL, "externalId": user_id},
-        )
-        if r.status_code != 200:
-            return None
-        return r.json()
+    r = await _backend_request(
+        "POST",
+        "/api/chats",
+        json={"channel": CHANNEL, "externalId": user_id},
+    )
+    if r is None or r.status_code != 200:
+        return None
+    return r.json()
 
 
 async def _list_agents() -> list[dict]:
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        r = await client.get(f"{BACKEND_URL}/api/agents")
-        if r.status_code != 200:
-            return []
-        return r.json()
+    r = await _backend_request("GET", "/api/agents")
+    if r is None or r.status_code != 200:
+        return []
+    return r.json()
 
 
 async def _set_chat_agent(chat_id: str, agent_id: str) -> bool:
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        r = await client.patch(
-            f"{BACKEND_URL}/api/chats/{chat_id}/agent",
-            json={"agentId": agent_id},
-        )
-        return r.status_code == 200
+    r = await _backend_request(
+        "PATCH",
+        f"/api/chats/{chat_id}/agent",
+        json={"agentId": agent_id},
+    )
+    return r is not None and r.status_code == 200
 
 
 async def _update_agent_prompt(agent_id: str, system_prompt: str) -> bool:
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        r = await client.patch(
-            f"{BACKEND_URL}/api/agents/{agent_id}",
-            json={"systemPrompt": system_prompt},
-        )
-        return r.status_code == 200
+    r = await _backend_request(
+        "PATCH",
+        f"/api/agents/{agent_id}",
+        json={"systemPrompt": system_prompt},
+    )
+    return r is not None and r.status_code == 200
 
 
-async def _send_text(chat_id: str, text: str) -> dict | None:
-    async with httpx.AsyncClient(timeout=120.0) as client:
-        r = await client.post(
-            f"{BACKEND_URL}/api/chats/{chat_id}/send",
-            json={"message": text, "modelId": None},
-        )
-        if r.status_code != 200:
-            return None
-        return r.json()
+def _idempotency_key(update: Update, chat_id: str) -> str:
+    """One key per Telegram update and backend chat: a redelivered update or a retry gets the first reply."""
+    return f"tg:{update.update_id}:{chat_id}"
 
 
-async def _send_voice(chat_id: str, audio_bytes: bytes, filename: str) -> dict | None:
-    async with httpx.AsyncClient(timeout=120.0) as client:
-        files = {"audio": (filename, audio_bytes)}
-        r = await client.post(
-            f"{BACKEND_URL}/api/chats/{chat_id}/send-voice",
-            files=files,
-        )
-        if r.status_code != 200:
-            return None
-        return r.json()
+async def _send_text(chat_id: str, text: str, idempotency_key: str) -> dict | None:
+    r = await _backend_request(
+        "POST",
+        f"/api/chats/{chat_id}/send",
+        json={"message": text, "modelId": None},
+        headers={"Idempotency-Key": idempotency_key},
+        timeout=120.0,
+    )
+    if r is None or r.status_code != 200:
+        return None
+    return r.json()
+
+
+async def _send_voice(chat_id: str, audio_bytes: bytes, filename: str, idempotency_key: str) -> dict | None:
+    files = {"audio": (filename, audio_bytes)}
+    r = await _backend_request(
+        "POST",
+        f"/api/chats/{chat_id}/send-voice",
+        files=files,
+        headers={"Idempotency-Key": idempotency_key},
+        timeout=120.0,
+    )
+    if r is None or r.status_code != 200:
+        return None
+    return r.json()
+
+
+# --- Concurrent update processing: users in parallel, one user's updates in order ---
+
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "64"))
+BOT_MAX_USER_QUEUE = int(os.getenv("BOT_MAX_USER_QUEUE", "5"))
+TYPING_INTERVAL = 4.5  # Telegram shows "typing…" for ~5 s per send_chat_action
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Runs updates of different users concurrently (at most max_concurrent at a time) while keeping
+    each user's updates strictly in arrival order. A user with max_user_queue updates already
+    pending gets further updates dropped instead of queueing without bound.
+    """
+
+    def __init__(self, max_concurrent: int, max_user_queue: int):
+        # Базовый семафор ограничивает общее число ожидающих апдейтов; слоты обработки — свой семафор,
+        # который берётся уже после очереди пользователя, чтобы ждущие своей очереди не занимали слоты
+        super().__init__(max_concurrent_updates=max_concurrent * max(max_user_queue, 1))
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._max_user_queue = max(max_user_queue, 1)
+        self._users: dict[str, tuple[asyncio.Lock, list[int]]] = {}
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = _user_id(update) if isinstance(update, Update) else None
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+        lock, pending = self._users.setdefault(key, (asyncio.Lock(), [0]))
+        if pending[0] >= self._max_user_queue:
+            coroutine.close()
+            logger.warning("User %s has %s pending updates; dropping update", key, pending[0])
+            if update.effective_message:
+                with suppress(Exception):
+                    await update.effective_message.reply_text("Подождите, обрабатываю предыдущие сообщения.")
+            return
+        pending[0] += 1
+        try:
+            async with lock:
+                async with self._slots:
+                    await coroutine
+        finally:
+            pending[0] -= 1
+            if pending[0] == 0:
+                self._users.pop(key, None)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+@asynccontextmanager
+async def _typing(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str = ChatAction.TYPING):
+    """Keep sending a chat action while the block runs (e.g. while waiting on the backend)."""
+    chat = update.effective_chat
+
+    async def _loop() -> None:
+        while True:
+            try:
+                await context.bot.send_chat_action(chat.id, action)
+            except Exception as e:
+                logger.debug("send_chat_action failed: %s", e)
+            await asyncio.sleep(TYPING_INTERVAL)
+
+    task = asyncio.create_task(_loop()) if chat else None
+    try:
+        yield
+    finally:
+        if task:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
 
 
 # --- Handlers ---
 
+async def _reply_parts(update: Update, result: dict) -> None:
+    """Send the reply as the backend split it for Telegram (parts), one message after another."""
+    content = result.get("content") or ""
+    parts = result.get("parts") or [content[i:i + 4000] for i in range(0, len(content), 4000)] or [""]
+    for part in parts:
+        if part.strip():
+            await update.message.reply_text(part)
+
+
+async def _current_chat_id(uid: str, context: ContextTypes.DEFAULT_TYPE) -> str | None:
+    """Selected chat; if none (new user or expired state) — the user's latest backend chat, else a new one."""
+    chat_id = context.user_data.get("current_chat_id")
+    if chat_id:
+        return chat_id
+    chats = await _list_chats(uid)
+    chat = chats[0] if chats else await _create_chat(uid)
+    if chat:
+        context.user_data["current_chat_id"] = chat["id"]
+        return chat["id"]
+    return None
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     uid = _user_id(update)
     if not uid:
@@ -210,20 +389,16 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             await update.message.reply_text("Промпт обновлён." if ok else "Ошибка обновления.")
         return
 
-    chat_id = context.user_data.get("current_chat_id")
-    if not chat_id:
-        new_chat = await _create_chat(uid)
-        if new_chat:
-            context.user_data["current_chat_id"] = new_chat["id"]
-            chat_id = new_chat["id"]
+    chat_id = await _current_chat_id(uid, context)
     if not chat_id:
         await update.message.reply_text("Ошибка связи с сервером. Отправьте /start.")
         return
-    result = await _send_text(chat_id, text)
+    async with _typing(update, context):
+        result = await _send_text(chat_id, text, _idempotency_key(update, chat_id))
     if not result:
         await update.message.reply_text("Не удалось получить ответ.")
         return
-    await update.message.reply_text((result.get("content") or "")[:4000])
+    await _reply_parts(update, result)
 
 
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -232,12 +407,7 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     uid = _user_id(update)
     if not uid:
         return
-    chat_id = context.user_data.get("current_chat_id")
-    if not chat_id:
-        new_chat = await _create_chat(uid)
-        if new_chat:
-            context.user_data["current_chat_id"] = new_chat["id"]
-            chat_id = new_chat["id"]
+    chat_id = await _current_chat_id(uid, context)
     if not chat_id:
         await update.message.reply_text("Ошибка связи с сервером. Отправьте /start.")
         return
@@ -247,12 +417,12 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     await file.download_to_memory(buf)
     buf.seek(0)
     audio_bytes = buf.read()
-    result = await _send_voice(chat_id, audio_bytes, "voice.ogg")
+    async with _typing(update, context, ChatAction.RECORD_VOICE):
+        result = await _send_voice(chat_id, audio_bytes, "voice.ogg", _idempotency_key(update, chat_id))
     if not result:
         await update.message.reply_text("Не удалось обработать голосовое.")
         return
-    content = result.get("content", "")
-    await update.message.reply_text(content[:4000])
+    await _reply_parts(update, result)
     audio_b64 = result.get("audioBase64")
     if audio_b64:
         try:
@@ -266,11 +436,32 @@ def main() -> None:
     token = os.getenv("TELEGRAM_BOT_TOKEN")
     if not token:
         raise SystemExit("Set TELEGRAM_BOT_TOKEN in .env")
-    app = Application.builder().token(token).build()
+    builder = (
+        Application.builder()
+        .token(token)
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+        .post_init(init_backend_client)
+        .post_shutdown(close_backend_client)
+        .concurrent_updates(PerUserUpdateProcessor(BOT_CONCURRENT_UPDATES, BOT_MAX_USER_QUEUE))
+    )
+    if REDIS_URL:
+        from persistence import RedisPersistence
+        builder = builder.persistence(
+            RedisPersistence(REDIS_URL, ttl_seconds=BOT_STATE_TTL, update_interval=BOT_STATE_FLUSH_INTERVAL)
+        )
+    else:
+        logger.warning("REDIS_URL not set: user state is kept in memory and lost on restart")
+    app = builder.build()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CallbackQueryHandler(callback_query))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
     app.add_handler(MessageHandler(filters.VOICE, handle_voice))
+    if BOT_MODE == "webhook":
+        from webhook import run_webhook
+        logger.info("Telegram bot starting (webhook)...")
+        asyncio.run(run_webhook(app, _user_id))
+        return
     logger.info("Telegram bot starting...")
     app.run_polling(allowed_updates=Update.ALL_TYPES)
 
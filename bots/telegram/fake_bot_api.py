@@ -0,0 +1,182 @@
+"""
+Local fake Telegram Bot API (+ minimal fake Agiens backend) for load-testing the bot without network access.
+
+Serve:
+    python fake_bot_api.py serve --port 8081
+Run bot replicas against it (webhook mode):
+    TELEGRAM_BOT_TOKEN=1:fake TELEGRAM_API_URL=http://127.0.0.1:8081 BACKEND_URL=http://127.0.0.1:8081 \\
+    BOT_MODE=webhook WEBHOOK_PORT=8080 BOT_REPLICAS=http://127.0.0.1:8080,http://127.0.0.1:8082 \\
+    BOT_SELF_URL=http://127.0.0.1:8080 python bot.py      (and the same with port 8082)
+Load test (posts updates to the webhook, waits for the bot's replies, checks per-user order):
+    python fake_bot_api.py load --api http://127.0.0.1:8081 --webhook http://127.0.0.1:8080/telegram/webhook \\
+        --users 200 --messages 10
+
+The fake backend replies "echo: <text>" after BACKEND_DELAY seconds (default 0.5) to emulate the LLM.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import time
+import uuid
+
+import httpx
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+BACKEND_DELAY = float(os.getenv("BACKEND_DELAY", "0.5"))
+
+_message_ids = itertools.count(1)
+# chat_id -> texts sent by the bot, in order
+_sent: dict[int, list[str]] = {}
+
+
+def _ok(result) -> JSONResponse:
+    return JSONResponse({"ok": True, "result": result})
+
+
+async def _params(request: Request) -> dict:
+    """Bot API parameters: form-encoded (values JSON-encoded for objects) or JSON body."""
+    if request.headers.get("content-type", "").startswith("application/json"):
+        return await request.json()
+    form = await request.form()
+    out = {}
+    for k, v in form.items():
+        if isinstance(v, str):
+            try:
+                out[k] = json.loads(v)
+            except ValueError:
+                out[k] = v
+    return out
+
+
+def _message(chat_id: int, text: str | None = None) -> dict:
+    msg = {"message_id": next(_message_ids), "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+    if text is not None:
+        msg["text"] = text
+    return msg
+
+
+async def bot_method(request: Request) -> JSONResponse:
+    method = request.path_params["method"]
+    p = await _params(request)
+    if method == "getMe":
+        return _ok({"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"})
+    if method in ("setWebhook", "deleteWebhook", "sendChatAction", "answerCallbackQuery"):
+        return _ok(True)
+    if method == "getUpdates":
+        await asyncio.sleep(min(float(p.get("timeout") or 0), 1.0))
+        return _ok([])
+    if method in ("sendMessage", "editMessageText"):
+        chat_id = int(p.get("chat_id") or 0)
+        _sent.setdefault(chat_id, []).append(str(p.get("text") or ""))
+        return _ok(_message(chat_id, p.get("text")))
+    if method == "sendVoice":
+        return _ok(_message(int(p.get("chat_id") or 0)))
+    return JSONResponse({"ok": False, "error_code": 404, "description": f"Fake: {method} not implemented"}, status_code=404)
+
+
+async def sent(request: Request) -> JSONResponse:
+    return JSONResponse({str(k): v for k, v in _sent.items()})
+
+
+async def reset(request: Request) -> JSONResponse:
+    _sent.clear()
+    return JSONResponse({"ok": True})
+
+
+# --- Fake backend: just enough of /api/chats for handle_text ---
+
+async def create_chat(request: Request) -> JSONResponse:
+    now = time.strftime("%Y-%m-%dT%H:%M:%S")
+    return JSONResponse({"id": str(uuid.uuid4()), "title": "New chat", "model": "fake", "lastMessagePreview": "", "lastMessageAt": now})
+
+
+async def list_chats(request: Request) -> JSONResponse:
+    return JSONResponse([])
+
+
+async def send(request: Request) -> JSONResponse:
+    body = await request.json()
+    await asyncio.sleep(BACKEND_DELAY)
+    return JSONResponse({"content": f"echo: {body.get('message', '')}", "audioBase64": None})
+
+
+app = Starlette(
+    routes=[
+        Route("/bot{token}/{method}", bot_method, methods=["GET", "POST"]),
+        Route("/_fake/sent", sent, methods=["GET"]),
+        Route("/_fake/reset", reset, methods=["POST"]),
+        Route("/api/chats", create_chat, methods=["POST"]),
+        Route("/api/chats", list_chats, methods=["GET"]),
+        Route("/api/chats/{chat_id}/send", send, methods=["POST"]),
+    ]
+)
+
+
+async def load(api: str, webhook: str, users: int, messages: int, secret: str, timeout: float) -> None:
+    """Post users*messages text updates to the webhook, wait for all replies, report latency and ordering."""
+    update_ids = itertools.count(1)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        await client.post(f"{api}/_fake/reset")
+        started = time.perf_counter()
+
+        async def _user(uid: int) -> None:
+            for i in range(messages):
+                update = {
+                    "update_id": next(update_ids),
+                    "message": {
+                        **_message(uid, f"m{i}"),
+                        "from": {"id": uid, "is_bot": False, "first_name": f"u{uid}"},
+                    },
+                }
+                r = await client.post(webhook, json=update, headers=headers)
+                r.raise_for_status()
+
+        await asyncio.gather(*(_user(100000 + u) for u in range(users)))
+        posted = time.perf_counter() - started
+        expected = users * messages
+        got = 0
+        while time.perf_counter() - started < timeout:
+            data = (await client.get(f"{api}/_fake/sent")).json()
+            got = sum(len(v) for v in data.values())
+            if got >= expected:
+                break
+            await asyncio.sleep(0.2)
+        total = time.perf_counter() - started
+    out_of_order = [
+        chat for chat, texts in data.items()
+        if texts != [f"echo: m{i}" for i in range(len(texts))]
+    ]
+    print(f"posted {expected} updates in {posted:.2f}s ({expected / posted:.0f}/s)")
+    print(f"replies {got}/{expected} in {total:.2f}s ({got / total:.0f}/s)")
+    print(f"users with out-of-order replies: {len(out_of_order)}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_serve = sub.add_parser("serve")
+    p_serve.add_argument("--host", default="127.0.0.1")
+    p_serve.add_argument("--port", type=int, default=8081)
+    p_load = sub.add_parser("load")
+    p_load.add_argument("--api", default="http://127.0.0.1:8081")
+    p_load.add_argument("--webhook", default="http://127.0.0.1:8080/telegram/webhook")
+    p_load.add_argument("--users", type=int, default=100)
+    p_load.add_argument("--messages", type=int, default=5)
+    p_load.add_argument("--secret", default=os.getenv("WEBHOOK_SECRET", ""))
+    p_load.add_argument("--timeout", type=float, default=120.0)
+    args = parser.parse_args()
+    if args.cmd == "serve":
+        import uvicorn
+        uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+    else:
+        asyncio.run(load(args.api, args.webhook, args.users, args.messages, args.secret, args.timeout))
+
+
+if __name__ == "__main__":
+    main()
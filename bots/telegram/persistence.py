@@ -0,0 +1,150 @@
+"""
+Redis-backed PTB persistence for user_data/chat_data (current_chat_id, editing_agent_id, waiting_prompt_text).
+
+State survives restarts and is shared between webhook replicas:
+- one JSON key per user/chat (tgbot:user:<id>, tgbot:chat:<id>) with a TTL refreshed on every write;
+- writes are coalesced by PTB's update_interval (BOT_STATE_FLUSH_INTERVAL) and skipped when unchanged;
+- nothing is loaded at startup: refresh_* pulls a user's state right before their update is handled,
+  and only when another process wrote a newer version.
+"""
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any
+
+from redis.asyncio import Redis
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+
+class RedisPersistence(BasePersistence):
+    def __init__(
+        self,
+        url: str,
+        *,
+        prefix: str = "tgbot",
+        ttl_seconds: int = 30 * 24 * 3600,
+        update_interval: float = 5.0,
+        max_known: int = 10000,
+    ):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._redis = Redis.from_url(url, decode_responses=True)
+        self._prefix = prefix
+        self._ttl = ttl_seconds
+        # key -> (version, json of data) last read from / written to Redis by this process; LRU of max_known keys
+        # (a forgotten key only costs one extra write or re-read)
+        self._known: OrderedDict[str, tuple[int, str]] = OrderedDict()
+        self._max_known = max_known
+
+    def _key(self, kind: str, id: int) -> str:
+        return f"{self._prefix}:{kind}:{id}"
+
+    def _remember(self, key: str, version: int, encoded: str) -> None:
+        self._known[key] = (version, encoded)
+        self._known.move_to_end(key)
+        while len(self._known) > self._max_known:
+            self._known.popitem(last=False)
+
+    async def _write(self, key: str, data: dict) -> None:
+        encoded = json.dumps(data, ensure_ascii=False, sort_keys=True)
+        known = self._known.get(key)
+        if known and known[1] == encoded:
+            self._known.move_to_end(key)
+            return
+        version = time.time_ns()
+        try:
+            await self._redis.set(key, json.dumps({"v": version, "d": data}, ensure_ascii=False), ex=self._ttl)
+        except Exception as e:
+            # Не роняем обработку апдейтов: состояние останется в памяти и уйдёт при следующем сбросе
+            logger.warning("Redis persistence write %s failed: %s", key, e)
+            return
+        self._remember(key, version, encoded)
+
+    async def _refresh(self, key: str, data: dict) -> None:
+        try:
+            raw = await self._redis.get(key)
+        except Exception as e:
+            logger.warning("Redis persistence read %s failed: %s", key, e)
+            return
+        if not raw:
+            return
+        try:
+            payload = json.loads(raw)
+            version = int(payload.get("v", 0))
+            remote = dict(payload.get("d") or {})
+        except (ValueError, TypeError, AttributeError) as e:
+            # Битое значение не роняет обработку апдейта: работаем с состоянием в памяти, следующая запись его заменит
+            logger.warning("Redis persistence %s holds invalid state, ignoring it: %s", key, e)
+            return
+        known = self._known.get(key)
+        if known and known[0] >= version:
+            self._known.move_to_end(key)
+            return
+        data.clear()
+        data.update(remote)
+        self._remember(key, version, json.dumps(remote, ensure_ascii=False, sort_keys=True))
+
+    async def _drop(self, key: str) -> None:
+        self._known.pop(key, None)
+        try:
+            await self._redis.delete(key)
+        except Exception as e:
+            logger.warning("Redis persistence delete %s failed: %s", key, e)
+
+    # --- user_data / chat_data ---
+
+    async def get_user_data(self) -> dict[int, dict[Any, Any]]:
+        return {}
+
+    async def get_chat_data(self) -> dict[int, dict[Any, Any]]:
+        return {}
+
+    async def update_user_data(self, user_id: int, data: dict[Any, Any]) -> None:
+        await self._write(self._key("user", user_id), data)
+
+    async def update_chat_data(self, chat_id: int, data: dict[Any, Any]) -> None:
+        await self._write(self._key("chat", chat_id), data)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict[Any, Any]) -> None:
+        await self._refresh(self._key("user", user_id), user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict[Any, Any]) -> None:
+        await self._refresh(self._key("chat", chat_id), chat_data)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self._drop(self._key("user", user_id))
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        await self._drop(self._key("chat", chat_id))
+
+    # --- not persisted ---
+
+    async def get_bot_data(self) -> dict[Any, Any]:
+        return {}
+
+    async def update_bot_data(self, data: dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict[Any, Any]) -> None:
+        pass
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object | None) -> None:
+        pass
+
+    async def flush(self) -> None:
+        """Called on Application shutdown after the final update_* round."""
+        await self._redis.aclose()
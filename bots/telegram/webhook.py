@@ -0,0 +1,175 @@
+"""
+Webhook mode for the Telegram bot with horizontal sharding across replicas.
+
+Telegram posts every update to one public URL (nginx → any replica). Each replica owns a slice of
+users on a consistent-hash ring over BOT_REPLICAS; an update for a user owned by another replica is
+forwarded to that replica's /telegram/internal endpoint before Telegram gets its 200, so one user's
+updates are always handled (in order) by the same process while different users spread over replicas.
+
+Env:
+  WEBHOOK_URL      public URL registered with Telegram (e.g. https://server.example/telegram/webhook)
+  WEBHOOK_SECRET   secret_token checked on every webhook/internal request; required with several replicas
+                   (without it /telegram/internal is not served)
+  WEBHOOK_LISTEN / WEBHOOK_PORT   bind address of this replica (default 0.0.0.0:8080)
+  BOT_REPLICAS     comma-separated internal base URLs of all replicas (same order everywhere)
+  BOT_SELF_URL     this replica's entry in BOT_REPLICAS
+"""
+import bisect
+import hashlib
+import hmac
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import Callable
+
+import httpx
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response
+from starlette.routing import Route
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+BOT_REPLICAS = [u.strip().rstrip("/") for u in os.getenv("BOT_REPLICAS", "").split(",") if u.strip()]
+BOT_SELF_URL = os.getenv("BOT_SELF_URL", "").rstrip("/")
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class HashRing:
+    """Consistent-hash ring with virtual nodes: adding/removing a replica moves only ~1/N of users."""
+
+    def __init__(self, nodes: list[str], vnodes: int = 128):
+        self._ring: list[tuple[int, str]] = sorted(
+            (self._hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes)
+        )
+        self._keys = [h for h, _ in self._ring]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def node_for(self, key: str) -> str | None:
+        if not self._ring:
+            return None
+        i = bisect.bisect(self._keys, self._hash(key)) % len(self._ring)
+        return self._ring[i][1]
+
+
+def _secret_ok(request: Request) -> bool:
+    if not WEBHOOK_SECRET:
+        return True
+    return hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), WEBHOOK_SECRET)
+
+
+def build_webhook_app(application: Application, user_key: Callable[[Update], str | None]) -> Starlette:
+    """Starlette app: /telegram/webhook (from Telegram, routes by user), /telegram/internal (from peers), /healthz."""
+    if len(BOT_REPLICAS) > 1 and not WEBHOOK_SECRET:
+        # Без секрета /telegram/internal принимал бы апдейты от кого угодно
+        raise RuntimeError("WEBHOOK_SECRET is required when BOT_REPLICAS lists several replicas")
+    ring = HashRing(BOT_REPLICAS)
+    forward_client = httpx.AsyncClient(timeout=10.0, limits=httpx.Limits(max_keepalive_connections=20))
+
+    async def _parse(request: Request) -> tuple[dict, Update] | None:
+        """Body as JSON and as an Update; None if it is not a valid update."""
+        try:
+            data = await request.json()
+            return data, Update.de_json(data, application.bot)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            logger.warning("Rejected malformed update: %s", e)
+            return None
+
+    async def webhook(request: Request) -> Response:
+        if not _secret_ok(request):
+            return PlainTextResponse("forbidden", status_code=403)
+        parsed = await _parse(request)
+        if parsed is None:
+            return PlainTextResponse("bad request", status_code=400)
+        data, update = parsed
+        key = user_key(update)
+        owner = ring.node_for(key) if key else None
+        if owner is None or owner == BOT_SELF_URL:
+            await application.update_queue.put(update)
+            return Response(status_code=200)
+        try:
+            r = await forward_client.post(
+                f"{owner}/telegram/internal",
+                json=data,
+                headers={SECRET_HEADER: WEBHOOK_SECRET},
+            )
+            r.raise_for_status()
+        except httpx.HTTPError as e:
+            # Не 200 → Telegram повторит доставку позже, порядок для пользователя сохранится
+            logger.warning("Forward update %s to %s failed: %s", data.get("update_id"), owner, e)
+            return Response(status_code=503)
+        return Response(status_code=200)
+
+    async def internal(request: Request) -> Response:
+        if not _secret_ok(request):
+            return PlainTextResponse("forbidden", status_code=403)
+        parsed = await _parse(request)
+        if parsed is None:
+            return PlainTextResponse("bad request", status_code=400)
+        await application.update_queue.put(parsed[1])
+        return Response(status_code=200)
+
+    async def healthz(request: Request) -> Response:
+        return PlainTextResponse("ok")
+
+    @asynccontextmanager
+    async def _lifespan(app: Starlette):
+        try:
+            yield
+        finally:
+            await forward_client.aclose()
+
+    routes = [
+        Route("/telegram/webhook", webhook, methods=["POST"]),
+        Route("/healthz", healthz, methods=["GET"]),
+    ]
+    if WEBHOOK_SECRET:
+        routes.append(Route("/telegram/internal", internal, methods=["POST"]))
+    return Starlette(routes=routes, lifespan=_lifespan)
+
+
+async def run_webhook(application: Application, user_key: Callable[[Update], str | None]) -> None:
+    """Serve webhook for this replica until stopped. The first replica (or a single one) registers the webhook."""
+    import uvicorn
+
+    server = uvicorn.Server(
+        uvicorn.Config(
+            build_webhook_app(application, user_key),
+            host=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            log_level="info",
+        )
+    )
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        is_leader = not BOT_REPLICAS or BOT_SELF_URL == BOT_REPLICAS[0]
+        if is_leader and WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=100,
+            )
+            logger.info("Webhook registered: %s", WEBHOOK_URL)
+        await application.start()
+        logger.info(
+            "Webhook replica %s listening on %s:%s (%s replicas)",
+            BOT_SELF_URL or "-", WEBHOOK_LISTEN, WEBHOOK_PORT, len(BOT_REPLICAS) or 1,
+        )
+        try:
+            await server.serve()
+        finally:
+            await application.stop()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
@@ -75,7 +75,8 @@ export interface ChatWithMessagesDto {
   title: string;
   modelId: string;
   agentId?: string | null;
-  messages: { id: string; role: string; content: string; createdAt: string }[];
+  messages: { id: string; role: string; content: string; createdAt: string; seq: number }[];
+  hasMore?: boolean;
 }
 
 export interface AccountMeDto {